@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
 import gzip
+import hashlib
+import shutil
 import sys
+import zlib
 
 __author__ = 'zhouqi'
 
+import json
 import logging
 import os
 import signal
 import time
 
+from tornado import gen
 from tornado import ioloop
 from tornado import web
 from tornado.httpserver import HTTPServer
@@ -100,14 +105,191 @@ class BaseApp(object):
         pass
 
 
+HEADER_BYTES = 80
+CHUNK_HEADERS = 2016
+CHUNK_BYTES = HEADER_BYTES * CHUNK_HEADERS
+DEFAULT_FILE = 'blockchain_headers'
+
+_manifests = {}  # path -> (size, mtime, manifest)
+
+
+def headers_path(root, name):
+    """
+    :return: path of the headers file name in root, None if name is not a plain file name
+    """
+    if name != os.path.basename(name) or name.startswith('.'):
+        return None
+    path = os.path.join(root, name)
+    if not os.path.isfile(path):
+        return None
+    return path
+
+
+def chunk_checksums(path):
+    """
+    sha256 of every complete 2016-headers chunk, cached until the file changes
+    """
+    stat = os.stat(path)
+    cached = _manifests.get(path)
+    if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime):
+        return cached[2]
+    checksums = []
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(CHUNK_BYTES)
+            if len(data) < CHUNK_BYTES:
+                break
+            checksums.append(hashlib.sha256(data).hexdigest())
+    manifest = {'headers': stat.st_size / HEADER_BYTES,
+                'chunk_headers': CHUNK_HEADERS,
+                'sha256': checksums}
+    _manifests[path] = (stat.st_size, stat.st_mtime, manifest)
+    return manifest
+
+
+def precompress(root):
+    """
+    write name.gz next to every headers file which is newer than its .gz
+    """
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name.endswith('.gz') or not os.path.isfile(path):
+            continue
+        gz_path = path + '.gz'
+        if os.path.exists(gz_path) and os.path.getmtime(gz_path) >= os.path.getmtime(path):
+            continue
+        logging.info('precompress %s', path)
+        with open(path, 'rb') as src, gzip.open(gz_path + '.tmp', 'wb') as dst:
+            shutil.copyfileobj(src, dst, CHUNK_BYTES)
+        os.rename(gz_path + '.tmp', gz_path)
+
+
+def accept_gzip(handler):
+    return 'gzip' in handler.request.headers.get('Accept-Encoding', '')
+
+
+class PrecompressedStaticFileHandler(web.StaticFileHandler):
+    """
+    serve name.gz with Content-Encoding gzip when the client accepts it and it is
+    a full request, Range requests always get the plain file so offsets mean headers
+    """
+
+    def validate_absolute_path(self, root, absolute_path):
+        absolute_path = super(PrecompressedStaticFileHandler, self).validate_absolute_path(
+            root, absolute_path)
+        self.set_header('Vary', 'Accept-Encoding')
+        gz_path = absolute_path + '.gz'
+        if accept_gzip(self) and 'Range' not in self.request.headers \
+                and os.path.isfile(gz_path) \
+                and os.path.getmtime(gz_path) >= os.path.getmtime(absolute_path):
+            self.set_header('Content-Encoding', 'gzip')
+            return gz_path
+        return absolute_path
+
+    def get_content_type(self):
+        if 'Content-Encoding' in self._headers:
+            return 'application/octet-stream'
+        return super(PrecompressedStaticFileHandler, self).get_content_type()
+
+    @classmethod
+    def get_content_version(cls, abspath):
+        # size and mtime, hashing a whole headers file on every request is too slow
+        stat = os.stat(abspath)
+        return '%x-%x' % (stat.st_size, int(stat.st_mtime))
+
+
+class ManifestHandler(web.RequestHandler):
+    """
+    /manifest?file=testnet_headers, the number of headers and the sha256 of every
+    complete chunk, so a client can tell which chunks it already has
+    """
+
+    def initialize(self, path):
+        self.root = path
+
+    def get(self):
+        path = headers_path(self.root, self.get_argument('file', DEFAULT_FILE))
+        if path is None:
+            raise web.HTTPError(404)
+        self.set_header('Content-Type', 'application/json')
+        # etag of the body, unchanged manifests are answered with 304
+        self.write(json.dumps(chunk_checksums(path)))
+
+
+class HeadersHandler(web.RequestHandler):
+    """
+    /headers?from=H&file=testnet_headers, the raw headers from height H to the end,
+    streamed and gzipped on the fly when the client accepts it
+    """
+    read_bytes = CHUNK_BYTES
+
+    def initialize(self, path):
+        self.root = path
+
+    def compute_etag(self):
+        return None  # set in get, before the body is streamed
+
+    @gen.coroutine
+    def get(self):
+        path = headers_path(self.root, self.get_argument('file', DEFAULT_FILE))
+        if path is None:
+            raise web.HTTPError(404)
+        try:
+            height = int(self.get_argument('from', 0))
+        except ValueError:
+            raise web.HTTPError(400)
+        stat = os.stat(path)
+        end = stat.st_size - stat.st_size % HEADER_BYTES
+        if height < 0 or height * HEADER_BYTES > end:
+            raise web.HTTPError(416)
+        self.set_header('Content-Type', 'application/octet-stream')
+        self.set_header('Vary', 'Accept-Encoding')
+        self.set_header('X-Height-From', str(height))
+        self.set_header('Etag', '"%x-%x-%x"' % (end, int(stat.st_mtime), height))
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        compressor = None
+        if accept_gzip(self):
+            self.set_header('Content-Encoding', 'gzip')
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        else:
+            self.set_header('Content-Length', str(end - height * HEADER_BYTES))
+        with open(path, 'rb') as f:
+            f.seek(height * HEADER_BYTES)
+            remain = end - height * HEADER_BYTES
+            while remain > 0:
+                data = f.read(min(self.read_bytes, remain))
+                if not data:
+                    break
+                remain -= len(data)
+                self.write(compressor.compress(data) if compressor else data)
+                yield self.flush()
+        if compressor is not None:
+            self.write(compressor.flush())
+
+
 class Api(BaseApp):
-    pass
+    path = 'files'
+
+    def prepare(self):
+        if os.path.isdir(self.path):
+            precompress(self.path)
+
+
+def make_routings(path='files'):
+    """
+    :param path: directory of blockchain_headers and testnet_headers
+    """
+    return [
+        (r"/files/(.*)", PrecompressedStaticFileHandler, {"path": path}),
+        (r"/manifest", ManifestHandler, {"path": path}),
+        (r"/headers", HeadersHandler, {"path": path}),
 
+    ]
 
-routings = [
-    (r"/files/(.*)", web.StaticFileHandler, {"path": "files"}),
 
-]
+routings = make_routings()
 
 print '\n'.join([e[0] for e in routings])
 
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import deque
+
+from tornado import gen
+from tornado.locks import Condition
+
+from electrumq.chain import logger
+from electrumq.utils.exception import ChunkException
+
+__author__ = 'zhouqi'
+
+
+class ChunkScheduler(object):
+    """
+    fetch the chunks first..last with at most window of them in flight or waiting,
+    chunks arriving early wait in a reorder buffer and are committed strictly in
+    height order; a chunk which fails to arrive or to connect is requested again,
+    up to retries times
+    """
+    window = 8
+    retries = 3
+    report_interval = 5  # second
+
+    def __init__(self, first, last, fetch, commit, window=None):
+        """
+        :param fetch: function(idx), future of the raw chunk bytes
+        :param commit: function(idx, data), True if the chunk is connected
+        """
+        if window is not None:
+            self.window = window
+        self.first = first
+        self.last = last
+        self.fetch = fetch
+        self.commit = commit
+        self.next_request = first
+        self.next_commit = first
+        self._in_flight = set()
+        self._buffer = {}
+        self._failed = deque()
+        self._attempts = {}
+        self._error = None
+        self._changed = Condition()
+        self.retry_cnt = 0
+        self.header_cnt = 0
+        self.begin = None
+        self._reported = None
+
+    def extend(self, last):
+        """
+        the remote tip moved while catching up
+        """
+        self.last = max(self.last, last)
+        self._changed.notify()
+
+    def is_running(self):
+        return self.begin is not None and self.next_commit <= self.last and self._error is None
+
+    @gen.coroutine
+    def run(self):
+        """
+        :return: future of the number of headers committed
+        """
+        self.begin = self._reported = time.time()
+        while self.next_commit <= self.last:
+            self.fill()  # a cached chunk may land in the buffer right away
+            if self.next_commit in self._buffer:
+                idx = self.next_commit
+                data = self._buffer.pop(idx)
+                if self.commit(idx, data):
+                    self.next_commit += 1
+                    self.header_cnt += len(data) / 80
+                    self.report()
+                else:
+                    self.fail(idx, 'cannot connect')
+                continue
+            if self._error is not None:
+                # what is already in order is committed
+                raise self._error
+            yield self._changed.wait()
+        self.report(force=True)
+        raise gen.Return(self.header_cnt)
+
+    def fill(self):
+        while len(self._in_flight) + len(self._buffer) < self.window:
+            if self._failed:
+                idx = self._failed.popleft()
+            elif self.next_request <= self.last:
+                idx = self.next_request
+                self.next_request += 1
+            else:
+                break
+            self.fetch_one(idx)
+
+    @gen.coroutine
+    def fetch_one(self, idx):
+        self._in_flight.add(idx)
+        try:
+            data = yield self.fetch(idx)
+        except Exception as ex:
+            self._in_flight.discard(idx)
+            self.fail(idx, ex)
+        else:
+            self._in_flight.discard(idx)
+            self._buffer[idx] = data
+        self._changed.notify()
+
+    def fail(self, idx, reason):
+        attempt = self._attempts.get(idx, 0) + 1
+        self._attempts[idx] = attempt
+        if attempt > self.retries:
+            self._error = ChunkException('chunk %d failed %d times: %s' % (idx, attempt, reason))
+            return
+        logger.warning('chunk %d failed: %s, request it again', idx, reason)
+        self.retry_cnt += 1
+        self._failed.append(idx)
+        # the lowest failed chunk blocks the commit, ask for it first
+        self._failed = deque(sorted(self._failed))
+
+    def report(self, force=False):
+        now = time.time()
+        if force or now - self._reported >= self.report_interval:
+            self._reported = now
+            stats = self.stats()
+            logger.info('catch up chunk %d/%d, %d headers, %.0f headers/s',
+                        self.next_commit - 1, self.last, stats['headers'],
+                        stats['headers_per_sec'])
+
+    def stats(self):
+        elapsed = time.time() - self.begin if self.begin is not None else 0
+        return {'headers': self.header_cnt,
+                'headers_per_sec': self.header_cnt / elapsed if elapsed > 0 else 0.0,
+                'next_commit': self.next_commit,
+                'in_flight': len(self._in_flight),
+                'buffered': len(self._buffer),
+                'retries': self.retry_cnt}
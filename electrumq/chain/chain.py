@@ -1,17 +1,21 @@
 # -*- coding: utf-8 -*-
+import os
 import traceback
-from datetime import datetime
 
 from tornado import gen
+from tornado.concurrent import Future
 
 from electrumq.chain import logger
-from electrumq.db.sqlite import header_dict_to_block_item
-from electrumq.db.sqlite.block import BlockStore
-from electrumq.message.blockchain.block import GetHeaderFile
+from electrumq.chain.catchup import ChunkScheduler
+from electrumq.chain.forks import ForkTree
+from electrumq.db.sqlite import header_dict_to_block_item, BlockItem
+from electrumq.db.block import BlockStore
+from electrumq.db.sqlite.tx import TxStore
 from electrumq.message.blockchain.headers import Subscribe
 from electrumq.net.manager import NetWorkManager
 from electrumq.utils import Singleton
-from electrumq.message.all import headers_subscribe
+from electrumq.message.all import headers_subscribe, GetChunk, GetMerkle
+from electrumq.utils.exception import ChunkException
 
 __author__ = 'zhouqi'
 
@@ -20,25 +24,79 @@ BLOCK_INTERVAL = 2016
 
 class BlockChain():
     __metaclass__ = Singleton
+    chunk_timeout = 30  # second, a chunk not arriving in time is requested again
+    catch_up_window = 8  # chunks in flight or waiting to be committed
+    verify_batch = 16  # downloaded chunks verified together, on the process pool
 
     def __init__(self):
-        pass
+        self.scheduler = None
+        self._downloaded = []
+        self.forks = ForkTree(BlockStore(), self.on_reorg)
+        # let immutable merkle/chunk responses be cached once deep enough
+        NetWorkManager().tip_height = lambda: BlockStore().height
 
     def init_header(self):
-        if BlockStore().height <= 0:
-            # NetWorkManager().init_header(self.init_header_callback)
-            NetWorkManager().add_message(GetHeaderFile([]), self.init_header_callback)
+        height = BlockStore().height
+        if self.need_download(height):
+            # chunks are connected while the headers file is streaming, the ones already
+            # in the store are not handed out again
+            NetWorkManager().download_headers(
+                self.connect_downloaded_chunk, self.download_tail,
+                skip_chunks=(height + 1) / BLOCK_INTERVAL,
+                callback=self.download_header_callback)
         else:
             NetWorkManager().add_message(headers_subscribe([]), callback=self.catch_up,
                                                   subscribe=self.receive_header)  # do not have id
 
+    def need_download(self, height):
+        """
+        :return: True for an empty store, an interrupted download of the headers file, or
+                 a downloaded file with complete chunks the store has not connected yet
+        """
+        if height <= 0:
+            return True
+        path = NetWorkManager().headers_path()
+        if os.path.exists(path + '.part'):
+            return True
+        return os.path.exists(path) and \
+            os.path.getsize(path) / (80 * BLOCK_INTERVAL) > (height + 1) / BLOCK_INTERVAL
+
+    def connect_raw_headers(self, height, data):
+        for idx in xrange(len(data) / 80):
+            BlockStore().connect_raw_header(data[idx * 80:idx * 80 + 80], height + idx)
+
+    def connect_downloaded_chunk(self, idx, data):
+        self._downloaded.append((idx, data))
+        if len(self._downloaded) >= self.verify_batch:
+            self.flush_downloaded()
+
+    def flush_downloaded(self):
+        if self._downloaded:
+            BlockStore().connect_chunks(self._downloaded[0][0],
+                                        [data for _, data in self._downloaded])
+            self._downloaded = []
+
+    def download_tail(self, height, data):
+        self.flush_downloaded()
+        self.connect_raw_headers(height, data)
+
+    def download_header_callback(self, future):
+        self.flush_downloaded()
+        try:
+            logger.debug('%d headers downloaded' % future.result())
+        except Exception as ex:
+            logger.exception(ex.message)
+        NetWorkManager().add_message(headers_subscribe([]), callback=self.catch_up,
+                                     subscribe=self.receive_header)  # do not have id
+
     def init_header_callback(self, future):
         try:
             result = future.result()
             block_cnt = len(result) / 80
             for idx in xrange(block_cnt / BLOCK_INTERVAL):
-                BlockStore().connect_chunk(idx, result[
-                                                idx * 80 * BLOCK_INTERVAL: idx * 80 * BLOCK_INTERVAL + 80 * BLOCK_INTERVAL])
+                self.connect_downloaded_chunk(idx, result[
+                                                   idx * 80 * BLOCK_INTERVAL: idx * 80 * BLOCK_INTERVAL + 80 * BLOCK_INTERVAL])
+            self.flush_downloaded()
             if block_cnt > block_cnt / BLOCK_INTERVAL * BLOCK_INTERVAL:
                 for idx in xrange(block_cnt - (block_cnt / BLOCK_INTERVAL * BLOCK_INTERVAL)):
                     height = block_cnt / BLOCK_INTERVAL * BLOCK_INTERVAL + idx
@@ -56,21 +114,101 @@ class BlockChain():
     def receive_header(self, params):
         for h in params:
             block = header_dict_to_block_item(h)
-            BlockStore().connect_block_item(block, h['block_height'])
+            self.forks.connect(block)
+
+    def on_reorg(self, fork_height, old, new):
+        """
+        the txs of the replaced blocks are verified again against the new ones, with
+        merkle branches from the server, not the cache
+        """
+        NetWorkManager().discard_cached(fork_height)
+        for tx_hash, height in TxStore().undo_verifications(fork_height + 1):
+            NetWorkManager().add_message(GetMerkle([tx_hash, height]), self.get_merkle_callback)
+
+    @gen.coroutine
+    def get_merkle_callback(self, msg_id, msg, merkle):
+        tx_hash = msg['params'][0]
+        block_root = self.get_block_root(merkle.get('block_height', msg['params'][1]))
+        if block_root is not None and TxStore().verify_merkle(tx_hash, merkle, block_root):
+            TxStore().verified_tx(tx_hash)
 
     @gen.coroutine
     def catch_up(self, msg_id, msg, result):
         logger.debug('catchup %s, %s, %s' % (msg_id, msg, result))
         height = result['block_height']
         local_height = BlockStore().height
-        if height > local_height:
-            from electrumq.message.all import GetHeader, GetChunk
-            next_height = min(height,
-                              local_height / BLOCK_INTERVAL * BLOCK_INTERVAL + BLOCK_INTERVAL - 1)
-            logger.debug('catch up trunc from %d to %d' % (
-                next_height / BLOCK_INTERVAL, height / BLOCK_INTERVAL))
-            for h in xrange(next_height / BLOCK_INTERVAL, height / BLOCK_INTERVAL + 1):
-                NetWorkManager().add_message(GetChunk([h]), self.get_trunc_callback)
+        if height <= local_height:
+            return
+        first, last = (local_height + 1) / BLOCK_INTERVAL, height / BLOCK_INTERVAL
+        if self.scheduler is not None and self.scheduler.is_running():
+            self.scheduler.extend(last)
+            return
+        logger.debug('catch up trunc from %d to %d' % (first, last))
+        self.scheduler = ChunkScheduler(first, last, self.fetch_chunk, self.commit_chunk,
+                                        window=self.catch_up_window)
+        try:
+            yield self.scheduler.run()
+        except ChunkException as ex:
+            logger.warning(ex.message)
+
+    def fetch_chunk(self, idx):
+        """
+        :return: future of the raw chunk, failed if it times out or is not hex
+        """
+        future = Future()
+
+        @gen.coroutine
+        def chunk_callback(msg_id, msg, data):
+            if future.done():
+                return
+            try:
+                future.set_result(data.decode('hex'))
+            except (AttributeError, TypeError) as ex:
+                future.set_exception(ex)
+
+        def expire():
+            if not future.done():
+                future.set_exception(gen.TimeoutError('chunk %d timed out' % idx))
+
+        admit = NetWorkManager().add_message(GetChunk([idx]), chunk_callback,
+                                             timeout=self.chunk_timeout)
+        if hasattr(admit, 'add_expire_callback'):
+            admit.add_expire_callback(expire)
+        return future
+
+    def commit_chunk(self, idx, data):
+        fork_height = self.chunk_fork_height(idx, data)
+        if fork_height is None:
+            if BlockStore().connect_chunk(idx, data):
+                return True
+            if len(data) < 80 or BlockItem(data).block_prev not in self.forks:
+                return False
+            # goes on with a branch of the fork tree
+            fork_height = idx * BLOCK_INTERVAL
+        # the chunk replaces headers near the tip, header by header through the fork tree
+        connected = False
+        for height in xrange(fork_height, idx * BLOCK_INTERVAL + len(data) / 80):
+            block = BlockItem(data, (height - idx * BLOCK_INTERVAL) * 80)
+            block.block_no = height
+            connected = self.forks.connect(block)
+        return connected
+
+    def chunk_fork_height(self, idx, data):
+        """
+        :return: the first height of the chunk where the stored header differs, None if
+                 the chunk agrees with the store
+        """
+        first = idx * BLOCK_INTERVAL
+        last = min(BlockStore().height, first + len(data) / 80 - 1)
+        stored = self.forks.main_hash(last) if last >= first else None
+        if stored is None or BlockItem(data, (last - first) * 80).block_hash == stored:
+            # headers commit to the ones before them, a same top means a same chunk
+            return None
+        height = last
+        while height > first and BlockItem(data, (height - 1 - first) * 80).block_hash \
+                != self.forks.main_hash(height - 1):
+            height -= 1
+        return height
 
     @gen.coroutine
     def get_header_callback(self, msg_id, msg, header):
@@ -87,36 +225,6 @@ class BlockChain():
 class MemBlockChain(BlockChain):
     __metaclass__ = Singleton
 
-    def init_header(self):
-        NetWorkManager().init_header(self.init_header_callback)
-
-    def init_header_callback(self, future):
-        try:
-            dt = datetime.now()
-            result = future.result()
-            cnt = len(result)
-            for idx in xrange(cnt / (80 * BLOCK_INTERVAL)):
-                print idx
-                BlockStore().connect_chunk(idx,
-                                           result[
-                                           idx * 80 * BLOCK_INTERVAL: idx * 80 * BLOCK_INTERVAL + 80 * BLOCK_INTERVAL])
-            if cnt > cnt / (80 * BLOCK_INTERVAL) * (80 * BLOCK_INTERVAL):
-                for idx in xrange(
-                                (cnt - (cnt / (80 * BLOCK_INTERVAL) * (80 * BLOCK_INTERVAL))) / 80):
-                    height = cnt / (80 * BLOCK_INTERVAL) * BLOCK_INTERVAL + idx
-                    header = BlockStore().deserialize_header(result[(cnt / (
-                        80 * BLOCK_INTERVAL) * BLOCK_INTERVAL + idx) * 80:(cnt / (
-                        80 * BLOCK_INTERVAL) * BLOCK_INTERVAL + idx) * 80 + 80])
-                    BlockStore().connect_header(header, height)
-                    print height
-            print datetime.now() - dt
-            from electrumq.message.all import headers_subscribe
-            NetWorkManager().add_message(headers_subscribe([]), callback=self.catch_up,
-                                                  subscribe=self.receive_header)  # do not have id
-        except Exception as ex:
-            print ex
-            traceback.print_exc()
-
     @gen.coroutine
     def receive_header(self, params):
         for h in params:
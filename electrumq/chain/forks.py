@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import time
+
+from electrumq.chain import logger
+from electrumq.db.verify import bits_to_target, header_work, CHUNK_HEADERS
+from electrumq.utils.parameter import Parameter
+
+__author__ = 'zhouqi'
+
+
+class ForkTree(object):
+    """
+    headers of the branches competing with the main chain near its tip, by block hash;
+    a branch with more work than the main chain since their fork replaces it, and the
+    main headers it replaces stay in the tree, so the chain can switch back
+    """
+    max_depth = 100  # deepest reorg followed, branches forking below are pruned
+    max_nodes = 2000
+
+    def __init__(self, store, on_reorg=None):
+        """
+        :param store: the BlockStore of the main chain
+        :param on_reorg: function(fork_height, old blocks, new blocks), after a switch
+        """
+        self.store = store
+        self.on_reorg = on_reorg
+        self._nodes = {}
+        self.reorg_cnt = 0
+        self.last_reorg = None  # (fork height, depth, seconds)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, block_hash):
+        return block_hash in self._nodes
+
+    def main_hash(self, height):
+        block = self.store.get_block(height)
+        return block.block_hash if block is not None else None
+
+    def connect(self, block):
+        """
+        :param block: BlockItem with block_no set
+        :return: True if block is on the main chain afterwards
+        """
+        height = block.block_no
+        tip = self.store.height
+        if height == tip + 1 and (tip < 0 or self.main_hash(tip) == block.block_prev):
+            self.store.connect_block_item(block, height)
+            self.prune()
+            return True
+        if height <= tip and self.main_hash(height) == block.block_hash:
+            return True
+        if height <= tip - self.max_depth:
+            logger.debug('drop header %d, %d below the tip' % (height, tip - height))
+            return False
+        parent = self.parent(block)
+        if parent is None or not self.is_valid(block, parent):
+            # todo store unchain
+            logger.debug('drop header %d, not connected' % height)
+            return False
+        self._nodes[block.block_hash] = block
+        branch = self.branch(block)
+        if branch is not None and self.work(branch) > self.main_work(branch[0].block_no, tip):
+            self.switch(branch)
+            self.prune()
+            return True
+        self.prune()
+        return False
+
+    def parent(self, block):
+        node = self._nodes.get(block.block_prev)
+        if node is not None and node.block_no == block.block_no - 1:
+            return node
+        if block.block_no > 0 and self.main_hash(block.block_no - 1) == block.block_prev:
+            return self.store.get_block(block.block_no - 1)
+        return None
+
+    def is_valid(self, block, parent):
+        """
+        proof of work against its own bits, which only change at a retarget; linkage only
+        on testnet, as for chunks
+        """
+        if Parameter().TESTNET or Parameter().NOLNET:
+            return True
+        if block.block_no % CHUNK_HEADERS != 0 and block.block_bits != parent.block_bits:
+            return False
+        return int(block.block_hash, 16) <= bits_to_target(block.block_bits)
+
+    def branch(self, block):
+        """
+        :return: the blocks from the fork with the main chain to block, None if it does
+                 not reach the main chain within max_depth
+        """
+        branch = [block]
+        while len(branch) <= self.max_depth:
+            last = branch[-1]
+            if self.main_hash(last.block_no - 1) == last.block_prev:
+                branch.reverse()
+                return branch
+            node = self._nodes.get(last.block_prev)
+            if node is None or node.block_no != last.block_no - 1:
+                return None
+            branch.append(node)
+        return None
+
+    def work(self, blocks):
+        return sum([header_work(block.block_bits) for block in blocks])
+
+    def main_work(self, first, last):
+        return self.work([self.store.get_block(height) for height in xrange(first, last + 1)])
+
+    def switch(self, branch):
+        begin = time.time()
+        fork_height = branch[0].block_no - 1
+        old = [self.store.get_block(height)
+               for height in xrange(fork_height + 1, self.store.height + 1)]
+        for block in old:
+            self._nodes[block.block_hash] = block
+        self.store.rollback(fork_height)
+        for block in branch:
+            block.is_main = 1
+            self._nodes.pop(block.block_hash, None)
+        self.store.save_block_item_batch(branch)
+        self.reorg_cnt += 1
+        self.last_reorg = (fork_height, len(old), time.time() - begin)
+        logger.info('reorg at %d, %d blocks replaced by %d' % (fork_height, len(old), len(branch)))
+        if self.on_reorg is not None:
+            self.on_reorg(fork_height, old, branch)
+
+    def prune(self):
+        """
+        drop the headers forking too deep below the tip, then the lowest ones over max_nodes
+        """
+        floor = self.store.height - self.max_depth
+        for block_hash in [h for h, b in self._nodes.iteritems() if b.block_no <= floor]:
+            del self._nodes[block_hash]
+        if len(self._nodes) > self.max_nodes:
+            lowest = sorted(self._nodes.itervalues(), key=lambda b: b.block_no)
+            for block in lowest[:len(self._nodes) - self.max_nodes]:
+                del self._nodes[block.block_hash]
@@ -1,4 +1,11 @@
 # -*- coding: utf-8 -*-
+from electrumq.utils.configuration import block_store
+
+if block_store == 'flat':
+    from electrumq.db.flat.block import BlockStore
+else:
+    from electrumq.db.sqlite.block import BlockStore
+
 __author__ = 'zhouqi'
 
 
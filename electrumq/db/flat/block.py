@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+import logging
+import mmap
+import os
+import threading
+import traceback
+
+from electrumq.db.sqlite import BlockItem
+from electrumq.db.sqlite.block import BlockStore as SqliteBlockStore
+from electrumq.utils import Singleton
+from electrumq.utils.configuration import flat_headers_path
+
+__author__ = 'zhouqi'
+
+HEADER_BYTES = 80
+
+logger = logging.getLogger('blockstore')
+
+
+class BlockStore(SqliteBlockStore):
+    """
+    headers of the main chain in one file, the header of height h at offset h * 80,
+    read through mmap; chunks are written as they come, and the tip is kept in memory
+    """
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        SqliteBlockStore.__init__(self)
+        self.path = None
+        self._file = None
+        self._map = None
+        self._count = 0
+        self._lock = threading.RLock()
+
+    def open(self, path=None):
+        """
+        :param path: flat_headers_path if None
+        """
+        with self._lock:
+            self.close()
+            self.path = path if path is not None else flat_headers_path
+            if not os.path.exists(self.path):
+                open(self.path, 'wb').close()
+            self._file = open(self.path, 'r+b', 0)  # unbuffered, the map sees every write
+            size = os.path.getsize(self.path)
+            if size % HEADER_BYTES != 0:
+                logger.warning('drop %d bytes of a partial header in %s', size % HEADER_BYTES, self.path)
+                size -= size % HEADER_BYTES
+                self._file.truncate(size)
+            self._count = size / HEADER_BYTES
+            self._remap()
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _ensure_open(self):
+        if self._file is None:
+            self.open()
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._count > 0:
+            self._map = mmap.mmap(self._file.fileno(), self._count * HEADER_BYTES,
+                                  access=mmap.ACCESS_READ)
+
+    @property
+    def height(self):
+        self._ensure_open()
+        return self._count - 1
+
+    def read_raw(self, block_no):
+        """
+        :return: the 80 bytes of the header at block_no, None if it is not stored
+        """
+        self._ensure_open()
+        if block_no < 0 or block_no >= self._count:
+            return None
+        offset = block_no * HEADER_BYTES
+        with self._lock:
+            if self._map is None or len(self._map) < offset + HEADER_BYTES:
+                self._remap()
+            return self._map[offset:offset + HEADER_BYTES]
+
+    def write_raw(self, block_no, data):
+        """
+        write the headers of data from block_no on, at most right after the tip
+        """
+        self._ensure_open()
+        with self._lock:
+            if block_no > self._count:
+                raise ValueError('gap between tip %d and %d' % (self._count - 1, block_no))
+            self._file.seek(block_no * HEADER_BYTES)
+            self._file.write(data)
+            # the map grows lazily, on the first read past it
+            self._count = max(self._count, block_no + len(data) / HEADER_BYTES)
+
+    def rollback(self, height):
+        with self._lock:
+            self._ensure_open()
+            if height + 1 >= self._count:
+                return
+            # no map may outlive the end of the file
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self._count = max(height + 1, 0)
+            self._file.truncate(self._count * HEADER_BYTES)
+            self._remap()
+
+    def save_block_item(self, block_item):
+        try:
+            self.write_raw(block_item.block_no, block_item.serialize())
+        except Exception as ex:
+            print ex.message
+            traceback.print_exc()
+
+    def save_block_item_batch(self, block_item_list):
+        block_item_list = sorted(block_item_list, key=lambda b: b.block_no)
+        if not block_item_list:
+            return
+        first = block_item_list[0].block_no
+        self.write_raw(first, ''.join([block.serialize() for block in block_item_list]))
+
+    def get_block(self, block_no):
+        raw = self.read_raw(block_no)
+        if raw is None:
+            return None
+        block = BlockItem(raw)
+        block.block_no = block_no
+        block.is_main = 1
+        return block
+
+    def get_block_root(self, block_no):
+        raw = self.read_raw(block_no)
+        if raw is None:
+            return None
+        return raw[36:68][::-1].encode('hex')
+
+    def save_chunk(self, idx, data, hashes):
+        # verified headers are stored as they came
+        self.write_raw(idx * 2016, data[:len(hashes) * HEADER_BYTES])
+        if len(hashes) == 2016:
+            logger.debug('save chunk to chain %d' % idx)
+        else:
+            logger.debug('save chunk to chain %d, but length is %d' % (idx, len(hashes)))
+
+    def connect_block_item(self, block_item, height=None):
+        block_item.block_no = height
+        block_item.is_main = 1
+        previous_height = block_item.block_no - 1
+        if previous_height >= 0 and self.height < previous_height:
+            # todo store unchain
+            logger.debug('save header to unchain %d' % height)
+            return
+        prev_block = self.get_block(previous_height) if previous_height >= 0 else None
+        if prev_block is not None and prev_block.block_hash != block_item.block_prev:
+            # todo store unchain
+            logger.debug('save header to unchain %d' % height)
+        self.save_block_item(block_item)
+        logger.debug('save header to chain %d' % height)
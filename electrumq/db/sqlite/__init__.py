@@ -21,7 +21,7 @@ def header_dict_to_block_item(header):
     block.block_ver = header['version']
     block.block_prev = header['prev_block_hash']
     block.block_root = header['merkle_root']
-    block.block_ver = header['timestamp']
+    block.block_time = header['timestamp']
     block.block_bits = header['bits']
     block.block_nonce = header['nonce']
     block.block_no = header['block_height']
@@ -1,27 +1,76 @@
 # -*- coding: utf-8 -*-
+import atexit
 import logging
+import multiprocessing
+import struct
+import threading
 import traceback
+from collections import OrderedDict
 
 from electrumq.db.sqlite import execute_one, BlockItem, Connection, header_dict_to_block_item
+from electrumq.db.verify import MAX_TARGET, CHUNK_HEADERS, HEADER_BYTES, check_chunk, \
+    next_context, retarget
 from electrumq.utils.parameter import Parameter
 from electrumq.utils import Singleton
 
 __author__ = 'zhouqi'
 
-MAX_TARGET = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
-
 logger = logging.getLogger('blockstore')
 
 
 class BlockStore():
     __metaclass__ = Singleton
+    # processes verifying chunks handed over together to connect_chunks, the number of
+    # cpus if None, 0 to verify them in this process; they only run once started by
+    # start_verify_pool, before the ioloop threads
+    verify_processes = None
+    _pool = None
+    cache_size = 4096  # recent main chain BlockItems kept in memory
 
     def __init__(self):
-        pass
+        self._lock = threading.RLock()
+        self._tip = None
+        self._blocks = OrderedDict()
+        self.hit_cnt = 0
+        self.miss_cnt = 0
 
     @property
     def height(self):
-        return execute_one('SELECT ifnull(max(block_no),-1) FROM blocks')[0]
+        tip = self._tip
+        if tip is None:
+            tip = self._tip = execute_one('SELECT ifnull(max(block_no),-1) FROM blocks')[0]
+        return tip
+
+    def _cache(self, block):
+        with self._lock:
+            self._blocks.pop(block.block_no, None)
+            self._blocks[block.block_no] = block
+            while len(self._blocks) > self.cache_size:
+                self._blocks.popitem(last=False)
+
+    def _saved(self, block_item_list):
+        """
+        keep the tip and the cached blocks in line with the rows just written
+        """
+        if not block_item_list:
+            return
+        with self._lock:
+            for block in block_item_list:
+                self._blocks.pop(block.block_no, None)
+            if self._tip is not None:
+                self._tip = max(self._tip, max([block.block_no for block in block_item_list]))
+            # the new tip is the prev of the next header
+            self._cache(max(block_item_list, key=lambda b: b.block_no))
+
+    def clear_cache(self):
+        with self._lock:
+            self._tip = None
+            self._blocks.clear()
+            self.hit_cnt = 0
+            self.miss_cnt = 0
+
+    def cache_stats(self):
+        return {'hits': self.hit_cnt, 'misses': self.miss_cnt, 'size': len(self._blocks)}
 
     def save_block_item(self, block_item):
         sql = 'INSERT or REPLACE INTO blocks(block_no, block_hash, block_root, block_ver, block_bits, block_nonce, block_time, block_prev, is_main) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);'
@@ -34,6 +83,7 @@ class BlockStore():
             except Exception as ex:
                 print ex.message
                 traceback.print_exc()
+        self._saved([block_item])
 
     def save_block_item_batch(self, block_item_list):
         sql = 'INSERT INTO blocks(block_no, block_hash, block_root, block_ver, block_bits, block_nonce, block_time, block_prev, is_main) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);'
@@ -53,8 +103,19 @@ class BlockStore():
                       block_item_list if block.block_hash not in exist_blocks]
             c.executemany(sql, params)
             conn.commit()
+        self._saved(block_item_list)
 
     def get_block(self, block_no):
+        """
+        :return: the BlockItem of the main chain at block_no, shared with the cache
+        """
+        with self._lock:
+            block = self._blocks.get(block_no)
+            if block is not None:
+                self._cache(block)
+                self.hit_cnt += 1
+                return block
+            self.miss_cnt += 1
         b = execute_one('SELECT block_no, block_hash, block_root, block_ver, block_bits'
                         '  , block_nonce, block_time, block_prev, is_main '
                         '  FROM blocks WHERE block_no=? AND blocks.is_main=1', (block_no,))
@@ -63,11 +124,23 @@ class BlockStore():
         block = BlockItem()
         block.block_no, block.block_hash, block.block_root, block.block_ver, block.block_bits \
             , block.block_nonce, block.block_time, block.block_prev, block.is_main = b
+        self._cache(block)
         return block
 
     def get_block_root(self, block_no):
-        return execute_one(
-            'SELECT block_root FROM blocks WHERE block_no=? AND blocks.is_main=1', (block_no,))[0]
+        block = self.get_block(block_no)
+        return block.block_root if block is not None else None
+
+    def rollback(self, height):
+        """
+        drop the headers above height, before a reorg saves the new branch
+        """
+        with Connection.gen_db() as conn:
+            conn.execute('DELETE FROM blocks WHERE block_no>?', (height,))
+        with self._lock:
+            for block_no in [h for h in self._blocks if h > height]:
+                del self._blocks[block_no]
+            self._tip = None
 
     def get_target(self, index, chain=None):
         if index == 0:
@@ -79,68 +152,109 @@ class BlockStore():
                 if h.block_no == index * 2016 - 1:
                     last = h
         assert last is not None
-        # bits to target
-        bits = last.block_bits
-        bitsN = (bits >> 24) & 0xff
-        assert 0x03 <= bitsN <= 0x1d, "First part of bits should be in [0x03, 0x1d]"
-        bitsBase = bits & 0xffffff
-        assert 0x8000 <= bitsBase <= 0x7fffff, "Second part of bits should be in [0x8000, 0x7fffff]"
-        target = bitsBase << (8 * (bitsN - 3))
-        # new target
-        nActualTimespan = last.block_time - first.block_time
-        nTargetTimespan = 14 * 24 * 60 * 60
-        nActualTimespan = max(nActualTimespan, nTargetTimespan / 4)
-        nActualTimespan = min(nActualTimespan, nTargetTimespan * 4)
-        new_target = min(MAX_TARGET, (target * nActualTimespan) / nTargetTimespan)
-        # convert new target to bits
-        c = ("%064x" % new_target)[2:]
-        while c[:2] == '00' and len(c) > 6:
-            c = c[2:]
-        bitsN, bitsBase = len(c) / 2, int('0x' + c[:6], 16)
-        if bitsBase >= 0x800000:
-            bitsN += 1
-            bitsBase >>= 8
-        new_bits = bitsN << 24 | bitsBase
-        return new_bits, bitsBase << (8 * (bitsN - 3))
-
-    def verify_header(self, header, prev_header, bits, target):
-        if prev_header is None:
-            prev_hash = '0' * 64
-        else:
-            prev_hash = prev_header.block_hash
-        if prev_hash != header.block_prev:
-            logger.warning("prev hash mismatch: %s vs %s" % (prev_hash, header.block_prev))
-            return False
-        if Parameter().TESTNET or Parameter().NOLNET: return True
-        if bits != header.block_bits:
-            logger.warning("bits mismatch: %s vs %s" % (bits, header.block_bits))
-            return False
-        _hash = header.block_hash
-        if int('0x' + _hash, 16) > target:
-            logger.warning(
-                "insufficient proof of work: %s vs target %s" % (int('0x' + _hash, 16), target))
-            return False
-        return True
+        return retarget(first.block_time, last.block_time, last.block_bits)
 
     def connect_chunk(self, idx, data):
+        """
+        :return: True if the chunk is saved to chain
+        """
+        return self.connect_chunks(idx, [data]) == 1
+
+    def connect_chunks(self, first, chunks):
+        """
+        verify consecutive chunks, in the process pool when there are several, and
+        save them in order until one fails
+        :return: number of chunks saved to chain
+        """
+        cnt = 0
         try:
-            previous_height = idx * 2016 - 1
+            previous_height = first * CHUNK_HEADERS - 1
             if previous_height > 0 \
                     and (self.height < previous_height or self.get_block(previous_height) is None):
                 # todo store unchain
-                logger.debug('save chunk to unchain %d' % idx)
-            else:
-                result = self.verify_chunk(idx, data)
-                if len(result) == 2016:
-                    self.save_block_item_batch(result)
-                    logger.debug('save chunk to chain %d' % idx)
-                else:
-                    self.save_block_item_batch(result)
-                    # todo store unchain
-                    logger.debug('save chunk to chain %d, but length is %d' % (idx, len(result)))
+                logger.debug('save chunk to unchain %d' % first)
+                return 0
+            # the context of a chunk comes from the one before, so all are independent
+            context = self.chunk_context(first)
+            args = []
+            for data in chunks:
+                args.append((data,) + context)
+                if len(data) < CHUNK_HEADERS * HEADER_BYTES:
+                    break
+                context = next_context(data, context[1])
+            pool = self.verify_pool() if len(args) > 1 else None
+            results = pool.map(check_chunk, args) if pool is not None else map(check_chunk, args)
+            for idx, (data, hashes) in enumerate(zip(chunks, results), first):
+                if hashes is None:
+                    logger.warning('chunk %d failed verification' % idx)
+                    break
+                self.save_chunk(idx, data, hashes)
+                cnt += 1
         except BaseException as ex:
             print ex
             traceback.print_exc()
+        return cnt
+
+    def chunk_context(self, index):
+        """
+        :return: (prev hash, bits, target) of the chunk index, bits and target are None
+                 on testnet, where only the linkage is checked
+        """
+        if index == 0:
+            prev_hash = '\0' * 32
+        else:
+            prev_hash = self.get_block(index * CHUNK_HEADERS - 1).block_hash.decode('hex')[::-1]
+        if Parameter().TESTNET or Parameter().NOLNET:
+            return prev_hash, None, None
+        bits, target = self.get_target(index)
+        return prev_hash, bits, target
+
+    def start_verify_pool(self):
+        """
+        fork the verify processes, while the caller has no other thread to copy; the
+        pool is closed by stop_verify_pool, or at exit
+        """
+        if self.verify_processes == 0 or self._pool is not None:
+            return
+        self._pool = multiprocessing.Pool(self.verify_processes)
+        atexit.register(self.stop_verify_pool)
+
+    def verify_pool(self):
+        """
+        :return: the pool of start_verify_pool, None to verify in this process
+        """
+        return self._pool
+
+    def stop_verify_pool(self):
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def save_chunk(self, idx, data, hashes):
+        result = self.chunk_items(idx, data, hashes)
+        self.save_block_item_batch(result)
+        if len(result) == CHUNK_HEADERS:
+            logger.debug('save chunk to chain %d' % idx)
+        else:
+            logger.debug('save chunk to chain %d, but length is %d' % (idx, len(result)))
+
+    def chunk_items(self, index, data, hashes):
+        """
+        BlockItems of a verified chunk, with the hashes already computed
+        """
+        result = []
+        for i, block_hash in enumerate(hashes):
+            block = BlockItem()
+            block.block_ver, block_prev, block_root, block.block_time, block.block_bits, \
+                block.block_nonce = struct.unpack_from('<I32s32sIII', data, i * HEADER_BYTES)
+            block.block_prev = block_prev[::-1].encode('hex')
+            block.block_root = block_root[::-1].encode('hex')
+            block.block_hash = block_hash[::-1].encode('hex')
+            block.block_no = index * CHUNK_HEADERS + i
+            block.is_main = 1
+            result.append(block)
+        return result
 
     def connect_raw_header(self, raw, height):
         block = BlockItem(raw)
@@ -160,40 +274,15 @@ class BlockStore():
         block_item.block_no = height
         block_item.is_main = 1
         previous_height = block_item.block_no - 1
-        if self.height < previous_height or self.get_block(previous_height) is None:
+        prev_block = self.get_block(previous_height) if self.height >= previous_height else None
+        if prev_block is None:
             # todo store unchain
             logger.debug('save header to unchain %d' % height)
         else:
-            prev_block = BlockStore().get_block(previous_height)
-            #
-            # # Missing header, request it
-            if not prev_block:
-                # todo store unchain
-                logger.debug('save header to unchain %d' % height)
-            #
             # # Does it connect to my chain?
             prev_hash = prev_block.block_hash
             if prev_hash != block_item.block_prev:
                 # todo store unchain
                 logger.debug('save header to unchain %d' % height)
-            BlockStore().save_block_item(block_item)
+            self.save_block_item(block_item)
             logger.debug('save header to chain %d' % height)
-
-    def verify_chunk(self, index, data):
-        num = len(data) / 80
-        # prev_header = None
-        # if index != 0:
-        #     prev_header = self.get_block(index * 2016 - 1)
-        # bits, target = self.get_target(index)
-        result = []
-        for i in range(num):
-            raw_header = data[i * 80:(i + 1) * 80]
-            block = BlockItem(raw_header)
-            block.block_no = index * 2016 + i
-            verified = True  # self.verify_header(block, prev_header, bits, target)
-            if not verified:
-                return []
-            block.is_main = 1
-            prev_header = block
-            result.append(block)
-        return result
@@ -23,10 +23,14 @@ class TxStore():
     def add(self, address, tx, block_height):
         with Connection.gen_db() as conn:
             c = conn.cursor()
-            if c.execute('SELECT count(0) FROM txs WHERE tx_hash=?', (tx,)).fetchone()[0] == 0:
+            row = c.execute('SELECT block_no FROM txs WHERE tx_hash=?', (tx,)).fetchone()
+            if row is None:
                 block_time = None  # c.execute('select block_time from blocks WHERE block_no=?', (block_height,)).fetchone()[0]
                 c.execute('INSERT INTO txs(tx_hash, block_no, tx_time, source) VALUES (?, ?, ?, ?)',
                           (tx, block_height, block_time, 0))
+            elif row[0] != block_height:
+                # mined or reorganized since seen, verify again
+                c.execute('UPDATE txs SET block_no=?, source=0 WHERE tx_hash=?', (block_height, tx))
             if c.execute('SELECT count(0) FROM addresses_txs WHERE tx_hash=? AND address=?',
                          (tx, address)).fetchone()[0] == 0:
                 c.execute('INSERT INTO addresses_txs(tx_hash, address) VALUES (?, ?)',
@@ -86,12 +90,16 @@ class TxStore():
         return h[::-1].encode('hex')
 
     def undo_verifications(self, height):
-        # todo:
-        pass
-        # tx_hashes = self.wallet.undo_verifications(height)
-        # for tx_hash in tx_hashes:
-        #     self.print_error("redoing", tx_hash)
-        #     self.merkle_roots.pop(tx_hash, None)
+        """
+        the txs verified in blocks from height on are to be verified again, after a reorg
+        :return: [(tx_hash, block_no)] of those txs
+        """
+        with Connection.gen_db() as conn:
+            c = conn.cursor()
+            txs = c.execute('SELECT tx_hash, block_no FROM txs WHERE block_no>=? AND source=1',
+                            (height,)).fetchall()
+            c.execute('UPDATE txs SET source=0 WHERE block_no>=? AND source=1', (height,))
+        return txs
 
     def verified_tx(self, tx):
         with Connection.gen_db() as conn:
@@ -138,6 +146,16 @@ class TxStore():
             'SELECT ifnull(max(a.block_no),-1) FROM txs a, addresses_txs b WHERE b.address=? AND a.tx_hash=b.tx_hash',
             (address,))[0]
 
+    def get_address_history(self, address):
+        """
+        :return: {tx_hash: (block_no, verified, fetched)} of the txs known for address
+        """
+        rows = execute_all(
+            'SELECT b.tx_hash, b.block_no, b.source, b.tx_ver IS NOT NULL'
+            '  FROM addresses_txs a, txs b'
+            '  WHERE a.address=? AND a.tx_hash=b.tx_hash', (address,))
+        return {row[0]: (row[1], row[2] == 1, row[3] == 1) for row in rows}
+
     def get_txs(self, address):
         return execute_all(
             "SELECT b.tx_hash, ifnull(b.tx_time, strftime('%s', 'now')) tx_time FROM addresses_txs a,txs b WHERE a.address=? AND a.tx_hash=b.tx_hash",
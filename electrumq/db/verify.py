@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+header verification on raw 80-byte headers: hashes straight from the chunk buffer
+with hashlib, targets compared as 32-byte big-endian strings, which orders them
+like the integers; module level functions so a process pool can run them
+"""
+import hashlib
+import struct
+
+__author__ = 'zhouqi'
+
+HEADER_BYTES = 80
+CHUNK_HEADERS = 2016
+MAX_TARGET = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
+TARGET_TIMESPAN = 14 * 24 * 60 * 60
+
+
+def header_hash(raw):
+    """
+    :return: double sha256 of the header, in the byte order of the prev hash field
+    """
+    return hashlib.sha256(hashlib.sha256(raw).digest()).digest()
+
+
+def bits_to_target(bits):
+    bits_n = (bits >> 24) & 0xff
+    assert 0x03 <= bits_n <= 0x1d, "First part of bits should be in [0x03, 0x1d]"
+    bits_base = bits & 0xffffff
+    assert 0x8000 <= bits_base <= 0x7fffff, "Second part of bits should be in [0x8000, 0x7fffff]"
+    return bits_base << (8 * (bits_n - 3))
+
+
+def target_to_bits(target):
+    c = ('%064x' % target)[2:]
+    while c[:2] == '00' and len(c) > 6:
+        c = c[2:]
+    bits_n, bits_base = len(c) / 2, int('0x' + c[:6], 16)
+    if bits_base >= 0x800000:
+        bits_n += 1
+        bits_base >>= 8
+    return bits_n << 24 | bits_base
+
+
+def header_work(bits):
+    """
+    expected number of hashes for a header of bits
+    """
+    return (1 << 256) / (bits_to_target(bits) + 1)
+
+
+def retarget(first_time, last_time, last_bits):
+    """
+    bits and target of the next 2016-blocks period
+    """
+    timespan = last_time - first_time
+    timespan = max(timespan, TARGET_TIMESPAN / 4)
+    timespan = min(timespan, TARGET_TIMESPAN * 4)
+    new_target = min(MAX_TARGET, (bits_to_target(last_bits) * timespan) / TARGET_TIMESPAN)
+    new_bits = target_to_bits(new_target)
+    return new_bits, bits_to_target(new_bits)
+
+
+def next_context(data, bits=None):
+    """
+    prev hash, bits and target for the chunk after data, a complete chunk
+    :param bits: None to skip bits and proof of work
+    """
+    prev_hash = header_hash(data[-HEADER_BYTES:])
+    if bits is None:
+        return prev_hash, None, None
+    first_time = struct.unpack_from('<I', data, 68)[0]
+    last_time, last_bits = struct.unpack_from('<II', data, len(data) - HEADER_BYTES + 68)
+    bits, target = retarget(first_time, last_time, last_bits)
+    return prev_hash, bits, target
+
+
+def check_chunk(args):
+    """
+    :param args: (data, prev_hash, bits, target), bits None to check linkage only
+    :return: hashes of the headers in data, None if one of them is invalid
+    """
+    data, prev_hash, bits, target = args
+    if len(data) % HEADER_BYTES != 0:
+        return None
+    target_bytes = None
+    if bits is not None:
+        target_bytes = ('%064x' % target).decode('hex')
+        bits_bytes = struct.pack('<I', bits)
+    hashes = []
+    sha256 = hashlib.sha256
+    for offset in xrange(0, len(data), HEADER_BYTES):
+        raw = data[offset:offset + HEADER_BYTES]
+        if raw[4:36] != prev_hash:
+            return None
+        prev_hash = sha256(sha256(raw).digest()).digest()
+        if target_bytes is not None:
+            if raw[72:76] != bits_bytes or prev_hash[::-1] > target_bytes:
+                return None
+        hashes.append(prev_hash)
+    return hashes
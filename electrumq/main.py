@@ -5,6 +5,7 @@ import time
 from tornado import gen
 
 from electrumq.chain.chain import BlockChain
+from electrumq.db.block import BlockStore
 from electrumq.db.sqlite import init
 from electrumq.db.sqlite.tx import TxStore
 from electrumq.message.all import *
@@ -35,6 +36,7 @@ def test_simple_wallet():
     logging.config.fileConfig('logging.conf')
     # drop()
     init()
+    BlockStore().start_verify_pool()  # forks, so before the ioloop threads
     network = NetWorkManager()
     network.start_ioloop()
     network.start_client()
@@ -106,6 +108,7 @@ def test_cold_hot_wallet():
     logging.config.fileConfig('logging.conf')
     # drop()
     init()
+    BlockStore().start_verify_pool()  # forks, so before the ioloop threads
     network = NetWorkManager()
     network.start_ioloop()
     network.start_client()
@@ -147,6 +150,7 @@ def test_hd_wallet():
     logging.config.fileConfig('logging.conf')
     # drop()
     init()
+    BlockStore().start_verify_pool()  # forks, so before the ioloop threads
     network = NetWorkManager()
     network.start_ioloop()
     network.start_client()
@@ -178,6 +182,7 @@ def test_hd_cold_hot_wallet():
     logging.config.fileConfig('logging.conf')
     # drop()
     init()
+    BlockStore().start_verify_pool()  # forks, so before the ioloop threads
     network = NetWorkManager()
     network.start_ioloop()
     network.start_client()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import json
+import sqlite3
+import threading
+
+from electrumq.db.verify import CHUNK_HEADERS
+from electrumq.net import logger
+
+__author__ = 'zhouqi'
+
+cache_sql = '''
+CREATE TABLE IF NOT EXISTS responses
+    (cache_key TEXT NOT NULL PRIMARY KEY
+    , result TEXT NOT NULL
+    , size INTEGER NOT NULL
+    , access INTEGER NOT NULL);
+'''
+index_cache_access_sql = 'CREATE INDEX IF NOT EXISTS idx_responses_access ON responses (access);'
+
+
+class ResponseCache(object):
+    """
+    on-disk cache of electrum responses which never change:
+    1. blockchain.transaction.get
+    2. blockchain.transaction.get_merkle, once the tx has `confirmations`
+    3. blockchain.block.get_chunk, once the whole 2016-blocks period has `confirmations`
+    least recently used entries are evicted when the cache grows over max_bytes, the
+    access order of hits is kept in memory and written on put or every flush_access hits
+    """
+    max_bytes = 64 * 1024 * 1024
+    confirmations = 6
+    flush_access = 100
+
+    def __init__(self, path, max_bytes=None):
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(cache_sql)
+        self.conn.execute(index_cache_access_sql)
+        self.conn.commit()
+        self.size, self.access = self.conn.execute(
+            'SELECT ifnull(sum(size),0), ifnull(max(access),0) FROM responses').fetchone()
+        self.hit_cnt = 0
+        self.miss_cnt = 0
+        self._touched = {}  # cache_key -> access of hits not written yet
+
+    def key(self, message):
+        return message['method'] + json.dumps(message['params'])
+
+    def is_cacheable(self, message, tip_height=None):
+        method, params = message['method'], message['params']
+        if method == 'blockchain.transaction.get':
+            return True
+        if tip_height is None:
+            return False
+        if method == 'blockchain.transaction.get_merkle':
+            return 0 < params[1] <= tip_height - self.confirmations + 1
+        if method == 'blockchain.block.get_chunk':
+            return (params[0] + 1) * CHUNK_HEADERS - 1 <= tip_height - self.confirmations + 1
+        return False
+
+    def get(self, message):
+        key = self.key(message)
+        with self._lock:
+            row = self.conn.execute('SELECT result FROM responses WHERE cache_key=?',
+                                    (key,)).fetchone()
+            if row is None:
+                self.miss_cnt += 1
+                return None
+            self.hit_cnt += 1
+            self.access += 1
+            self._touched[key] = self.access
+            if len(self._touched) >= self.flush_access:
+                self._flush()
+                self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, message, result):
+        if result is None:
+            return
+        key = self.key(message)
+        value = json.dumps(result)
+        with self._lock:
+            old = self.conn.execute('SELECT size FROM responses WHERE cache_key=?',
+                                    (key,)).fetchone()
+            if old is not None:
+                self.size -= old[0]
+            self.access += 1
+            self._touched.pop(key, None)
+            self._flush()
+            self.conn.execute(
+                'INSERT OR REPLACE INTO responses(cache_key, result, size, access) VALUES (?, ?, ?, ?)',
+                (key, value, len(value), self.access))
+            self.size += len(value)
+            self._evict()
+            self.conn.commit()
+
+    def _flush(self):
+        if self._touched:
+            self.conn.executemany('UPDATE responses SET access=? WHERE cache_key=?',
+                                  [(access, key) for key, access in self._touched.iteritems()])
+            self._touched = {}
+
+    def _evict(self):
+        while self.size > self.max_bytes:
+            rows = self.conn.execute(
+                'SELECT cache_key, size FROM responses ORDER BY access LIMIT 100').fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.conn.execute('DELETE FROM responses WHERE cache_key=?', (key,))
+                self.size -= size
+                logger.debug('evict %s', key)
+                if self.size <= self.max_bytes:
+                    break
+
+    def discard_from(self, height):
+        """
+        drop the merkle branches and chunks of blocks at or above height, which a reorg
+        may have replaced
+        :return: number of entries dropped
+        """
+        cnt = 0
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT cache_key, size FROM responses WHERE cache_key LIKE 'blockchain.transaction.get_merkle%' "
+                "OR cache_key LIKE 'blockchain.block.get_chunk%'").fetchall()
+            for key, size in rows:
+                method, params = key.split('[', 1)
+                params = json.loads('[' + params)
+                if method == 'blockchain.transaction.get_merkle' and params[1] >= height \
+                        or method == 'blockchain.block.get_chunk' \
+                        and (params[0] + 1) * CHUNK_HEADERS - 1 >= height:
+                    cnt += 1
+                    self.conn.execute('DELETE FROM responses WHERE cache_key=?', (key,))
+                    self._touched.pop(key, None)
+                    self.size -= size
+            self.conn.commit()
+        logger.debug('discard %d cached responses from %d', cnt, height)
+        return cnt
+
+    def clear(self):
+        with self._lock:
+            self.conn.execute('DELETE FROM responses')
+            self.conn.commit()
+            self.size = 0
+            self._touched = {}
+
+    def stats(self):
+        return {'hits': self.hit_cnt, 'misses': self.miss_cnt, 'size': self.size}
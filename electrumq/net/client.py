@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
+import copy
 import json
 import logging
+import random
 import sys
+import time
 from collections import deque
 
 from tornado import gen
@@ -11,10 +14,58 @@ from tornado.iostream import StreamClosedError
 from tornado.tcpclient import TCPClient
 
 from electrumq.net import logger
+from electrumq.net.framing import FrameBuffer, FrameParser, encoder, FRAME_HEAD_ID, \
+    FRAME_TAIL_ID
+from electrumq.net.lanes import MessageLanes
 
 __author__ = 'zhouqi'
 
 
+class RequestFuture(Future):
+    """
+    resolved with the message id once the request is written, or with None if it
+    expires before, cancel() drops the request and its callback, expire callbacks
+    run when it times out without retry left, is cancelled or is answered with an
+    error, kept in error; a request answered from the cache has no client
+    """
+
+    def __init__(self, client, msg_id):
+        super(RequestFuture, self).__init__()
+        self.client = client
+        self.msg_id = msg_id
+        self.expired = False
+        self.error = None
+        self._cancelled = False
+        self._expire_callbacks = []
+
+    def cancel(self):
+        if self.expired or self.client is None:
+            return False
+        self._cancelled = self.client.cancel(self.msg_id)
+        return self._cancelled
+
+    def cancelled(self):
+        return self._cancelled
+
+    def add_expire_callback(self, fn):
+        if self.expired:
+            fn()
+        else:
+            self._expire_callbacks.append(fn)
+
+    def expire(self):
+        self.expired = True
+        if not self.done():
+            # producers waiting for a slot of the in-flight window go on
+            self.set_result(None)
+        callbacks, self._expire_callbacks = self._expire_callbacks, []
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception as ex:
+                logger.exception(ex.message)
+
+
 class RPCClient:
     ip, port = '176.9.108.141', 50001
     stream = None
@@ -26,12 +77,65 @@ class RPCClient:
     _subscribe_list = None
     _callback_dict = None
     _subscribe_dict = None
+    _future_dict = None
+    _deadline_dict = None
+    _subscriptions = None
     ioloop = None
     connect_future = None
     connect_timeout = 0.5
     connect_retry_time = 0
     logger = logging.getLogger('rpcclient')
 
+    # wakeup: flush on add_message and dispatch on parse_response,
+    # otherwise poll send_all/callback/subscribe every second
+    wakeup = True
+    _flush_scheduled = False
+    _periodic_started = False
+    dispatch_budget = 0.05  # second, longest time one drain may hold the ioloop
+    drain_stats = None
+
+    # json-rpc batch: pack up to batch_size messages (or batch_max_bytes) in
+    # one array frame, 0 means one frame per message
+    batch_size = 0
+    batch_max_bytes = 64 * 1024
+    max_write_bytes = 256 * 1024  # a larger flush is split into several writes
+    max_frame_bytes = 8 * 1024 * 1024  # longer replies are dropped
+    parser = None
+    bytes_received = 0
+
+    # weight of interactive/broadcast/sync/bulk lanes in send_all, LANE_WEIGHTS if None
+    lane_weights = None
+
+    # most ids waiting for reply at the same time, 0 means unlimited;
+    # other messages stay in _message_list until replies arrive
+    max_in_flight = 0
+
+    # reconnect after the stream is lost, waiting reconnect_base * 2 ** attempt
+    # seconds (at most reconnect_max) with jitter, then replay outstanding
+    # requests and subscriptions on the new connection
+    auto_reconnect = True
+    reconnect_base = 0.5
+    reconnect_max = 60
+    reconnect_cnt = 0
+    _reconnect_attempt = 0
+    _closed = False
+    handshake = None  # message sent first on every connection, like server.version
+
+    # second a request may wait for its reply, 0 means forever; expired
+    # requests are swept every sweep_interval and retried `retries` times,
+    # through retry_handler(client, message, callback, timeout, retries, future)
+    # if set, so the manager can move them to another server
+    request_timeout = 0
+    sweep_interval = 1
+    retry_handler = None
+    _sweep_started = False
+    _periodics = None
+    timeout_stats = None
+
+    # MetricsRegistry counting requests, errors, latency and bytes of this client
+    metrics = None
+    _sent_at = None
+
     timeout = None
 
     def __init__(self, ioloop, ip=None, port=None):
@@ -41,37 +145,61 @@ class RPCClient:
             self.port = port
         self.ioloop = ioloop
         self.sequence = xrange(sys.maxint).__iter__()
-        self._message_list = deque()
+        self._message_list = MessageLanes(self.lane_weights)
         self._sent_dict = {}
         self._response_list = deque()
         self._subscribe_list = deque()
         self._callback_dict = {}
         self._subscribe_dict = {}
+        self._future_dict = {}
+        self._deadline_dict = {}
+        self.timeout_stats = {}
+        self._subscriptions = {}
+        self._sent_at = {}
+        self._periodics = []
+        self.drain_stats = {'response': [0, 0.0], 'subscribe': [0, 0.0]}
 
     def __del__(self):
         if self.stream is not None:
             self.stream.close()
 
+    def close(self):
+        self._closed = True
+        self.is_connected = False
+        for periodic in self._periodics:
+            self.ioloop.stop_periodic(periodic)
+        self._periodics = []
+        self._sweep_started = self._periodic_started = False
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
     def connect_with_future(self):
         self.connect_future = Future()
-        self.ioloop.add_future(TCPClient().connect(self.ip, self.port), self.connect_callback)
+        # connect on the client's own ioloop thread, so the stream is bound to it
+        self.ioloop.add_callback(self.start_connect)
         self.set_timout(timeout=3)
         return self.connect_future
 
+    def start_connect(self):
+        self.ioloop.add_future(TCPClient().connect(self.ip, self.port), self.connect_callback)
+
     def connect_callback(self, future):
         if not future.done():
             return
         if future.exception() is None:
             self.stream = future.result()
+            self.stream.set_close_callback(self.on_close)
             self.is_connected = True
+            self._reconnect_attempt = 0
             logger.debug('client connected by callback')
+            if self.handshake is not None:
+                self._push_front(self.handshake)
             try:
-                self.stream.read_until(b"\n", callback=self.parse_response)
+                self.start_read()
             except Exception as ex:
                 logger.debug(ex.message)
-            self.ioloop.add_periodic(self.send_all)
-            self.ioloop.add_periodic(self.callback)
-            self.ioloop.add_periodic(self.subscribe)
+            self.start_dispatch()
             if self.connect_future._callbacks is None:
                 self.connect_future._callbacks = []
             self.connect_future.set_result(True)
@@ -85,6 +213,61 @@ class RPCClient:
             else:
                 self.connect_future.set_result(False)
 
+    def on_close(self):
+        self.is_connected = False
+        self.stream = None
+        if self._closed or not self.auto_reconnect:
+            return
+        logger.debug('connection to %s:%s lost', self.ip, self.port)
+        self.requeue()
+        self.schedule_reconnect()
+
+    def requeue(self):
+        """
+        put the requests without reply and the subscriptions back to the front
+        of _message_list, they are sent again once connected
+        """
+        pending = set()
+        for msg_id in sorted(self._sent_dict.keys(), reverse=True):
+            message = self._sent_dict.pop(msg_id)
+            if self.handshake is not None and message['method'] == self.handshake['method']:
+                self._callback_dict.pop(msg_id, None)
+                continue
+            message['id'] = msg_id
+            self._message_list.appendleft(message)
+        self._sent_at.clear()
+        for message in self._message_list:
+            pending.add(self.subscription_key(message))
+        for key, (message, callback) in self._subscriptions.items():
+            if key not in pending:
+                self._push_front(message, callback)
+
+    def reconnect_delay(self):
+        """
+        second before the next connect attempt, doubled by every failed one
+        """
+        delay = min(self.reconnect_max, self.reconnect_base * 2 ** self._reconnect_attempt)
+        delay *= 0.5 + random.random() / 2
+        self._reconnect_attempt += 1
+        return delay
+
+    def schedule_reconnect(self):
+        delay = self.reconnect_delay()
+        logger.debug('reconnect to %s:%s in %.2fs', self.ip, self.port, delay)
+        self.ioloop.add_timeout(self.ioloop.time() + delay, self.reconnect)
+
+    @gen.coroutine
+    def reconnect(self):
+        if self._closed or self.is_connected:
+            return
+        connected = yield self.connect_with_future()
+        if connected:
+            self.reconnect_cnt += 1
+            if self.metrics is not None:
+                self.metrics.reconnect(self.address())
+        elif not self._closed:
+            self.schedule_reconnect()
+
     def set_timout(self, timeout):
         self.timeout = self.ioloop.add_timeout(self.ioloop.time() + timeout,
                                                self.on_timeout)
@@ -104,102 +287,368 @@ class RPCClient:
         try:
             self.stream = yield TCPClient().connect(self.ip, self.port)
             self.is_connected = True
-            self.stream.read_until(b"\n", callback=self.parse_response)
+            self.start_read()
             logger.debug('client connected')
-            self.ioloop.add_periodic(self.send_all)
-            self.ioloop.add_periodic(self.callback)
-            self.ioloop.add_periodic(self.subscribe)
+            self.start_dispatch()
         except StreamClosedError as ex:
             self.is_connected = False
         except Exception as ex:
             print ex
             self.is_connected = False
 
+    def start_dispatch(self):
+        if not self._sweep_started:
+            self._sweep_started = True
+            self._periodics.append(
+                self.ioloop.add_periodic(self.sweep, self.sweep_interval * 1000))
+        if self.wakeup:
+            self.wakeup_send()
+        elif not self._periodic_started:
+            self._periodic_started = True
+            for func in (self.send_all, self.callback, self.subscribe):
+                self._periodics.append(self.ioloop.add_periodic(func))
+
+    def wakeup_send(self):
+        """
+        schedule one flush on the ioloop, safe to call from any thread
+        """
+        if self.wakeup and self.is_connected and not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.ioloop.add_callback(self.send_all)
+
     @gen.coroutine
     def send_all(self):
+        self._flush_scheduled = False
         if self.is_connected:
             if len(self._message_list) > 0:
                 self.logger.debug('begin to send all')
-                content = ''
-                while len(self._message_list) > 0:
+                frames = FrameBuffer(self.max_write_bytes)
+                batch = []
+                batch_len = 0
+                now = time.time()
+                while len(self._message_list) > 0 and self.has_capacity():
                     msg = self._message_list.popleft()
-                    content += json.dumps(msg).replace(' ', '') + '\n'
-                    self._sent_dict[msg.pop('id')] = msg
-                self.logger.debug('send:' + content)
-                self.stream.write(content)
+                    if self.batch_size > 0:
+                        msg['jsonrpc'] = '2.0'
+                        data = encoder.encode(msg)
+                        msg.pop('jsonrpc')
+                        batch.append(data)
+                        batch_len += len(data) + 1
+                        if len(batch) >= self.batch_size or batch_len >= self.batch_max_bytes:
+                            frames.append_batch(batch)
+                            batch = []
+                            batch_len = 0
+                    else:
+                        frames.append(msg)
+                    msg_id = msg.pop('id')
+                    self._sent_dict[msg_id] = msg
+                    if self.metrics is not None:
+                        self._sent_at[msg_id] = now
+                        self.metrics.request(self.address(), msg['method'])
+                    future = self._future_dict.get(msg_id)
+                    if future is not None and not future.done():
+                        future.set_result(msg_id)
+                    if frames.is_full():
+                        self.write(frames.take())
+                if len(batch) > 0:
+                    frames.append_batch(batch)
+                if len(frames) > 0:
+                    self.write(frames.take())
+
+    def write(self, content):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('send:' + content)
+        try:
+            self.stream.write(content)
+            if self.metrics is not None:
+                self.metrics.bytes_out(self.address(), len(content))
+        except StreamClosedError:
+            # on_close puts the messages back to _message_list
+            self.logger.debug('stream closed when sending')
+
+    def has_capacity(self):
+        return self.max_in_flight <= 0 or len(self._sent_dict) < self.max_in_flight
 
     @gen.coroutine
     def callback(self):
-        if len(self._response_list) > 0:
-            self.logger.debug('begin to callback all')
-            msg_id, msg, result = self._response_list.popleft()
-            self.logger.debug(str((msg_id, msg, result)))
-            if msg_id in self._callback_dict:
-                func = self._callback_dict.pop(msg_id)
+        self._drain(self._response_list, self.dispatch_response, 'response', self.callback)
+
+    @gen.coroutine
+    def subscribe(self):
+        self._drain(self._subscribe_list, self.dispatch_subscribe, 'subscribe', self.subscribe)
+
+    def _drain(self, queue, dispatch, name, resume):
+        """
+        dispatch all pending items of queue in one pass, but yield the ioloop
+        once dispatch_budget is spent and resume on the next iteration
+        """
+        if len(queue) == 0:
+            return
+        self.logger.debug('begin to %s all' % name)
+        begin = time.time()
+        cnt = 0
+        while len(queue) > 0:
+            dispatch(*queue.popleft())
+            cnt += 1
+            if time.time() - begin > self.dispatch_budget:
+                break
+        stats = self.drain_stats[name]
+        stats[0] += cnt
+        stats[1] += time.time() - begin
+        if len(queue) > 0:
+            self.ioloop.add_callback(resume)
+
+    def dispatch_response(self, msg_id, msg, result):
+        self.logger.debug(str((msg_id, msg, result)))
+        if msg_id in self._callback_dict:
+            func = self._callback_dict.pop(msg_id)
+            try:
+                feature = func(msg_id, msg, result)
+                if not is_future(feature):
+                    raise Exception('callback must be a feature')
+                self.ioloop.add_future(feature)
+            except Exception as ex:
+                self.logger.exception(ex.message)
+
+    def dispatch_subscribe(self, method, params):
+        self.logger.debug(str((method, params)))
+        if method in self._subscribe_dict:
+            funcs = self._subscribe_dict[method]
+            for func in funcs:
                 try:
-                    feature = func(msg_id, msg, result)
+                    feature = func(params)
                     if not is_future(feature):
                         raise Exception('callback must be a feature')
                     self.ioloop.add_future(feature)
                 except Exception as ex:
                     self.logger.exception(ex.message)
 
-    @gen.coroutine
-    def subscribe(self):
-        if len(self._subscribe_list):
-            method, params = self._subscribe_list.popleft()
-            self.logger.debug(str((method, params)))
-            if method in self._subscribe_dict:
-                funcs = self._subscribe_dict[method]
-                for func in funcs:
-                    try:
-                        feature = func(params)
-                        if not is_future(feature):
-                            raise Exception('callback must be a feature')
-                        self.ioloop.add_future(feature)
-                    except Exception as ex:
-                        self.logger.exception(ex.message)
+    def address(self):
+        return '%s:%s' % (self.ip, self.port)
+
+    def record(self, msg_id, method, error=False):
+        """
+        report the latency of a reply to metrics
+        """
+        sent_at = self._sent_at.pop(msg_id, None)
+        if self.metrics is not None:
+            latency = time.time() - sent_at if sent_at is not None else None
+            self.metrics.response(self.address(), method, latency=latency, error=error)
+
+    def outstanding(self):
+        return len(self._message_list) + len(self._sent_dict)
+
+    def queue_stats(self):
+        """
+        queue depth and drain rate (items per second spent dispatching)
+        """
+        stats = {'message_queue': len(self._message_list),
+                 'in_flight': len(self._sent_dict),
+                 'max_in_flight': self.max_in_flight,
+                 'response_queue': len(self._response_list),
+                 'subscribe_queue': len(self._subscribe_list),
+                 'timeouts': sum(self.timeout_stats.values())}
+        for lane, depth in self._message_list.depth().items():
+            stats['lane_' + lane] = depth
+        for name, (cnt, cost) in self.drain_stats.items():
+            stats[name + '_dispatched'] = cnt
+            stats[name + '_drain_rate'] = cnt / cost if cost > 0 else 0.0
+        return stats
+
+    def start_read(self):
+        """
+        stream every read to the frame parser until the connection closes
+        """
+        self.parser = FrameParser(self.max_frame_bytes)
+        self.stream.read_until_close(callback=self.on_data, streaming_callback=self.on_data)
+
+    def on_data(self, data):
+        if not data:
+            return
+        self.bytes_received += len(data)
+        if self.metrics is not None:
+            self.metrics.bytes_in(self.address(), len(data))
+        for frame in self.parser.feed(data):
+            self.parse_response(frame)
+        for head, tail in self.parser.take_dropped():
+            self.drop_reply(head, tail)
+
+    def drop_reply(self, head, tail):
+        """
+        a reply over max_frame_bytes fails its request, told by the id at either end of
+        the frame; without an id the connection is closed and the requests sent again
+        """
+        match = FRAME_HEAD_ID.match(head) or FRAME_TAIL_ID.search(tail)
+        if match is None:
+            self.logger.warning('drop frame over %d bytes, close the connection',
+                                self.parser.max_frame_bytes)
+            if self.stream is not None:
+                self.stream.close()
+            return
+        msg_id = int(match.group(1))
+        self.logger.warning('drop reply of %d over %d bytes', msg_id, self.parser.max_frame_bytes)
+        self.fail_request(msg_id, {'message': 'reply over %d bytes' % self.parser.max_frame_bytes})
 
     def parse_response(self, content):
+        self.logger.debug('receive:%s', content)
         try:
             j = json.loads(content)
-            if 'error' in j:
-                raise Exception(j['error'])
-            elif 'method' in j:
-                if 'jsonrpc' in j:
-                    j.pop('jsonrpc')
-                self.logger.debug('subscribe:' + json.dumps(j).replace(' ', ''))
-                self._subscribe_list.append((j['method'], j['params']))
+            if isinstance(j, list):
+                # reply of a batch request, demultiplex to per-id callbacks
+                for each in j:
+                    try:
+                        self.handle_frame(each)
+                    except Exception as ex:
+                        self.logger.exception('error message:' + json.dumps(each))
             else:
-                if 'jsonrpc' in j:
-                    j.pop('jsonrpc')
-                self.logger.debug('receive:' + json.dumps(j).replace(' ', ''))
-                print j['id'], 'sent result has received'
-                self._response_list.append((j['id'], self._sent_dict.pop(j['id']), j['result']))
+                self.handle_frame(j)
         except Exception as ex:
-            self.logger.exception('error message:' + content)
-        self.stream.read_until(b"\n", callback=self.parse_response)
+            self.logger.exception('error message:' + content[:1024])
+
+    def fail_request(self, msg_id, error):
+        """
+        drop a request sent without a usable reply, its callback never runs
+        """
+        message = self._sent_dict.pop(msg_id, None)
+        if message is None:
+            return
+        self._deadline_dict.pop(msg_id, None)
+        self._callback_dict.pop(msg_id, None)
+        self.record(msg_id, message['method'], error=True)
+        future = self._future_dict.pop(msg_id, None)
+        if future is not None:
+            # let the waiters of the request go
+            future.error = error
+            future.expire()
+        if len(self._message_list) > 0:
+            # a slot of the in-flight window is free
+            self.wakeup_send()
+
+    def handle_frame(self, j):
+        if 'error' in j:
+            self.fail_request(j.get('id'), j['error'])
+            raise Exception(j['error'])
+        elif 'method' in j:
+            self._subscribe_list.append((j['method'], j['params']))
+            if self.wakeup:
+                self.subscribe()
+        else:
+            if j['id'] not in self._sent_dict:
+                # timed out or cancelled before the reply arrived
+                self.logger.debug('drop late reply of %s', j['id'])
+                return
+            self._deadline_dict.pop(j['id'], None)
+            self._future_dict.pop(j['id'], None)
+            self.record(j['id'], self._sent_dict[j['id']]['method'])
+            self._response_list.append((j['id'], self._sent_dict.pop(j['id']), j['result']))
+            if len(self._message_list) > 0:
+                # a slot of the in-flight window is free
+                self.wakeup_send()
+            if self.wakeup:
+                self.callback()
 
-    def add_message(self, message, callback=None, subscribe=None):
+    def add_message(self, message, callback=None, subscribe=None, timeout=None, retries=0,
+                    future=None):
+        """
+        :param timeout: second to wait for the reply, request_timeout if None
+        :param retries: times to send again after a timeout
+        :param future: RequestFuture of the same request retried from another client
+        :return: RequestFuture resolved with the message id once it is written, so
+                 producers can wait for a free slot of the in-flight window
+        """
         message["id"] = self.sequence.next()
+        if future is None:
+            future = RequestFuture(self, message['id'])
+        else:
+            future.client, future.msg_id = self, message['id']
+        self._future_dict[message['id']] = future
+        if timeout is None:
+            timeout = self.request_timeout
+        if timeout > 0:
+            self._deadline_dict[message['id']] = (time.time() + timeout, timeout, retries)
         if callback is not None:
             self._callback_dict[message['id']] = callback
         if subscribe is not None:
             method = message['method']
             if method in self._subscribe_dict:
-                self._subscribe_dict[method].append(subscribe)
+                if subscribe not in self._subscribe_dict[method]:
+                    self._subscribe_dict[method].append(subscribe)
             else:
                 self._subscribe_dict[method] = [subscribe, ]
+        if message['method'].endswith('subscribe'):
+            replay = copy.copy(message)
+            replay.pop('id')
+            self._subscriptions[self.subscription_key(message)] = (replay, callback)
         self._message_list.append(message)
+        self.wakeup_send()
+        return future
 
     def add_subscribe(self, message, callback=None, subscribe=None):
-        message["id"] = self.sequence.next()
+        return self.add_message(message, callback=callback, subscribe=subscribe)
+
+    def _push_front(self, message, callback=None):
+        message = copy.copy(message)
+        message['id'] = self.sequence.next()
         if callback is not None:
             self._callback_dict[message['id']] = callback
-        if subscribe is not None:
+        self._message_list.appendleft(message)
+
+    def subscription_key(self, message):
+        return message['method'] + json.dumps(message['params'])
+
+    def _remove(self, msg_id):
+        """
+        forget a request, wherever it is
+        :return: the message, None if it is not pending
+        """
+        message = self._sent_dict.pop(msg_id, None)
+        if message is None:
+            for each in self._message_list:
+                if each['id'] == msg_id:
+                    self._message_list.remove(each)
+                    message = each
+                    message.pop('id')
+                    break
+        self._deadline_dict.pop(msg_id, None)
+        self._sent_at.pop(msg_id, None)
+        return message
+
+    def cancel(self, msg_id):
+        message = self._remove(msg_id)
+        self._callback_dict.pop(msg_id, None)
+        future = self._future_dict.pop(msg_id, None)
+        if future is not None:
+            future.expire()
+        if message is not None and len(self._message_list) > 0:
+            self.wakeup_send()
+        return message is not None
+
+    def sweep(self):
+        """
+        drop requests past their deadline, retry them while retries are left
+        """
+        now = time.time()
+        expired = [(msg_id, value) for msg_id, value in self._deadline_dict.items()
+                   if value[0] <= now]
+        for msg_id, (_, timeout, retries) in expired:
+            message = self._remove(msg_id)
+            callback = self._callback_dict.pop(msg_id, None)
+            future = self._future_dict.pop(msg_id, None)
+            if message is None:
+                continue
             method = message['method']
-            if method in self._subscribe_dict:
-                self._subscribe_dict[method].append(subscribe)
-            else:
-                self._subscribe_dict[method] = [subscribe, ]
-        self._message_list.append(message)
+            self.timeout_stats[method] = self.timeout_stats.get(method, 0) + 1
+            if self.metrics is not None:
+                self.metrics.response(self.address(), method, error=True)
+            self.logger.warning('%s %s timed out after %ss', method, msg_id, timeout)
+            if retries > 0:
+                if self.retry_handler is not None:
+                    self.retry_handler(self, message, callback, timeout, retries - 1, future)
+                else:
+                    self.add_message(message, callback, timeout=timeout, retries=retries - 1,
+                                     future=future)
+            elif future is not None:
+                future.expire()
+        if expired:
+            # slots of the in-flight window are free
+            self.wakeup_send()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+from functools import partial
+
+from tornado import gen
+
+from electrumq.net import logger
+
+__author__ = 'zhouqi'
+
+
+class RequestCoalescer(object):
+    """
+    identical requests (same method and params) in flight at the same time share
+    one request on the wire, the later ones only attach their callback to it
+    """
+
+    def __init__(self):
+        self._waiting = {}
+        self._lock = threading.Lock()
+        self.request_cnt = 0
+        self.hit_cnt = 0
+        self.saved_bytes = 0
+
+    def key(self, message):
+        return message['method'] + json.dumps(message['params'])
+
+    def add_message(self, message, callback, send):
+        """
+        :param send: function(message, callback) which puts message on the wire
+        :return: what send returned for the request on the wire
+        """
+        key = self.key(message)
+        with self._lock:
+            self.request_cnt += 1
+            if key in self._waiting:
+                self.hit_cnt += 1
+                self.saved_bytes += len(key)
+                logger.debug('coalesce %s', key)
+                admit, callbacks = self._waiting[key]
+                callbacks.append(callback)
+                return admit
+            callbacks = [callback, ]
+            admit = send(message, partial(self._dispatch, key))
+            self._waiting[key] = (admit, callbacks)
+        if hasattr(admit, 'add_expire_callback'):
+            # a timed out, cancelled or failed request never dispatches, its waiters
+            # learn it from the expire callbacks of admit, and the next one goes
+            admit.add_expire_callback(partial(self._forget, key, admit))
+        return admit
+
+    def _forget(self, key, admit):
+        with self._lock:
+            if key in self._waiting and self._waiting[key][0] is admit:
+                _, callbacks = self._waiting.pop(key)
+                logger.debug('release %d waiting for %s, error %s', len(callbacks), key,
+                             getattr(admit, 'error', None))
+
+    @gen.coroutine
+    def _dispatch(self, key, msg_id, msg, result):
+        with self._lock:
+            _, callbacks = self._waiting.pop(key)
+        futures = []
+        for callback in callbacks:
+            try:
+                futures.append(callback(msg_id, msg, result))
+            except Exception as ex:
+                logger.exception(ex.message)
+        for future in futures:
+            try:
+                yield future
+            except Exception as ex:
+                logger.exception(ex.message)
+
+    def stats(self):
+        return {'requests': self.request_cnt,
+                'hits': self.hit_cnt,
+                'saved_bytes': self.saved_bytes,
+                'waiting': len(self._waiting)}
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import os
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+
+from electrumq.net import logger
+
+__author__ = 'zhouqi'
+
+HEADER_BYTES = 80
+CHUNK_BYTES = HEADER_BYTES * 2016
+
+
+class HeaderDownloader(object):
+    """
+    stream the bootstrap headers file to path + '.part' and hand every complete
+    2016-headers chunk to chunk_callback(idx, data) as soon as its bytes arrive,
+    the headers after the last complete chunk go to tail_callback(height, data);
+    an interrupted download resumes from the partial file with an http Range
+    request, and the file is renamed to path once complete; a complete file is
+    resumed the same way, so only the headers appended since are downloaded
+    """
+    retry = 5
+    connect_timeout = 20
+    request_timeout = 60 * 10
+
+    def __init__(self, url, path, chunk_callback, tail_callback=None, skip_chunks=0):
+        """
+        :param skip_chunks: chunks before this index are not handed out again
+        """
+        self.url = url
+        self.path = path
+        self.part_path = path + '.part'
+        self.chunk_callback = chunk_callback
+        self.tail_callback = tail_callback
+        self.next_chunk = skip_chunks
+        self.offset = 0
+        self._pieces = []
+        self._pending = 0  # bytes in _pieces, they start at offset - _pending
+        self._file = None
+        self._status = None
+
+    @gen.coroutine
+    def start(self):
+        """
+        :return: future of the number of headers in the file
+        """
+        if os.path.exists(self.path) and not os.path.exists(self.part_path):
+            os.rename(self.path, self.part_path)
+        self._file = open(self.part_path, 'ab+')
+        try:
+            self.resume_local()
+            retry = self.retry
+            while True:
+                try:
+                    yield self.fetch()
+                    break
+                except HTTPError as ex:
+                    if ex.code == 416:
+                        # the partial file already has everything
+                        break
+                    retry -= 1
+                    logger.warning('download %s failed at %d: %s', self.url, self.offset, ex)
+                    if retry <= 0:
+                        raise
+                except Exception as ex:
+                    retry -= 1
+                    logger.warning('download %s failed at %d: %s', self.url, self.offset, ex)
+                    if retry <= 0:
+                        raise
+            self.finish()
+        finally:
+            self._file.close()
+        os.rename(self.part_path, self.path)
+        raise gen.Return(self.offset / HEADER_BYTES)
+
+    def resume_local(self):
+        """
+        hand out the chunks already in the partial file, one chunk in memory at a time
+        """
+        size = os.path.getsize(self.part_path)
+        size -= size % HEADER_BYTES
+        self._file.truncate(size)
+        self._file.seek(self.next_chunk * CHUNK_BYTES)
+        self.offset = self.next_chunk * CHUNK_BYTES
+        if self.offset > size:
+            # the chunks to skip are not on disk, download them again
+            self._file.truncate(0)
+            self.offset = 0
+            return
+        while self.offset < size:
+            data = self._file.read(min(CHUNK_BYTES, size - self.offset))
+            self.offset += len(data)
+            self.feed(data)
+        logger.debug('resume %s from %d', self.url, self.offset)
+
+    def fetch(self):
+        self._status = None
+        headers = {'Range': 'bytes=%d-' % self.offset} if self.offset > 0 else None
+        request = HTTPRequest(url=self.url, headers=headers,
+                              connect_timeout=self.connect_timeout,
+                              request_timeout=self.request_timeout,
+                              header_callback=self.on_header,
+                              streaming_callback=self.on_data)
+        return AsyncHTTPClient().fetch(request)
+
+    def on_header(self, line):
+        if line.startswith('HTTP/'):
+            self._status = int(line.split(' ')[1])
+            if self._status == 200 and self.offset > 0:
+                # Range is not supported, start from the beginning
+                logger.debug('server ignores Range, download %s again', self.url)
+                self._file.truncate(0)
+                self.offset = 0
+                self._pieces = []
+                self._pending = 0
+
+    def on_data(self, data):
+        if self._status not in (200, 206):
+            return
+        self._file.seek(self.offset)
+        self._file.write(data)
+        self.offset += len(data)
+        self.feed(data)
+
+    def feed(self, data):
+        self._pieces.append(data)
+        self._pending += len(data)
+        if self._pending < CHUNK_BYTES:
+            return
+        data = ''.join(self._pieces)
+        start = self.offset - self._pending
+        end = start + len(data) - len(data) % CHUNK_BYTES
+        for pos in xrange(start, end, CHUNK_BYTES):
+            idx = pos / CHUNK_BYTES
+            if idx >= self.next_chunk:
+                self.chunk_callback(idx, data[pos - start:pos - start + CHUNK_BYTES])
+                self.next_chunk = idx + 1
+        rest = data[end - start:]
+        self._pieces = [rest] if rest else []
+        self._pending = len(rest)
+
+    def finish(self):
+        self._file.flush()
+        if self.tail_callback is not None and self._pending >= HEADER_BYTES:
+            data = ''.join(self._pieces)
+            data = data[:len(data) - len(data) % HEADER_BYTES]
+            self.tail_callback((self.offset - self._pending) / HEADER_BYTES, data)
+        self._pieces = []
+        self._pending = 0
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import json
+import re
+
+__author__ = 'zhouqi'
+
+encoder = json.JSONEncoder(separators=(',', ':'))
+
+# id of a reply object from the first or the last bytes of its frame
+FRAME_HEAD_ID = re.compile(r'\s*\{\s*(?:"jsonrpc"\s*:\s*"2\.0"\s*,\s*)?"id"\s*:\s*(\d+)')
+FRAME_TAIL_ID = re.compile(r'"id"\s*:\s*(\d+)\s*(?:,\s*"jsonrpc"\s*:\s*"2\.0"\s*)?\}\s*$')
+
+
+class FrameBuffer(object):
+    """
+    newline-delimited json frames serialized with compact separators into a
+    list of chunks, joined once when taken out; a flush over max_bytes is
+    split so one write never carries more than max_bytes plus one frame
+    """
+    max_bytes = 256 * 1024
+
+    def __init__(self, max_bytes=None):
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self._chunks = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, message):
+        self._add(encoder.encode(message))
+
+    def append_batch(self, encoded):
+        """
+        :param encoded: list of messages already encoded, sent as one json array
+        """
+        self._add('[' + ','.join(encoded) + ']')
+
+    def _add(self, data):
+        self._chunks.append(data)
+        self._chunks.append('\n')
+        self.size += len(data) + 1
+
+    def is_full(self):
+        return self.size >= self.max_bytes
+
+    def take(self):
+        content = ''.join(self._chunks)
+        self._chunks = []
+        self.size = 0
+        return content
+
+
+class FrameParser(object):
+    """
+    split the bytes read from a stream into newline-delimited frames, pieces of
+    an unfinished frame are kept as they are and joined once it completes; a
+    frame over max_frame_bytes is dropped up to its newline, the first and last
+    edge_bytes of it are kept in dropped to tell which request it answers
+    """
+    max_frame_bytes = 8 * 1024 * 1024
+    edge_bytes = 64
+
+    def __init__(self, max_frame_bytes=None):
+        if max_frame_bytes is not None:
+            self.max_frame_bytes = max_frame_bytes
+        self._pieces = []
+        self._size = 0
+        self._skipping = False
+        self._head = ''
+        self._tail = ''
+        self.oversize_cnt = 0
+        self.dropped = []  # (head, tail) of the frames dropped, see take_dropped
+
+    def take_dropped(self):
+        dropped, self.dropped = self.dropped, []
+        return dropped
+
+    def _drop(self, tail):
+        self.dropped.append((self._head, tail[-self.edge_bytes:]))
+        self._head = self._tail = ''
+
+    def feed(self, data):
+        """
+        :return: list of complete frames, without the newline
+        """
+        frames = []
+        start = 0
+        end = data.find('\n')
+        while end >= 0:
+            if self._skipping:
+                self._skipping = False
+                self._drop(self._tail + data[start:end][-self.edge_bytes:])
+            elif self._size + end - start > self.max_frame_bytes:
+                if not self._pieces:
+                    self._head = data[start:start + self.edge_bytes]
+                last = self._pieces[-1][-self.edge_bytes:] if self._pieces else ''
+                self.oversize_cnt += 1
+                self._drop(last + data[start:end][-self.edge_bytes:])
+            elif self._pieces:
+                self._pieces.append(data[start:end])
+                frames.append(''.join(self._pieces))
+            else:
+                frames.append(data[start:end])
+            self._pieces = []
+            self._size = 0
+            self._head = ''
+            start = end + 1
+            end = data.find('\n', start)
+        if start < len(data):
+            rest = data[start:]
+            if self._skipping:
+                self._tail = (self._tail + rest[-self.edge_bytes:])[-self.edge_bytes:]
+                return frames
+            if len(self._head) < self.edge_bytes:
+                self._head += rest[:self.edge_bytes - len(self._head)]
+            self._pieces.append(rest)
+            self._size += len(rest)
+            if self._size > self.max_frame_bytes:
+                self.oversize_cnt += 1
+                self._tail = ''.join(self._pieces[-2:])[-self.edge_bytes:]
+                self._pieces = []
+                self._size = 0
+                self._skipping = True
+        return frames
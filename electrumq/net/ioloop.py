@@ -10,9 +10,19 @@ __author__ = 'zhouqi'
 
 MAX_WAIT_SECONDS_BEFORE_SHUTDOWN = 0.1
 
+
+class DeferredTimeout(object):
+    """
+    handle of a timeout added from another thread, the tornado one is set once the
+    ioloop adds it
+    """
+
+    def __init__(self):
+        self.timeout = None
+        self.cancelled = False
+
+
 class IOLoop(threading.Thread):
-    _futures = []
-    loop_interval = 100  # ms
     loop_quit_wait = MAX_WAIT_SECONDS_BEFORE_SHUTDOWN  # second
 
     def __init__(self):
@@ -21,36 +31,84 @@ class IOLoop(threading.Thread):
 
     def run(self):
         logger.debug('ioloop starting')
-
-        def add_features():
-            if not self._futures:
-                pass
-            else:
-                need_add = self._futures[:]
-                self._futures = []
-                for each in need_add:
-                    self.ioloop.add_future(each[0], each[1])
-
-        PeriodicCallback(add_features, self.loop_interval, self.ioloop).start()
         self.ioloop.start()
 
     def add_future(self, future, callback=None):
+        """
+        thread-safe, the future is attached on the next ioloop iteration
+        """
         def nothing(future, **kwargs):
             pass
 
         if callback is None:
             callback = nothing
-        # else:
-        #     feature.add_done_callback(callback)
-        self._futures.append((future, callback))
+        self.ioloop.add_callback(self.ioloop.add_future, future, callback)
+
+    def in_ioloop(self):
+        return threading.current_thread() is self
 
     def add_periodic(self, feature, interval=1000):
+        """
+        thread-safe, started on the ioloop
+        :return: the PeriodicCallback, for stop_periodic
+        """
         if self.ioloop._timeouts is None:
             self.ioloop._timeouts = []
-        PeriodicCallback(feature, interval, self.ioloop).start()
+        periodic = PeriodicCallback(feature, interval, self.ioloop)
+        if self.in_ioloop():
+            periodic.start()
+        else:
+            self.ioloop.add_callback(periodic.start)
+        return periodic
+
+    def stop_periodic(self, periodic):
+        """
+        thread-safe
+        """
+        if self.in_ioloop():
+            periodic.stop()
+        else:
+            self.ioloop.add_callback(periodic.stop)
+
+    def add_callback(self, callback, *args, **kwargs):
+        """
+        thread-safe, run callback on the next ioloop iteration
+        """
+        self.ioloop.add_callback(callback, *args, **kwargs)
 
     def add_timeout(self, deadline, callback, *args, **kwargs):
-        self.ioloop.add_timeout(deadline, callback, *args, **kwargs)
+        """
+        thread-safe, from another thread the timeout is added on the next ioloop
+        iteration, which wakes up the ioloop
+        :return: handle for remove_timeout
+        """
+        if self.in_ioloop():
+            return self.ioloop.add_timeout(deadline, callback, *args, **kwargs)
+        handle = DeferredTimeout()
+
+        def add():
+            if not handle.cancelled:
+                handle.timeout = self.ioloop.add_timeout(deadline, callback, *args, **kwargs)
+
+        self.ioloop.add_callback(add)
+        return handle
+
+    def remove_timeout(self, handle):
+        """
+        thread-safe
+        """
+        def remove():
+            if isinstance(handle, DeferredTimeout):
+                handle.cancelled = True
+                if handle.timeout is not None:
+                    self.ioloop.remove_timeout(handle.timeout)
+            else:
+                self.ioloop.remove_timeout(handle)
+
+        if self.in_ioloop():
+            remove()
+        else:
+            self.ioloop.add_callback(remove)
 
     def time(self):
         return self.ioloop.time()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+
+__author__ = 'zhouqi'
+
+INTERACTIVE = 'interactive'
+BROADCAST = 'broadcast'
+SYNC = 'sync'
+BULK = 'bulk'
+
+LANE_WEIGHTS = {INTERACTIVE: 8, BROADCAST: 4, SYNC: 2, BULK: 1}
+
+# methods not listed here are interactive
+LANE_MAP = {
+    'blockchain.transaction.broadcast': BROADCAST,
+    'blockchain.address.subscribe': SYNC,
+    'blockchain.address.get_history': SYNC,
+    'blockchain.address.get_mempool': SYNC,
+    'blockchain.transaction.get': SYNC,
+    'blockchain.transaction.get_merkle': SYNC,
+    'blockchain.block.get_chunk': BULK,
+    'blockchain.block.get_header': BULK,
+}
+
+
+class MessageLanes(object):
+    """
+    outbound queue of RPCClient with one deque per lane, popleft takes the
+    lanes in smooth weighted round robin so every lane gets its share and
+    background sync never holds up user-facing messages;
+    appendleft is for messages which must go first, like replays after reconnect
+    """
+
+    def __init__(self, weights=None, lane_map=None):
+        self.weights = dict(LANE_WEIGHTS if weights is None else weights)
+        self.lane_map = LANE_MAP if lane_map is None else lane_map
+        self._head = deque()
+        self._lanes = dict((lane, deque()) for lane in self.weights)
+        self._current = dict((lane, 0) for lane in self.weights)
+        self.dequeue_cnt = dict((lane, 0) for lane in self.weights)
+
+    def lane_of(self, message):
+        lane = self.lane_map.get(message['method'], INTERACTIVE)
+        return lane if lane in self._lanes else INTERACTIVE
+
+    def __len__(self):
+        return len(self._head) + sum(len(each) for each in self._lanes.values())
+
+    def __iter__(self):
+        for message in self._head:
+            yield message
+        for lane in self._lanes.values():
+            for message in lane:
+                yield message
+
+    def append(self, message):
+        self._lanes[self.lane_of(message)].append(message)
+
+    def appendleft(self, message):
+        self._head.appendleft(message)
+
+    def popleft(self):
+        if self._head:
+            return self._head.popleft()
+        ready = []
+        for lane, queue in self._lanes.items():
+            if queue:
+                ready.append(lane)
+            else:
+                self._current[lane] = 0
+        if not ready:
+            raise IndexError('pop from an empty queue')
+        total = 0
+        for lane in ready:
+            self._current[lane] += self.weights[lane]
+            total += self.weights[lane]
+        lane = max(ready, key=lambda each: self._current[each])
+        self._current[lane] -= total
+        self.dequeue_cnt[lane] += 1
+        return self._lanes[lane].popleft()
+
+    def remove(self, message):
+        for queue in [self._head] + self._lanes.values():
+            if message in queue:
+                queue.remove(message)
+                return
+        raise ValueError('message not in queue')
+
+    def depth(self):
+        return dict((lane, len(queue)) for lane, queue in self._lanes.items())
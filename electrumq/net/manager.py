@@ -1,19 +1,25 @@
 # -*- coding: utf-8 -*-
 import logging
+import os
 import random
 import signal
-import socket
+import time
+from functools import partial
 
-import tornado
 from tornado import gen
-from tornado.httpclient import AsyncHTTPClient
 
-from electrumq.message.blockchain.block import GetHeaderFile
 from electrumq.net.ioloop import IOLoop
 from electrumq.message.server import Version
 from electrumq.net import logger
-from electrumq.net.client import RPCClient
+from electrumq.net.cache import ResponseCache
+from electrumq.net.client import RPCClient, RequestFuture
+from electrumq.net.coalesce import RequestCoalescer
+from electrumq.net.download import HeaderDownloader
+from electrumq.net.metrics import MetricsRegistry, start_metrics_server
+from electrumq.net.pool import ClientPool
+from electrumq.net.selector import ServerSelector
 from electrumq.utils import Singleton
+from electrumq.utils.configuration import response_cache_path, server_score_path, headers_dir
 from electrumq.utils.parameter import Parameter
 
 __author__ = 'zhouqi'
@@ -29,8 +35,30 @@ class NetWorkManager:
 
     ioloop = None
     client = None
+    pool = None
+    pool_size = 1  # number of servers to keep connected at the same time
+    router = None  # routing of ClientPool, StickyRouter by default
+    batch_size = 0  # > 0 to send queued messages as json-rpc batch arrays
+    # requests waiting for reply per client, the others wait in its lanes so a late
+    # interactive message overtakes queued bulk ones; 0 writes every message at once
+    max_in_flight = 32
+    coalesce = True  # identical requests in flight share one wire request
+    coalescer = None
+    cache_enabled = True  # answer immutable requests from ResponseCache
+    cache = None
+    tip_height = None  # function returning the local chain height, for cache rules
+    selector = None
+    probe = True  # ping all DEFAULT_SERVERS in background to refresh the scores
+    request_timeout = 0  # default second to wait for a reply, 0 means forever
+    retries = 0  # default times to retry a timed out request, on another server if any
+    metrics = None  # MetricsRegistry of all clients, metrics.snapshot() for a dict
+    metrics_port = 0  # > 0 to serve /metrics in prometheus text format on 127.0.0.1
+    metrics_server = None
 
     def __init__(self):
+        self.coalescer = RequestCoalescer()
+        self.metrics = MetricsRegistry()
+        self.selector = ServerSelector(server_score_path)
         signal.signal(signal.SIGTERM, self.sig_handler)
         signal.signal(signal.SIGINT, self.sig_handler)
 
@@ -40,13 +68,16 @@ class NetWorkManager:
     network.status
     """
 
-    def start(self):
+    def start(self, servers=None):
         """
 
+        :param servers: list of (ip, port), picked from DEFAULT_SERVERS if None
         :return:
         """
         self.start_ioloop()
-        self.start_client()
+        if self.metrics_port > 0:
+            self.ioloop.add_callback(self.start_metrics_server)
+        self.start_client(servers)
 
     status = {}
 
@@ -55,16 +86,88 @@ class NetWorkManager:
     network.add_message(message, callback)
     """
 
-    def add_message(self, message, callback=None, subscribe=None):
-        if message.__class__ is GetHeaderFile:
-            self.ioloop.add_future(self.init(), callback)
+    def add_message(self, message, callback=None, subscribe=None, timeout=None, retries=None):
+        """
+        :param timeout: second to wait for the reply, request_timeout if None
+        :param retries: times to retry after a timeout, retries if None
+        :return: RequestFuture, cancel() it to drop the request
+        """
+        if retries is None:
+            retries = self.retries
+        if callback is None or subscribe is not None or message.is_subscribe():
+            return self.pool.add_message(message, callback=callback, subscribe=subscribe,
+                                         timeout=timeout, retries=retries)
+        elif self.coalesce:
+            return self.coalescer.add_message(
+                message, callback, partial(self.send_message, timeout=timeout, retries=retries))
         else:
-            self.client.add_message(message, callback=callback, subscribe=subscribe)
+            return self.send_message(message, callback, timeout=timeout, retries=retries)
+
+    def send_message(self, message, callback, timeout=None, retries=0):
+        """
+        answer from the response cache when possible, otherwise put on the wire
+        """
+        cache = self.response_cache()
+        if cache is not None and cache.is_cacheable(message, self.get_tip_height()):
+            result = cache.get(message)
+            if result is not None:
+                self.ioloop.add_callback(self.cached_callback, callback, message, result)
+                # never on the wire, no client and no message id
+                admit = RequestFuture(None, None)
+                admit.set_result(None)
+                return admit
+            callback = partial(self.cache_callback, callback)
+        return self.pool.add_message(message, callback=callback, timeout=timeout, retries=retries)
+
+    def retry_message(self, client, message, callback, timeout, retries, future):
+        """
+        retry_handler of the clients, move a timed out request to another server
+        """
+        others = [c for c in self.pool.clients if c is not client and c.is_connected]
+        if others:
+            client = min(others, key=lambda c: c.outstanding())
+        logger.debug('retry %s on %s:%s', message['method'], client.ip, client.port)
+        client.add_message(message, callback, timeout=timeout, retries=retries, future=future)
+
+    def cached_callback(self, callback, message, result):
+        try:
+            self.ioloop.add_future(callback(None, message, result))
+        except Exception as ex:
+            logger.exception(ex.message)
+
+    def cache_callback(self, callback, msg_id, msg, result):
+        if self.cache.is_cacheable(msg, self.get_tip_height()):
+            self.cache.put(msg, result)
+        return callback(msg_id, msg, result)
+
+    def response_cache(self):
+        if self.cache is None and self.cache_enabled:
+            path = response_cache_path
+            if Parameter().TESTNET:
+                path = path[:-len('.sqlite')] + '_testnet.sqlite'
+            self.cache = ResponseCache(path)
+        return self.cache
+
+    def discard_cached(self, height):
+        """
+        after a reorg, the cached responses of blocks at or above height are stale
+        """
+        cache = self.response_cache()
+        if cache is not None:
+            cache.discard_from(height)
+
+    def get_tip_height(self):
+        if self.tip_height is None:
+            return None
+        return self.tip_height()
 
     """
     inner method
     """
 
+    def start_metrics_server(self):
+        self.metrics_server = start_metrics_server(self.metrics, self.metrics_port)
+
     def start_ioloop(self):
         if self.ioloop is None:
             self.ioloop = IOLoop()
@@ -76,39 +179,96 @@ class NetWorkManager:
 
     def quit(self):
         if self.ioloop is not None:
+            if self.pool is not None:
+                for client in self.pool.clients:
+                    # no reconnect while shutting down
+                    self.ioloop.add_callback(client.close)
+            if self.metrics_server is not None:
+                self.ioloop.add_callback(self.metrics_server.stop)
+                self.metrics_server = None
             self.ioloop.quit()
             self.ioloop = None
 
-    def start_client(self):
-        ip, port = self.get_server()
-        self.client = RPCClient(ioloop=self.ioloop, ip=ip, port=port)
+    def start_client(self, servers=None):
+        """
+        :param servers: list of (ip, port) or serialized servers, the best scored
+                        servers of DEFAULT_SERVERS if None
+        """
+        self.pool = ClientPool(router=self.router)
+        if servers is None:
+            servers = self.selector.pick(self.candidate_servers(), count=self.pool_size)
+            if self.probe:
+                self.ioloop.add_callback(self.probe_servers, self.ioloop)
+        for server in servers:
+            client = RPCClient(ioloop=self.ioloop)
+            client.batch_size = self.batch_size
+            client.max_in_flight = self.max_in_flight
+            client.request_timeout = self.request_timeout
+            client.retry_handler = self.retry_message
+            client.metrics = self.metrics
+            client.handshake = Version(
+                [Parameter().ELECTRUM_VERSION, Parameter().PROTOCOL_VERSION])
+            self.pool.add_client(client)
+            self.ioloop.add_callback(self.connect_client, client, server)
+        self.client = self.pool.clients[0]
 
-        def connect_callback(future):
-            if not self.client.is_connected:
-                logger.debug('connect failed and retry')
-                self.client = None
-                self.start_client()
+    @gen.coroutine
+    def connect_client(self, client, server):
+        """
+        retry with the backoff of reconnects until connected; a server given as
+        (ip, port) is kept, a serialized one gives way to the best scored other
+        """
+        while self.ioloop is not None:
+            if isinstance(server, tuple):
+                client.ip, client.port = server
             else:
-                self.client.add_message(
-                    Version([Parameter().ELECTRUM_VERSION, Parameter().PROTOCOL_VERSION]))
+                client.ip, client.port = yield self.resolve_server(server)
+            logger.debug('begin to connect to %s %d' % (client.ip, client.port))
+            begin = time.time()
+            connected = yield client.connect_with_future()
+            if connected:
+                if not isinstance(server, tuple):
+                    self.selector.record(server, rtt=time.time() - begin)
+                self.metrics.register(client.address(), client)
+                break
+            if not isinstance(server, tuple):
+                self.selector.record(server, error=True)
+                # keep the client and its queued messages, only change the server
+                server = self.selector.pick(self.candidate_servers(), exclude_set=set([server]))[0]
+            delay = client.reconnect_delay()
+            logger.debug('connect failed, retry in %.2fs', delay)
+            yield gen.sleep(delay)
 
-        self.ioloop.add_future(self.client.connect_with_future(), connect_callback)
+    @gen.coroutine
+    def probe_servers(self, ioloop):
+        """
+        :param ioloop: the ioloop of the manager when the probe was queued
+        """
+        if ioloop is not self.ioloop:
+            # the manager quit before the probe started
+            return
+        yield self.selector.probe(ioloop, self.candidate_servers())
 
     """
     dns
     
     """
 
-    def get_server(self):
-        ip, port, _ = self.deserialize_server(self.pick_random_server())
-        port = int(port)
-        logger.debug('begin to connect to %s %d' % (ip, port))
-        try:
-            l = socket.getaddrinfo(ip, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
-            ip, port = l[0][-1]
-        except socket.gaierror:
-            logger.debug('cannot resolve hostname')
-        return ip, port
+    def candidate_servers(self):
+        return self.filter_protocol(Parameter().DEFAULT_SERVERS, 't')
+
+    @gen.coroutine
+    def get_server(self, exclude_set=set()):
+        server = self.selector.pick(self.candidate_servers(), exclude_set=exclude_set)[0]
+        address = yield self.resolve_server(server)
+        raise gen.Return(address)
+
+    def resolve_server(self, server):
+        """
+        :return: future of (ip, port), dns lookup is async and cached
+        """
+        host, port, _ = self.deserialize_server(server)
+        return self.selector.resolver.resolve(host, int(port))
 
     def filter_protocol(self, hostmap, protocol='s'):
         """
@@ -137,22 +297,25 @@ class NetWorkManager:
         int(port)  # Throw if cannot be converted to int
         return host, port, protocol
 
-    def init_header(self, callback=None):
-        self.ioloop.add_future(self.init(), callback)
+    def download_headers(self, chunk_callback, tail_callback=None, skip_chunks=0, callback=None):
+        """
+        stream Parameter().HEADERS_URL, every 2016-headers chunk goes to
+        chunk_callback(idx, data) as it arrives, see HeaderDownloader
+        :param callback: function(future) called once the download is complete
+        """
+        downloader = HeaderDownloader(Parameter().HEADERS_URL, self.headers_path(),
+                                      chunk_callback, tail_callback, skip_chunks)
+        self.ioloop.add_callback(self._download, downloader, callback)
+        return downloader
 
-    @gen.coroutine
-    def init(self):
-        retry = 5
-        while retry > 0:
-            try:
-                request = tornado.httpclient.HTTPRequest(url=Parameter().HEADERS_URL,
-                                                         connect_timeout=20.0,
-                                                         request_timeout=60 * 10)
-                response = yield tornado.gen.Task(AsyncHTTPClient().fetch, request)
-                #
-                # response = yield AsyncHTTPClient().fetch(Parameter().HEADERS_URL)
-            except Exception as ex:
-                print ex.message
-                retry -= 1
-            else:
-                raise gen.Return(response.body)
+    def headers_path(self):
+        """
+        :return: local path of the bootstrap headers file, the download goes to path + '.part'
+        """
+        return os.path.join(headers_dir, Parameter().HEADERS_URL.split('/')[-1])
+
+    def _download(self, downloader, callback):
+        # AsyncHTTPClient binds to the current ioloop, so start it on the ioloop thread
+        future = downloader.start()
+        if callback is not None:
+            self.ioloop.add_future(future, callback)
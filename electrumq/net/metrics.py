@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import weakref
+
+from tornado import web
+from tornado.httpserver import HTTPServer
+
+from electrumq.net import logger
+
+__author__ = 'zhouqi'
+
+# upper bounds in second of the latency buckets, the last one is +Inf
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        for idx, cnt in enumerate(other.counts):
+            self.counts[idx] += cnt
+        self.count += other.count
+        self.sum += other.sum
+
+    def cumulative(self):
+        """
+        :return: list of (upper bound, observations <= bound), as prometheus wants
+        """
+        total = 0
+        result = []
+        for bound, cnt in zip(self.buckets, self.counts):
+            total += cnt
+            result.append((bound, total))
+        return result
+
+    def snapshot(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'buckets': [(bound, cnt) for bound, cnt in self.cumulative()]}
+
+
+class MetricsRegistry(object):
+    """
+    per server (ip:port) and method: requests, errors and reply latency, per server:
+    bytes in and out, reconnects, and the queue depths of the registered clients
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = {}  # (server, method) -> count
+        self._errors = {}  # (server, method) -> count
+        self._latency = {}  # (server, method) -> Histogram
+        self._bytes_in = {}  # server -> bytes
+        self._bytes_out = {}
+        self._reconnects = {}
+        self._clients = weakref.WeakValueDictionary()  # server -> RPCClient
+        self.begin = time.time()
+
+    def register(self, server, client):
+        """
+        queue_stats() of client is read at every snapshot
+        """
+        self._clients[server] = client
+
+    def request(self, server, method):
+        with self._lock:
+            key = (server, method)
+            self._requests[key] = self._requests.get(key, 0) + 1
+
+    def response(self, server, method, latency=None, error=False):
+        with self._lock:
+            key = (server, method)
+            if error:
+                self._errors[key] = self._errors.get(key, 0) + 1
+            if latency is not None:
+                if key not in self._latency:
+                    self._latency[key] = Histogram()
+                self._latency[key].observe(latency)
+
+    def bytes_in(self, server, size):
+        with self._lock:
+            self._bytes_in[server] = self._bytes_in.get(server, 0) + size
+
+    def bytes_out(self, server, size):
+        with self._lock:
+            self._bytes_out[server] = self._bytes_out.get(server, 0) + size
+
+    def reconnect(self, server):
+        with self._lock:
+            self._reconnects[server] = self._reconnects.get(server, 0) + 1
+
+    def snapshot(self):
+        """
+        :return: {'uptime', 'methods': {method: {requests, errors, latency}},
+                  'servers': {server: {requests, errors, latency, bytes_in, bytes_out,
+                  reconnects, queues}}}
+        """
+        with self._lock:
+            methods = {}
+            servers = {}
+            keys = set(self._requests) | set(self._errors) | set(self._latency)
+            for server, method in keys:
+                for name, group in ((method, methods), (server, servers)):
+                    entry = group.setdefault(name, {'requests': 0, 'errors': 0,
+                                                    'latency': Histogram()})
+                    entry['requests'] += self._requests.get((server, method), 0)
+                    entry['errors'] += self._errors.get((server, method), 0)
+                    if (server, method) in self._latency:
+                        entry['latency'].merge(self._latency[(server, method)])
+            for server in set(self._bytes_in) | set(self._bytes_out) | set(self._reconnects):
+                servers.setdefault(server, {'requests': 0, 'errors': 0, 'latency': Histogram()})
+            for server, entry in servers.items():
+                entry['bytes_in'] = self._bytes_in.get(server, 0)
+                entry['bytes_out'] = self._bytes_out.get(server, 0)
+                entry['reconnects'] = self._reconnects.get(server, 0)
+        for group in (methods, servers):
+            for entry in group.values():
+                entry['latency'] = entry['latency'].snapshot()
+        for server, client in self._clients.items():
+            entry = servers.setdefault(server, {'requests': 0, 'errors': 0,
+                                                'latency': Histogram().snapshot(),
+                                                'bytes_in': 0, 'bytes_out': 0, 'reconnects': 0})
+            entry['queues'] = client.queue_stats()
+        return {'uptime': time.time() - self.begin, 'methods': methods, 'servers': servers}
+
+    def render(self):
+        """
+        :return: all metrics in prometheus text exposition format
+        """
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP electrumq_%s %s' % (name, help_text))
+            lines.append('# TYPE electrumq_%s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('electrumq_%s%s %s' % (name, format_labels(labels), format_value(value)))
+
+        with self._lock:
+            metric('requests_total', 'counter', 'requests sent per server and method',
+                   [({'server': s, 'method': m}, v) for (s, m), v in sorted(self._requests.items())])
+            metric('errors_total', 'counter', 'error replies and timeouts per server and method',
+                   [({'server': s, 'method': m}, v) for (s, m), v in sorted(self._errors.items())])
+            samples = []
+            for (server, method), histogram in sorted(self._latency.items()):
+                labels = {'server': server, 'method': method}
+                for bound, cnt in histogram.cumulative():
+                    samples.append((dict(labels, le=bound), cnt))
+            lines.append('# HELP electrumq_request_seconds reply latency per server and method')
+            lines.append('# TYPE electrumq_request_seconds histogram')
+            for labels, value in samples:
+                lines.append('electrumq_request_seconds_bucket%s %s'
+                             % (format_labels(labels), format_value(value)))
+            for (server, method), histogram in sorted(self._latency.items()):
+                labels = format_labels({'server': server, 'method': method})
+                lines.append('electrumq_request_seconds_sum%s %s' % (labels, format_value(histogram.sum)))
+                lines.append('electrumq_request_seconds_count%s %s' % (labels, histogram.count))
+            metric('received_bytes_total', 'counter', 'bytes read per server',
+                   [({'server': s}, v) for s, v in sorted(self._bytes_in.items())])
+            metric('sent_bytes_total', 'counter', 'bytes written per server',
+                   [({'server': s}, v) for s, v in sorted(self._bytes_out.items())])
+            metric('reconnects_total', 'counter', 'reconnects per server',
+                   [({'server': s}, v) for s, v in sorted(self._reconnects.items())])
+        depths, timeouts, dispatched = [], [], []
+        for server, client in sorted(self._clients.items()):
+            for queue, value in sorted(client.queue_stats().items()):
+                if not isinstance(value, (int, long)):
+                    continue
+                if queue == 'timeouts':
+                    timeouts.append(({'server': server}, value))
+                elif queue.endswith('_dispatched'):
+                    dispatched.append(({'server': server, 'queue': queue[:-len('_dispatched')]}, value))
+                else:
+                    depths.append(({'server': server, 'queue': queue}, value))
+        metric('queue', 'gauge', 'queue depths of the clients', depths)
+        metric('timeouts_total', 'counter', 'requests timed out per server', timeouts)
+        metric('dispatched_total', 'counter', 'replies dispatched per server and queue', dispatched)
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    items = []
+    for key in sorted(labels):
+        value = labels[key]
+        if isinstance(value, float):
+            value = format_value(value)
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        items.append('%s="%s"' % (key, value))
+    return '{%s}' % ','.join(items)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class MetricsHandler(web.RequestHandler):
+    def initialize(self, registry):
+        self.registry = registry
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(self.registry.render())
+
+
+def start_metrics_server(registry, port, address='127.0.0.1'):
+    """
+    serve /metrics on the current ioloop, call it on the ioloop thread
+    """
+    server = HTTPServer(web.Application([(r"/metrics", MetricsHandler, {"registry": registry})]))
+    server.listen(port, address)
+    logger.info('metrics on http://%s:%d/metrics', address, port)
+    return server
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import json
+
+from electrumq.net import logger
+
+__author__ = 'zhouqi'
+
+
+class RoundRobinRouter(object):
+    def __init__(self):
+        self._next = 0
+
+    def route(self, clients, message):
+        client = clients[self._next % len(clients)]
+        self._next += 1
+        return client
+
+
+class LeastOutstandingRouter(object):
+    def route(self, clients, message):
+        return min(clients, key=lambda c: c.outstanding())
+
+
+class StickyRouter(object):
+    """
+    a subscription always goes to the same client (per method and params, so per
+    address for blockchain.address.subscribe), other messages use fallback
+    """
+
+    def __init__(self, fallback=None):
+        if fallback is None:
+            fallback = LeastOutstandingRouter()
+        self.fallback = fallback
+        self._sticky = {}
+
+    def route(self, clients, message):
+        if not message.is_subscribe():
+            return self.fallback.route(clients, message)
+        key = message['method'] + json.dumps(message['params'])
+        client = self._sticky.get(key)
+        if client is None or client not in clients:
+            client = self.fallback.route(clients, message)
+            self._sticky[key] = client
+        return client
+
+
+class ClientPool(object):
+    """
+    N concurrent RPCClients, each message goes to the one picked by router
+    """
+
+    def __init__(self, router=None):
+        if router is None:
+            router = StickyRouter()
+        self.router = router
+        self.clients = []
+
+    def __len__(self):
+        return len(self.clients)
+
+    def add_client(self, client):
+        self.clients.append(client)
+
+    def remove_client(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+
+    def route(self, message):
+        connected = [c for c in self.clients if c.is_connected]
+        return self.router.route(connected or self.clients, message)
+
+    def add_message(self, message, callback=None, subscribe=None, timeout=None, retries=0):
+        client = self.route(message)
+        logger.debug('route %s to %s:%s', message['method'], client.ip, client.port)
+        return client.add_message(message, callback=callback, subscribe=subscribe,
+                                  timeout=timeout, retries=retries)
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import random
+import socket
+import threading
+import time
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from electrumq.message.server import Version
+from electrumq.net import logger
+from electrumq.net.client import RPCClient
+from electrumq.utils.parameter import Parameter
+
+__author__ = 'zhouqi'
+
+
+class CachedResolver(object):
+    """
+    getaddrinfo on a worker thread, so the ioloop never blocks on dns,
+    results are kept for ttl seconds
+    """
+    ttl = 300
+
+    def __init__(self):
+        self._cache = {}
+
+    def resolve(self, host, port):
+        """
+        call it on an ioloop thread
+        :return: future of (ip, port), (host, port) if it cannot be resolved
+        """
+        ioloop = IOLoop.current()
+        future = Future()
+        key = (host, port)
+        if key in self._cache and self._cache[key][0] > time.time():
+            future.set_result(self._cache[key][1])
+            return future
+
+        def done(address):
+            if address is None:
+                logger.debug('cannot resolve hostname %s', host)
+                address = key
+            else:
+                self._cache[key] = (time.time() + self.ttl, address)
+            future.set_result(address)
+
+        def lookup():
+            try:
+                l = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+                address = l[0][-1][:2]
+            except socket.gaierror:
+                address = None
+            ioloop.add_callback(done, address)
+
+        thread = threading.Thread(target=lookup)
+        thread.daemon = True
+        thread.start()
+        return future
+
+
+class ServerSelector(object):
+    """
+    keep an EWMA of round trip time and error rate per server (serialized as
+    host:port:protocol), pick the servers with the lowest score and persist
+    the scores across restarts
+    """
+    alpha = 0.3  # weight of the newest sample
+    unknown_rtt = 1.0  # second, assumed for servers never measured
+    error_penalty = 10  # score = rtt * (1 + error_penalty * error_rate)
+    probe_timeout = 3  # second
+
+    def __init__(self, path=None):
+        self.path = path
+        self.scores = {}
+        self.resolver = CachedResolver()
+        self.load()
+
+    def record(self, server, rtt=None, error=False):
+        score = self.scores.setdefault(server, {'rtt': None, 'error': 0.0})
+        if rtt is not None:
+            # the first sample is taken as it is
+            if score['rtt'] is None:
+                score['rtt'] = rtt
+            else:
+                score['rtt'] = self.alpha * rtt + (1 - self.alpha) * score['rtt']
+        score['error'] = self.alpha * (1.0 if error else 0.0) + (1 - self.alpha) * score['error']
+
+    def score(self, server):
+        if server not in self.scores:
+            return self.unknown_rtt
+        score = self.scores[server]
+        rtt = self.unknown_rtt if score['rtt'] is None else score['rtt']
+        return rtt * (1 + self.error_penalty * score['error'])
+
+    def pick(self, servers, count=1, exclude_set=set()):
+        eligible = [s for s in servers if s not in exclude_set]
+        random.shuffle(eligible)  # break ties between servers never measured
+        return sorted(eligible, key=self.score)[:count]
+
+    @gen.coroutine
+    def probe(self, ioloop, servers):
+        """
+        ping every server with server.version at the same time
+        """
+        yield [self.probe_one(ioloop, server) for server in servers]
+        self.save()
+
+    @gen.coroutine
+    def probe_one(self, ioloop, server):
+        host, port, _ = str(server).split(':')
+        ip, port = yield self.resolver.resolve(host, int(port))
+        client = RPCClient(ioloop=ioloop, ip=ip, port=port)
+        replied = Future()
+
+        @gen.coroutine
+        def version_callback(msg_id, msg, result):
+            if not replied.done():
+                replied.set_result(True)
+
+        begin = time.time()
+        try:
+            connected = yield client.connect_with_future()
+            if connected:
+                client.add_message(
+                    Version([Parameter().ELECTRUM_VERSION, Parameter().PROTOCOL_VERSION]),
+                    version_callback)
+                yield gen.with_timeout(begin + self.probe_timeout, replied)
+                self.record(server, rtt=time.time() - begin)
+                logger.debug('probe %s %.3fs', server, time.time() - begin)
+            else:
+                self.record(server, error=True)
+        except gen.TimeoutError:
+            self.record(server, error=True)
+        finally:
+            client.close()
+
+    def load(self):
+        if self.path is not None and os.path.exists(self.path):
+            try:
+                self.scores = json.loads(open(self.path).read())
+            except ValueError:
+                logger.warning('cannot load server scores from %s', self.path)
+
+    def save(self):
+        if self.path is not None:
+            with open(self.path, 'w') as f:
+                f.write(json.dumps(self.scores))
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+from ConfigParser import RawConfigParser
 
 from appdirs import AppDirs
 
@@ -22,6 +23,10 @@ if not os.path.exists(dirs.user_data_dir):
 conf_path = dirs.user_data_dir + '/electrumq.conf'
 log_conf_path = dirs.user_data_dir + '/logging.conf'
 sqlite_path = dirs.user_data_dir + '/tx.sqlite'
+response_cache_path = dirs.user_data_dir + '/response.sqlite'
+server_score_path = dirs.user_data_dir + '/servers.json'
+headers_dir = dirs.user_data_dir  # bootstrap headers file, and its .part while downloading
+flat_headers_path = dirs.user_data_dir + '/headers.dat'  # 80 bytes per height, block_store=flat
 style_path = dirs.user_data_dir + '/main.style'
 
 
@@ -45,6 +50,14 @@ def init_configuration():
         f.close()
 
 
+def read_option(section, option, default=None):
+    parser = RawConfigParser()
+    parser.read(conf_path)
+    if parser.has_option(section, option):
+        return parser.get(section, option)
+    return default
+
+
 log_conf_content = '''
 [loggers]
 keys=root,simpleExample,network,blockchain,blockstore,rpcclient
@@ -270,3 +283,7 @@ AddressView > QTextEdit{
 '''
 
 init_configuration()
+
+# backend of BlockStore, 'sqlite' (table blocks) or 'flat' (mmap of flat_headers_path),
+# set by block_store in the [chain] section of electrumq.conf
+block_store = read_option('chain', 'block_store', 'sqlite')
@@ -6,3 +6,9 @@ class VerificationException(Exception):
     def __init__(self, message, *args):
         super(VerificationException, self).__init__(*args)
         self.message = message
+
+
+class ChunkException(Exception):
+    def __init__(self, message, *args):
+        super(ChunkException, self).__init__(*args)
+        self.message = message
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import random
 from Queue import Queue
 from functools import partial
@@ -6,7 +7,7 @@ from functools import partial
 from tornado import gen
 
 from electrumq.chain.chain import BlockChain
-from electrumq.db.sqlite.block import BlockStore
+from electrumq.db.block import BlockStore
 from electrumq.db.sqlite.tx import TxStore
 from electrumq.message.blockchain.address import *
 from electrumq.message.blockchain.transaction import *
@@ -50,6 +51,9 @@ class BaseWallet(object):
         self.receiving_addresses = []
         self.change_addresses = []
         self.load_addresses()
+        # last status hash of every subscribed address, history is only asked on change
+        self.address_status = self.storage.get('address_status', {})
+        self._history_pending = 0
         # todo: wallet name logic
         self.wallet_name = 'abc'
 
@@ -364,16 +368,85 @@ class BaseWallet(object):
     """
 
     def sync(self):
-        NetWorkManager().add_message(GetHistory([self.address]), self.history_callback)
+        self.resume_txs()
+        for address in self.get_addresses():
+            self.subscribe_address(address)
+
+    def resume_txs(self):
+        """
+        the txs an earlier run left unverified or unfetched, the status of their address
+        is saved already and does not ask for them again
+        """
+        for tx_hash, height in TxStore().unverify_tx_list:
+            if height > 0:
+                NetWorkManager().add_message(GetMerkle([tx_hash, height]),
+                                             self.get_merkle_callback)
+        for tx_hash in TxStore().unfetch_tx:
+            NetWorkManager().add_message(Get([tx_hash]), self.get_tx_callback)
+
+    def subscribe_address(self, address):
+        NetWorkManager().add_message(Subscribe([address]), self.address_status_callback,
+                                     subscribe=self.address_notify)
+
+    @gen.coroutine
+    def address_status_callback(self, msg_id, msg, param):
+        self.on_address_status(msg['params'][0], param)
+
+    @gen.coroutine
+    def address_notify(self, params):
+        address, status = params
+        if self.is_mine(address):
+            self.on_address_status(address, status)
+
+    def on_address_status(self, address, status):
+        if status == self.address_status.get(address):
+            return
+        self._history_pending += 1
+        future = NetWorkManager().add_message(GetHistory([address]), self.history_callback)
+        if hasattr(future, 'add_expire_callback'):
+            # failed or timed out, the status stays unknown and the next one asks again
+            future.add_expire_callback(self.history_done)
+
+    @staticmethod
+    def history_status(history):
+        """
+        status hash of electrum protocol, None for an empty history
+        """
+        if not history:
+            return None
+        status = ''.join(['%s:%d:' % (each['tx_hash'], each['height']) for each in history])
+        return hashlib.sha256(status).hexdigest()
 
     @gen.coroutine
     def history_callback(self, msg_id, msg, param):
+        """
+        only the txs new, moved to another height, unverified or unfetched are requested
+        """
+        address = msg['params'][0]
+        known = TxStore().get_address_history(address)
         for each in param:
-            TxStore().add(msg['params'][0], each['tx_hash'], each['height'])
-        for tx, height in TxStore().unverify_tx_list:
-            NetWorkManager().add_message(GetMerkle([tx, height]), self.get_merkle_callback)
-        for tx in TxStore().unfetch_tx:
-            NetWorkManager().add_message(Get([tx]), self.get_tx_callback)
+            tx_hash, height = each['tx_hash'], each['height']
+            old = known.get(tx_hash)
+            TxStore().add(address, tx_hash, height)
+            if height > 0 and (old is None or old[0] != height or not old[1]):
+                NetWorkManager().add_message(GetMerkle([tx_hash, height]),
+                                             self.get_merkle_callback)
+            if old is None or not old[2]:
+                NetWorkManager().add_message(Get([tx_hash]), self.get_tx_callback)
+        self.address_status[address] = self.history_status(param)
+        self.history_done()
+
+    def history_done(self):
+        """
+        the statuses are saved once no GetHistory is pending
+        """
+        self._history_pending -= 1
+        if self._history_pending <= 0:
+            self.save_address_status()
+
+    def save_address_status(self):
+        self.storage.put('address_status', self.address_status)
+        self.storage.write()
 
     @gen.coroutine
     def get_merkle_callback(self, msg_id, msg, param):
@@ -3,7 +3,6 @@ from tornado import gen
 
 from electrumq.chain.chain import BlockChain
 from electrumq.db.sqlite.tx import TxStore
-from electrumq.message.blockchain.address import GetHistory
 from electrumq.message.blockchain.transaction import GetMerkle, Get
 from electrumq.net.manager import NetWorkManager
 from electrumq.utils.key_store import load_keystore
@@ -29,19 +28,6 @@ class HDWallet(BaseWallet):
         self.storage.put('keystore', self.keystore.dump())
         self.storage.write()
 
-    def sync(self):
-        for address in (self.receiving_addresses + self.change_addresses):
-            NetWorkManager().add_message(GetHistory([address]), self.history_callback)
-
-    @gen.coroutine
-    def history_callback(self, msg_id, msg, param):
-        for each in param:
-            TxStore().add(msg['params'][0], each['tx_hash'], each['height'])
-        # for tx, height in TxStore().unverify_tx_list:
-            NetWorkManager().add_message(GetMerkle([each['tx_hash'], each['height']]), self.get_merkle_callback)
-        # for tx in TxStore().unfetch_tx:
-            NetWorkManager().add_message(Get([each['tx_hash']]), self.get_tx_callback)
-
     @gen.coroutine
     def get_merkle_callback(self, msg_id, msg, param):
         tx_hash = msg['params'][0]
@@ -193,19 +179,6 @@ class HDWatchOnlyWallet(BaseWallet):
         self.storage.put('keystore', self.keystore.dump())
         self.storage.write()
 
-    def sync(self):
-        for address in (self.receiving_addresses + self.change_addresses):
-            NetWorkManager().add_message(GetHistory([address]), self.history_callback)
-
-    @gen.coroutine
-    def history_callback(self, msg_id, msg, param):
-        for each in param:
-            TxStore().add(msg['params'][0], each['tx_hash'], each['height'])
-        # for tx, height in TxStore().unverify_tx_list:
-            NetWorkManager().add_message(GetMerkle([each['tx_hash'], each['height']]), self.get_merkle_callback)
-        # for tx in TxStore().unfetch_tx:
-            NetWorkManager().add_message(Get([each['tx_hash']]), self.get_tx_callback)
-
     @gen.coroutine
     def get_merkle_callback(self, msg_id, msg, param):
         tx_hash = msg['params'][0]
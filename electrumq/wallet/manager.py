@@ -9,6 +9,7 @@ from appdirs import AppDirs
 from sortedcontainers import SortedDict
 
 from electrumq.chain.chain import BlockChain
+from electrumq.db.block import BlockStore
 from electrumq.db.sqlite import init
 from electrumq.net.manager import NetWorkManager
 from electrumq.utils import Singleton
@@ -57,6 +58,7 @@ class Wallet(object):
         set_testnet()
         # logging.config.fileConfig(log_conf_path)
         init()
+        BlockStore().start_verify_pool()  # forks, so before the ioloop threads
         network = NetWorkManager()
         network.start()
         BlockChain().init_header()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+BlockStore backends, bulk ingest of chunks and header lookups, and chunk verification
+
+usage: python -m tests.bench_blockstore [chunks] [lookups]
+       python -m tests.bench_blockstore verify [chunks] [processes]
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from electrumq.db import sqlite
+from electrumq.db.sqlite import BlockItem
+from electrumq.db.flat.block import BlockStore as FlatBlockStore
+from electrumq.db.sqlite.block import BlockStore as SqliteBlockStore
+from electrumq.db.verify import check_chunk, next_context
+from tests.fake_server import SyntheticChain
+
+__author__ = 'zhouqi'
+
+
+def timed(func, *args):
+    begin = time.time()
+    func(*args)
+    return time.time() - begin
+
+
+def bench(store, chain, chunk_cnt, lookups):
+    """
+    :return: (ingest seconds, get_block seconds, get_block_root seconds, height seconds)
+    """
+
+    def ingest():
+        for idx in xrange(chunk_cnt):
+            assert store.connect_chunk(idx, chain.chunk(idx))
+
+    def get_block():
+        for height in lookups:
+            store.get_block(height)
+
+    def get_block_root():
+        for height in lookups:
+            store.get_block_root(height)
+
+    def height():
+        for _ in lookups:
+            store.height
+
+    return timed(ingest), timed(get_block), timed(get_block_root), timed(height)
+
+
+def bench_verify(chunk_cnt, processes):
+    """
+    parsing every header to a BlockItem, as verify_chunk did, against check_chunk
+    serially and in a pool of processes; synthetic headers have no proof of work,
+    so the chunks are checked for linkage, which hashes every header all the same
+    """
+    import multiprocessing
+    chain = SyntheticChain(chunk_cnt * 2016 - 1)
+    chunks = [chain.chunk(idx) for idx in xrange(chunk_cnt)]
+    args = []
+    context = ('\0' * 32, None, None)
+    for data in chunks:
+        args.append((data,) + context)
+        context = next_context(data)
+
+    def parse():
+        for data in chunks:
+            for i in xrange(len(data) / 80):
+                BlockItem(data[i * 80:(i + 1) * 80])
+
+    def serial():
+        assert None not in map(check_chunk, args)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        pool.map(check_chunk, args[:processes])  # warm up the workers
+        print '%-10s %10s %12s' % ('verify', 'cost(s)', 'headers/s')
+        for name, func in (('BlockItem', parse), ('serial', serial),
+                           ('pool(%d)' % processes, lambda: None not in pool.map(check_chunk, args))):
+            cost = timed(func)
+            print '%-10s %10.3f %12.0f' % (name, cost, chain.height / cost)
+    finally:
+        pool.terminate()
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'verify':
+        bench_verify(int(sys.argv[2]) if len(sys.argv) > 2 else 20,
+                     int(sys.argv[3]) if len(sys.argv) > 3 else 4)
+        return
+    chunk_cnt = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    lookup_cnt = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    chain = SyntheticChain(chunk_cnt * 2016 - 1)
+    lookups = [random.randint(0, chain.height) for _ in xrange(lookup_cnt)]
+    path = tempfile.mkdtemp()
+    try:
+        sqlite.sqlite_path = os.path.join(path, 'tx.sqlite')
+        sqlite.init()
+        SqliteBlockStore().clear_cache()
+        flat = FlatBlockStore()
+        flat.open(os.path.join(path, 'headers.dat'))
+        print '%-8s %8s %10s %12s %12s %12s %12s' % (
+            'backend', 'headers', 'ingest(s)', 'headers/s', 'get_block', 'block_root', 'height')
+        print '%-8s %8s %10s %12s %12s %12s %12s' % ('', '', '', '', '(us/op)', '(us/op)', '(us/op)')
+        for name, store in (('sqlite', SqliteBlockStore()), ('flat', flat)):
+            ingest, get_block, get_block_root, height = bench(store, chain, chunk_cnt, lookups)
+            print '%-8s %8d %10.3f %12.0f %12.1f %12.1f %12.1f' % (
+                name, chain.height + 1, ingest, (chain.height + 1) / ingest,
+                get_block / lookup_cnt * 1e6, get_block_root / lookup_cnt * 1e6,
+                height / lookup_cnt * 1e6)
+        flat.close()
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
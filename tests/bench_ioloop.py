@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+handoff latency and throughput of IOLoop.add_future under producer threads
+
+usage: python -m tests.bench_ioloop [threads] [count]
+"""
+import sys
+import threading
+import time
+
+from tornado.concurrent import Future
+
+from electrumq.net.ioloop import IOLoop
+
+__author__ = 'zhouqi'
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def bench_throughput(threads, count):
+    """
+    every producer hands `count` done futures to the ioloop as fast as it can
+    :return: (number of callbacks run, total seconds)
+    """
+    ioloop = IOLoop()
+    ioloop.start()
+    total = threads * count
+    cnt = [0]
+    done = threading.Event()
+
+    def callback(future):
+        cnt[0] += 1
+        if cnt[0] == total:
+            done.set()
+
+    def produce():
+        for _ in xrange(count):
+            future = Future()
+            future.set_result(None)
+            ioloop.add_future(future, callback)
+
+    begin = time.time()
+    run_producers(threads, produce)
+    done.wait(60)
+    elapsed = time.time() - begin
+    ioloop.quit()
+    return cnt[0], elapsed
+
+
+def bench_latency(threads, count):
+    """
+    every producer hands one future at a time and waits for its callback
+    :return: latency list
+    """
+    ioloop = IOLoop()
+    ioloop.start()
+    cost = []
+
+    def produce():
+        for _ in xrange(count):
+            event = threading.Event()
+            future = Future()
+            future.set_result(None)
+            begin = time.time()
+            ioloop.add_future(future, lambda f: event.set())
+            event.wait(5)
+            cost.append(time.time() - begin)
+
+    run_producers(threads, produce)
+    ioloop.quit()
+    return cost
+
+
+def run_producers(threads, produce):
+    producers = [threading.Thread(target=produce) for _ in xrange(threads)]
+    for each in producers:
+        each.start()
+    for each in producers:
+        each.join()
+
+
+def main(threads=8, count=10000):
+    cnt, elapsed = bench_throughput(threads, count)
+    print 'throughput: %d threads x %d futures, %d callbacks in %.3fs, %.0f futures/s' \
+          % (threads, count, cnt, elapsed, cnt / elapsed)
+    cost = bench_latency(threads, max(1, count / 100))
+    print 'latency: %d threads x %d futures, p50 %.3fms p99 %.3fms max %.3fms' \
+          % (threads, len(cost) / threads, percentile(cost, 0.5) * 1000,
+             percentile(cost, 0.99) * 1000, max(cost) * 1000)
+
+
+if __name__ == '__main__':
+    main(*[int(each) for each in sys.argv[1:3]])
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+network benchmarks against a local stand-in electrum server
+
+usage: python -m tests.bench_network [latency|batch|flush] [count]
+"""
+import json
+import sys
+import threading
+import time
+
+from tornado import gen
+
+from electrumq.message.blockchain.transaction import GetMerkle, Broadcast
+from electrumq.message.server import Version
+from electrumq.net.client import RPCClient
+from electrumq.net.framing import FrameBuffer
+from electrumq.net.ioloop import IOLoop
+from tests.fake_server import start_fake_server, stop_fake_server
+
+__author__ = 'zhouqi'
+
+
+def wait_future(future, timeout=10):
+    event = threading.Event()
+    future.add_done_callback(lambda f: event.set())
+    event.wait(timeout)
+    return future.result()
+
+
+def connect_client(port, **kwargs):
+    ioloop = IOLoop()
+    ioloop.start()
+    client = RPCClient(ioloop=ioloop, ip='127.0.0.1', port=port)
+    for k, v in kwargs.items():
+        setattr(client, k, v)
+    assert wait_future(client.connect_with_future())
+    return ioloop, client
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def bench_round_trip(port, count, wakeup):
+    ioloop, client = connect_client(port, wakeup=wakeup)
+    cost = []
+    for _ in xrange(count):
+        event = threading.Event()
+
+        @gen.coroutine
+        def version_callback(msg_id, msg, result):
+            event.set()
+
+        begin = time.time()
+        client.add_message(Version(['2.8.3', '0.10']), version_callback)
+        event.wait(5)
+        cost.append(time.time() - begin)
+    ioloop.quit()
+    return cost
+
+
+def bench_throughput(port, count, batch_size):
+    ioloop, client = connect_client(port, batch_size=batch_size)
+    event = threading.Event()
+    done = [0]
+
+    @gen.coroutine
+    def merkle_callback(msg_id, msg, result):
+        done[0] += 1
+        if done[0] == count:
+            event.set()
+
+    begin = time.time()
+    for i in xrange(count):
+        client.add_message(GetMerkle(['%064x' % i, 100000]), merkle_callback)
+    event.wait(60)
+    cost = time.time() - begin
+    ioloop.quit()
+    return done[0], cost
+
+
+def main_latency(port, count):
+    print '%-10s %8s %10s %10s %10s' % ('mode', 'count', 'mean(ms)', 'p50(ms)', 'p95(ms)')
+    for mode, wakeup in (('polling', False), ('wakeup', True)):
+        cost = bench_round_trip(port, count, wakeup)
+        print '%-10s %8d %10.2f %10.2f %10.2f' % (
+            mode, count, sum(cost) / len(cost) * 1000, percentile(cost, 0.5) * 1000,
+            percentile(cost, 0.95) * 1000)
+
+
+def main_batch(port, count, server):
+    print '%-10s %8s %8s %10s %10s' % ('batch', 'count', 'frames', 'cost(s)', 'msg/s')
+    for batch_size in (0, 10, 100):
+        frame_cnt = server.frame_cnt
+        done, cost = bench_throughput(port, count, batch_size)
+        print '%-10d %8d %8d %10.3f %10.0f' % (
+            batch_size, done, server.frame_cnt - frame_cnt, cost, done / cost)
+
+
+class NullStream(object):
+    def __init__(self):
+        self.writes = []
+
+    def write(self, content):
+        self.writes.append(len(content))
+
+
+def legacy_flush(messages):
+    content = ''
+    for msg in messages:
+        content += json.dumps(msg).replace(' ', '') + '\n'
+    return content
+
+
+def framing_flush(messages):
+    frames = FrameBuffer()
+    chunks = []
+    for msg in messages:
+        frames.append(msg)
+        if frames.is_full():
+            chunks.append(frames.take())
+    chunks.append(frames.take())
+    return chunks
+
+
+def bench_flush(count, raw_tx):
+    """
+    :return: (seconds of send_all, framing only, legacy framing only, sizes of writes)
+    """
+    client = RPCClient(ioloop=None)
+    for _ in xrange(count):
+        client.add_message(Broadcast([raw_tx]))
+    messages = [dict(each) for each in client._message_list]
+    client.stream = NullStream()
+    client.is_connected = True
+    begin = time.time()
+    client.send_all()
+    cost = time.time() - begin
+    begin = time.time()
+    framing_flush(messages)
+    framing = time.time() - begin
+    begin = time.time()
+    legacy_flush(messages)
+    return cost, framing, time.time() - begin, client.stream.writes
+
+
+def main_flush(count):
+    print '%-9s %7s %7s %12s %11s %10s %8s' % ('tx bytes', 'count', 'writes', 'send_all(s)',
+                                               'framing(s)', 'legacy(s)', 'speedup')
+    for size in (250, 2500):
+        cost, framing, legacy, writes = bench_flush(count, '00' * size)
+        print '%-9d %7d %7d %12.3f %11.3f %10.3f %8.1f' % (
+            size, count, len(writes), cost, framing, legacy, legacy / framing)
+
+
+def main():
+    bench = sys.argv[1] if len(sys.argv) > 1 else 'latency'
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else (10 if bench == 'latency' else 5000)
+    if bench == 'flush':
+        main_flush(count if len(sys.argv) > 2 else 10000)
+        return
+    server_loop, server, port = start_fake_server({
+        'blockchain.transaction.get_merkle': {'block_height': 100000, 'merkle': [], 'pos': 0}})
+    try:
+        if bench == 'latency':
+            main_latency(port, count)
+        elif bench == 'batch':
+            main_batch(port, count, server)
+    finally:
+        stop_fake_server(server_loop, server)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+reorgs of synthetic forks through the ForkTree: latency of the switch by depth, and
+the headers left in the tree
+
+usage: python -m tests.bench_reorg [depths] [rounds]
+       depths separated by comma, 1,6,20 and the deepest one followed by default
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from electrumq.chain.forks import ForkTree
+from electrumq.db import sqlite
+from electrumq.db.flat.block import BlockStore as FlatBlockStore
+from electrumq.db.sqlite import BlockItem
+from electrumq.db.sqlite.block import BlockStore as SqliteBlockStore
+from electrumq.utils.parameter import set_testnet
+from tests.bench_network import percentile
+from tests.fake_server import SyntheticChain
+
+__author__ = 'zhouqi'
+
+
+def block_at(chain, height):
+    block = BlockItem(chain.headers[height])
+    block.block_no = height
+    return block
+
+
+def bench(store, chain, depth, rounds):
+    """
+    every round a branch forking depth blocks below the tip gets one block more than
+    the main chain
+    :return: (switch seconds of each round, headers in the tree at the end)
+    """
+    forks = ForkTree(store)
+    latency = []
+    for idx in xrange(rounds):
+        tip = store.height
+        fork = chain.fork(tip - depth, depth + 1, salt='round%d' % idx)
+        for height in xrange(tip - depth + 1, tip + 1):
+            forks.connect(block_at(fork, height))
+        begin = time.time()
+        assert forks.connect(block_at(fork, tip + 1))
+        latency.append(time.time() - begin)
+        chain = fork
+    return latency, len(forks)
+
+
+def main():
+    depths = [int(d) for d in sys.argv[1].split(',')] \
+        if len(sys.argv) > 1 else [1, 6, 20, ForkTree.max_depth - 1]
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    set_testnet()
+    print '%-8s %6s %7s %10s %10s %10s %6s' % (
+        'backend', 'depth', 'rounds', 'p50(ms)', 'p95(ms)', 'max(ms)', 'nodes')
+    for depth in depths:
+        path = tempfile.mkdtemp()
+        try:
+            sqlite.sqlite_path = os.path.join(path, 'tx.sqlite')
+            sqlite.init()
+            SqliteBlockStore().clear_cache()
+            flat = FlatBlockStore()
+            flat.open(os.path.join(path, 'headers.dat'))
+            for name, store in (('sqlite', SqliteBlockStore()), ('flat', flat)):
+                chain = SyntheticChain(2016 * 2 - 1)
+                assert store.connect_chunks(0, [chain.chunk(0), chain.chunk(1)]) == 2
+                latency, nodes = bench(store, chain, depth, rounds)
+                print '%-8s %6d %7d %10.2f %10.2f %10.2f %6d' % (
+                    name, depth, rounds, percentile(latency, 0.5) * 1000,
+                    percentile(latency, 0.95) * 1000, max(latency) * 1000, nodes)
+            flat.close()
+        finally:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
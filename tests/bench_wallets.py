@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+load driver, N synthetic wallets syncing through NetWorkManager against local
+stand-in electrum servers
+
+usage: python -m tests.bench_wallets [wallets] [addresses] [latency_ms] [jitter_ms] [drop_rate] [servers]
+"""
+import hashlib
+import sys
+import threading
+import time
+
+from tornado import gen
+
+from electrumq.message.all import address_subscribe, GetHistory, Get, GetMerkle
+from electrumq.net.ioloop import MAX_WAIT_SECONDS_BEFORE_SHUTDOWN
+from electrumq.net.manager import NetWorkManager
+from electrumq.net.metrics import MetricsRegistry
+from tests.bench_network import percentile
+from tests.fake_server import start_fake_server, stop_fake_server, electrum_results
+
+__author__ = 'zhouqi'
+
+
+class SyntheticWallet(object):
+    """
+    the requests of a wallet sync: subscribe every address, fetch the history
+    of the ones with a status, then every tx and its merkle branch
+    """
+
+    def __init__(self, driver, name, address_cnt):
+        self.driver = driver
+        self.addresses = [hashlib.sha256('%s:%d' % (name, idx)).hexdigest()[:34]
+                          for idx in xrange(address_cnt)]
+        self.pending = 0
+        self.done = False
+
+    def start(self):
+        for address in self.addresses:
+            self.request(address_subscribe([address]), self.status_callback)
+
+    def request(self, message, callback):
+        self.pending += 1
+        self.driver.request(message, callback)
+
+    def finish_one(self):
+        self.pending -= 1
+        if self.pending == 0:
+            self.done = True
+            self.driver.wallet_done(self)
+
+    @gen.coroutine
+    def status_callback(self, msg_id, msg, status):
+        if status is not None:
+            self.request(GetHistory(msg['params']), self.history_callback)
+        self.finish_one()
+
+    @gen.coroutine
+    def history_callback(self, msg_id, msg, history):
+        for item in history:
+            self.request(Get([item['tx_hash']]), self.tx_callback)
+            self.request(GetMerkle([item['tx_hash'], item['height']]), self.tx_callback)
+        self.finish_one()
+
+    @gen.coroutine
+    def tx_callback(self, msg_id, msg, result):
+        self.finish_one()
+
+
+class LoadDriver(object):
+    def __init__(self, manager, wallet_cnt, address_cnt):
+        self.manager = manager
+        self.wallets = [SyntheticWallet(self, 'wallet%d' % idx, address_cnt)
+                        for idx in xrange(wallet_cnt)]
+        self.latency = []
+        self.done_cnt = 0
+        self.finished = threading.Event()
+
+    def request(self, message, callback):
+        begin = time.time()
+
+        def timed_callback(msg_id, msg, result):
+            self.latency.append(time.time() - begin)
+            return callback(msg_id, msg, result)
+
+        self.manager.add_message(message, timed_callback)
+
+    def wallet_done(self, wallet):
+        self.done_cnt += 1
+        if self.done_cnt == len(self.wallets):
+            self.finished.set()
+
+    def start(self):
+        for wallet in self.wallets:
+            wallet.start()
+
+    def run(self, timeout=60):
+        """
+        :return: dict of wallets, wallets done, requests, seconds, requests/s and latency percentiles
+        """
+        begin = time.time()
+        self.manager.ioloop.add_callback(self.start)
+        self.finished.wait(timeout)
+        cost = time.time() - begin
+        latency = list(self.latency)
+        stats = {'wallets': len(self.wallets), 'done': self.done_cnt,
+                 'requests': len(latency), 'seconds': cost,
+                 'throughput': len(latency) / cost if cost > 0 else 0.0}
+        for p in (0.5, 0.95, 0.99):
+            stats['p%d' % int(p * 100)] = percentile(latency, p) if latency else None
+        return stats
+
+
+def run_load(wallet_cnt=20, address_cnt=5, latency=0, jitter=0, drop_rate=0.0, server_cnt=1,
+             timeout=60):
+    servers = [start_fake_server(electrum_results(), latency=latency, jitter=jitter,
+                                 drop_rate=drop_rate, seed=idx) for idx in xrange(server_cnt)]
+    manager = NetWorkManager()
+    saved = (manager.pool_size, manager.cache_enabled, manager.request_timeout,
+             manager.retries, manager.probe)
+    manager.pool_size = server_cnt
+    manager.cache_enabled = False
+    manager.probe = False
+    manager.metrics = MetricsRegistry()
+    if drop_rate > 0:
+        # dropped requests time out and go to another server
+        manager.request_timeout = max(0.5, (latency + jitter) * 4)
+        manager.retries = 10
+    try:
+        manager.start(servers=[('127.0.0.1', port) for _, _, port in servers])
+        deadline = time.time() + 5
+        while not all(c.is_connected for c in manager.pool.clients) and time.time() < deadline:
+            time.sleep(0.01)
+        stats = LoadDriver(manager, wallet_cnt, address_cnt).run(timeout)
+        stats['dropped'] = sum(server.drop_cnt for _, server, _ in servers)
+        return stats
+    finally:
+        manager.quit()
+        time.sleep(MAX_WAIT_SECONDS_BEFORE_SHUTDOWN + 0.01)
+        manager.pool_size, manager.cache_enabled, manager.request_timeout, \
+            manager.retries, manager.probe = saved
+        for server_loop, server, _ in servers:
+            stop_fake_server(server_loop, server)
+
+
+def main():
+    args = sys.argv[1:]
+    wallet_cnt = int(args[0]) if len(args) > 0 else 20
+    address_cnt = int(args[1]) if len(args) > 1 else 5
+    latency = float(args[2]) / 1000 if len(args) > 2 else 0
+    jitter = float(args[3]) / 1000 if len(args) > 3 else 0
+    drop_rate = float(args[4]) if len(args) > 4 else 0.0
+    server_cnt = int(args[5]) if len(args) > 5 else 1
+    stats = run_load(wallet_cnt, address_cnt, latency, jitter, drop_rate, server_cnt)
+    print '%8s %6s %9s %9s %10s %9s %9s %9s %8s' % (
+        'wallets', 'done', 'requests', 'cost(s)', 'req/s', 'p50(ms)', 'p95(ms)', 'p99(ms)',
+        'dropped')
+    print '%8d %6d %9d %9.3f %10.0f %9.2f %9.2f %9.2f %8d' % (
+        stats['wallets'], stats['done'], stats['requests'], stats['seconds'],
+        stats['throughput'], (stats['p50'] or 0) * 1000, (stats['p95'] or 0) * 1000,
+        (stats['p99'] or 0) * 1000, stats['dropped'])
+    if stats['done'] < stats['wallets']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
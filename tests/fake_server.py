@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import random
+import struct
+import threading
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.httpserver import HTTPServer
+from tornado.iostream import StreamClosedError
+from tornado.netutil import bind_sockets
+from tornado.tcpserver import TCPServer
+from tornado.web import Application
+
+import download_server
+
+__author__ = 'zhouqi'
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), 'data', 'electrum_fixtures.json')
+
+DEFAULT_RESULTS = {
+    'server.version': 'ElectrumX 1.0.17',
+    'server.banner': 'fake electrum server',
+    'blockchain.numblocks.subscribe': 0,
+    'blockchain.headers.subscribe': {'block_height': 0},
+}
+
+
+def double_sha256(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+class SyntheticChain(object):
+    """
+    deterministic chain of linked 80-byte headers, without proof of work
+    """
+
+    def __init__(self, height, seed=0):
+        self.seed = seed
+        self.headers = []
+        self.extend(height + 1)
+
+    @property
+    def height(self):
+        return len(self.headers) - 1
+
+    def extend(self, cnt, salt=''):
+        for _ in xrange(cnt):
+            height = len(self.headers)
+            prev = double_sha256(self.headers[-1]) if self.headers else '\0' * 32
+            root = hashlib.sha256('%s:%d:%s' % (self.seed, height, salt)).digest()
+            self.headers.append(struct.pack('<I32s32sIII', 1, prev, root,
+                                            1231006505 + height * 600, 0x1d00ffff, height))
+
+    def fork(self, height, cnt, salt='fork'):
+        """
+        a copy sharing the headers up to height, then cnt headers of its own
+        """
+        chain = SyntheticChain(-1, self.seed)
+        chain.headers = self.headers[:height + 1]
+        chain.extend(cnt, salt)
+        return chain
+
+    def header_hash(self, height):
+        return double_sha256(self.headers[height])[::-1].encode('hex')
+
+    def header_dict(self, height):
+        ver, prev, root, timestamp, bits, nonce = struct.unpack('<I32s32sIII', self.headers[height])
+        return {'block_height': height, 'version': ver,
+                'prev_block_hash': prev[::-1].encode('hex'),
+                'merkle_root': root[::-1].encode('hex'),
+                'timestamp': timestamp, 'bits': bits, 'nonce': nonce}
+
+    def chunk(self, idx):
+        return ''.join(self.headers[idx * 2016:(idx + 1) * 2016])
+
+    def results(self):
+        return {
+            'blockchain.headers.subscribe': lambda params: self.header_dict(self.height),
+            'blockchain.numblocks.subscribe': lambda params: self.height,
+            'blockchain.block.get_header': lambda params: self.header_dict(params[0]),
+            'blockchain.block.get_chunk': lambda params: self.chunk(params[0]).encode('hex'),
+        }
+
+
+class SyntheticWallets(object):
+    """
+    history of any address made up from its hash: tx_per_address txs in the chain,
+    each with a merkle branch and the same raw tx
+    """
+
+    def __init__(self, chain, tx_per_address=3, raw_tx=None):
+        self.chain = chain
+        self.tx_per_address = tx_per_address
+        self.raw_tx = raw_tx if raw_tx is not None else '01000000' + '00' * 56
+
+    def history(self, address):
+        result = []
+        for idx in xrange(self.tx_per_address):
+            digest = hashlib.sha256('%s:%d' % (address, idx)).hexdigest()
+            result.append({'tx_hash': digest,
+                           'height': 1 + int(digest[:8], 16) % max(1, self.chain.height)})
+        return result
+
+    def status(self, address):
+        history = self.history(address)
+        if not history:
+            return None
+        return hashlib.sha256(''.join('%s:%d:' % (h['tx_hash'], h['height'])
+                                      for h in history)).hexdigest()
+
+    def merkle(self, tx_hash, height):
+        return {'block_height': height, 'pos': int(tx_hash[:4], 16) % 64,
+                'merkle': [hashlib.sha256('%s:%d' % (tx_hash, i)).hexdigest() for i in xrange(6)]}
+
+    def results(self):
+        return {
+            'blockchain.address.subscribe': lambda params: self.status(params[0]),
+            'blockchain.address.get_history': lambda params: self.history(params[0]),
+            'blockchain.transaction.get': lambda params: self.raw_tx,
+            'blockchain.transaction.get_merkle': lambda params: self.merkle(*params),
+        }
+
+
+def load_fixtures(path=FIXTURES_PATH, fallback=None):
+    """
+    results replaying the recorded replies of path, {method: {json params or '*': result}},
+    params without a recorded reply go to fallback[method]
+    """
+    fixtures = json.loads(open(path).read())
+    if fallback is None:
+        fallback = {}
+    results = dict(fallback)
+
+    def replay(method, params):
+        recorded = fixtures[method]
+        key = json.dumps(params)
+        if key in recorded:
+            return recorded[key]
+        if '*' in recorded:
+            return recorded['*']
+        result = fallback.get(method)
+        return result(params) if callable(result) else result
+
+    for method in fixtures:
+        results[method] = lambda params, method=method: replay(method, params)
+    return results
+
+
+def electrum_results(height=5000, tx_per_address=3, path=FIXTURES_PATH):
+    """
+    recorded fixtures first, then a synthetic chain of height and synthetic wallets
+    """
+    chain = SyntheticChain(height)
+    fallback = chain.results()
+    fallback.update(SyntheticWallets(chain, tx_per_address).results())
+    return load_fixtures(path, fallback)
+
+
+class FakeElectrumServer(TCPServer):
+    """
+    stand-in electrum server, answer every newline-delimited json-rpc request
+    with a canned result from `results` (value or callable of params), methods
+    in `no_reply` are never answered and the ones in `errors` answered with their
+    error (value or callable of params); replies wait latency plus up to jitter
+    seconds, and drop_rate of the requests are never answered
+    """
+    latency = 0
+    jitter = 0
+    drop_rate = 0.0
+
+    def __init__(self, results=None, io_loop=None, seed=None):
+        TCPServer.__init__(self, io_loop=io_loop)
+        self.results = dict(DEFAULT_RESULTS)
+        if results is not None:
+            self.results.update(results)
+        self.request_cnt = 0
+        self.frame_cnt = 0
+        self.drop_cnt = 0
+        self.method_cnt = {}
+        self.no_reply = set()
+        self.errors = {}
+        self.streams = set()
+        self.random = random.Random(seed)
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        self.streams.add(stream)
+        stream.set_close_callback(lambda: self.streams.discard(stream))
+        while True:
+            try:
+                line = yield stream.read_until(b'\n')
+            except StreamClosedError:
+                break
+            request = json.loads(line)
+            self.frame_cnt += 1
+            if isinstance(request, list):
+                response = [self.reply(each) for each in request]
+                response = [each for each in response if each is not None]
+            else:
+                response = self.reply(request)
+            if not response:
+                continue
+            delay = self.latency + self.random.random() * self.jitter
+            if delay > 0:
+                # replies of a slow server may overtake each other
+                self.io_loop.call_later(delay, self.write, stream, response)
+                continue
+            try:
+                yield stream.write(json.dumps(response) + '\n')
+            except StreamClosedError:
+                break
+
+    def write(self, stream, response):
+        if stream.closed():
+            return
+        try:
+            stream.write(json.dumps(response) + '\n')
+        except StreamClosedError:
+            pass
+
+    def reply(self, request):
+        self.request_cnt += 1
+        self.method_cnt[request['method']] = self.method_cnt.get(request['method'], 0) + 1
+        if request['method'] in self.no_reply:
+            return None
+        if self.drop_rate > 0 and self.random.random() < self.drop_rate:
+            self.drop_cnt += 1
+            return None
+        if request['method'] in self.errors:
+            error = self.errors[request['method']]
+            if callable(error):
+                error = error(request['params'])
+            return {'jsonrpc': '2.0', 'id': request['id'], 'error': error}
+        result = self.results.get(request['method'])
+        if callable(result):
+            result = result(request['params'])
+        return {'jsonrpc': '2.0', 'id': request['id'], 'result': result}
+
+    def drop_connections(self):
+        for stream in list(self.streams):
+            stream.close()
+
+    def notify(self, method, params):
+        for stream in list(self.streams):
+            stream.write(json.dumps({'jsonrpc': '2.0', 'method': method, 'params': params}) + '\n')
+
+
+def start_fake_server(results=None, latency=0, jitter=0, drop_rate=0.0, seed=None):
+    """
+    run a fake server on its own ioloop thread
+    :return: (ioloop, server, port)
+    """
+    ioloop = IOLoop(make_current=False)
+    server = FakeElectrumServer(results, io_loop=ioloop, seed=seed)
+    server.latency, server.jitter, server.drop_rate = latency, jitter, drop_rate
+    sockets = bind_sockets(0, '127.0.0.1')
+    port = sockets[0].getsockname()[1]
+    server.add_sockets(sockets)
+    thread = threading.Thread(target=ioloop.start)
+    thread.daemon = True
+    thread.start()
+    return ioloop, server, port
+
+
+def stop_fake_server(ioloop, server):
+    def stop():
+        server.stop()
+        ioloop.stop()
+
+    ioloop.add_callback(stop)
+
+
+def start_download_server(path):
+    """
+    run the bundled download_server serving files of path on its own ioloop thread
+    :return: (ioloop, server, port)
+    """
+    ioloop = IOLoop(make_current=False)
+    server = HTTPServer(Application(download_server.make_routings(path)), io_loop=ioloop)
+    sockets = bind_sockets(0, '127.0.0.1')
+    port = sockets[0].getsockname()[1]
+    server.add_sockets(sockets)
+    thread = threading.Thread(target=ioloop.start)
+    thread.daemon = True
+    thread.start()
+    return ioloop, server, port
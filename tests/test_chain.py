@@ -1,15 +1,29 @@
 # -*- coding: utf-8 -*-
+import os
+import random
+import shutil
+import tempfile
 from unittest import TestCase
 
 from tornado import gen
 from tornado.concurrent import Future
 from tornado.testing import AsyncTestCase, gen_test
 
+from electrumq.chain.catchup import ChunkScheduler
 from electrumq.chain.chain import BlockChain, BLOCK_INTERVAL
+from electrumq.chain.forks import ForkTree
+from electrumq.db import sqlite
+from electrumq.db.sqlite import BlockItem
+from electrumq.db.flat.block import BlockStore as FlatBlockStore
 from electrumq.db.sqlite.block import BlockStore
+from electrumq.db.sqlite.tx import TxStore
+from electrumq.db.verify import check_chunk, header_hash, bits_to_target, target_to_bits, retarget, \
+    MAX_TARGET, TARGET_TIMESPAN
 from electrumq.net.ioloop import MAX_WAIT_SECONDS_BEFORE_SHUTDOWN
 from electrumq.net.manager import NetWorkManager
-from electrumq.utils.parameter import set_testnet
+from electrumq.utils.exception import ChunkException
+from electrumq.utils.parameter import set_testnet, Parameter
+from tests.fake_server import SyntheticChain
 from tests.test_network import open_logger
 
 __author__ = 'zhouqi'
@@ -37,6 +51,78 @@ class HowToUseChain(AsyncTestCase):
         bc.init_header_callback(future)
 
 
+class TestChunkScheduler(AsyncTestCase):
+    def setUp(self):
+        super(TestChunkScheduler, self).setUp()
+        self.committed = []
+        self.requested = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.bad = set()  # chunks failing once
+
+    @gen.coroutine
+    def fetch(self, idx):
+        self.requested.append(idx)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            yield gen.sleep(random.random() * 0.01)  # arrive out of order
+        finally:
+            self.in_flight -= 1
+        if idx in self.bad:
+            self.bad.discard(idx)
+            raise gen.TimeoutError('chunk %d timed out' % idx)
+        raise gen.Return(chr(idx) * 80 * BLOCK_INTERVAL)
+
+    def commit(self, idx, data):
+        self.assertEqual(data[0], chr(idx))
+        self.committed.append(idx)
+        return True
+
+    @gen_test(timeout=10)
+    def test_ordered_commit(self):
+        self.bad = {3, 7}
+        scheduler = ChunkScheduler(2, 40, self.fetch, self.commit, window=4)
+        cnt = yield scheduler.run()
+        self.assertEqual(self.committed, range(2, 41))
+        self.assertEqual(cnt, 39 * BLOCK_INTERVAL)
+        self.assertLessEqual(self.max_in_flight, 4)
+        # only the failed chunks are requested again
+        self.assertEqual(sorted(self.requested), sorted(range(2, 41) + [3, 7]))
+        self.assertEqual(scheduler.stats()['retries'], 2)
+        self.assertGreater(scheduler.stats()['headers_per_sec'], 0)
+
+    @gen_test(timeout=10)
+    def test_commit_failed(self):
+        rejected = set([5])
+
+        def commit(idx, data):
+            if idx in rejected:
+                rejected.discard(idx)
+                return False
+            self.committed.append(idx)
+            return True
+
+        scheduler = ChunkScheduler(0, 9, self.fetch, commit, window=3)
+        yield scheduler.run()
+        self.assertEqual(self.committed, range(10))
+        self.assertEqual(self.requested.count(5), 2)
+
+    @gen_test(timeout=10)
+    def test_give_up(self):
+        @gen.coroutine
+        def fetch(idx):
+            if idx == 3:
+                raise gen.TimeoutError('chunk 3 timed out')
+            raise gen.Return(chr(idx) * 80)
+
+        scheduler = ChunkScheduler(0, 9, fetch, self.commit, window=3)
+        scheduler.retries = 2
+        with self.assertRaises(ChunkException):
+            yield scheduler.run()
+        self.assertEqual(self.committed, [0, 1, 2])
+
+
 open_logger('blockstore')
 
 
@@ -59,3 +145,282 @@ class TestBockStore(TestCase):
             BlockStore().connect_raw_header(data[idx * 80 * BLOCK_INTERVAL + i * 80: (
                                                                                      idx + 1) * 80 * BLOCK_INTERVAL + i * 80 + 80],
                                             idx * BLOCK_INTERVAL + i)
+
+
+GENESIS = ('0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12'
+           'b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c').decode('hex')
+BLOCK1 = ('010000006fe28c0ab6f1b372c1a6a246ae63f74f931e8365e15a089c68d6190000000000982051fd1e4ba7'
+          '44bbbe680e1fee14677ba1a3c3540bf7b1cdb606e857233e0e61bc6649ffff001d01e36299').decode('hex')
+
+
+class TestVerify(TestCase):
+    def test_mainnet_headers(self):
+        hashes = check_chunk((GENESIS + BLOCK1, '\0' * 32, 0x1d00ffff, MAX_TARGET))
+        self.assertEqual([h[::-1].encode('hex') for h in hashes],
+                         ['000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f',
+                          '00000000839a8e6886ab5951d76f411475428afc90947ee320161bbf18eb6048'])
+
+    def test_invalid_headers(self):
+        # nonce changed, no proof of work
+        self.assertIsNone(check_chunk((GENESIS[:76] + '\0' * 4, '\0' * 32, 0x1d00ffff, MAX_TARGET)))
+        # bits different from the expected ones
+        self.assertIsNone(check_chunk((GENESIS, '\0' * 32, 0x1c00ffff, bits_to_target(0x1c00ffff))))
+        # not linked
+        self.assertIsNone(check_chunk((BLOCK1 + GENESIS, '\0' * 32, None, None)))
+        self.assertIsNone(check_chunk((GENESIS + BLOCK1[:79], '\0' * 32, None, None)))
+        self.assertEqual(len(check_chunk((GENESIS + BLOCK1, '\0' * 32, None, None))), 2)
+
+    def test_retarget(self):
+        for bits in (0x1d00ffff, 0x1b0404cb, 0x180526fd):
+            self.assertEqual(target_to_bits(bits_to_target(bits)), bits)
+        self.assertEqual(retarget(0, TARGET_TIMESPAN, 0x1b0404cb), (0x1b0404cb, bits_to_target(0x1b0404cb)))
+        # at most 4 times easier, never easier than MAX_TARGET
+        self.assertEqual(retarget(0, TARGET_TIMESPAN * 10, 0x1b0404cb)[0],
+                         target_to_bits(bits_to_target(0x1b0404cb) * 4))
+        self.assertEqual(retarget(0, TARGET_TIMESPAN * 10, 0x1d00ffff)[0], 0x1d00ffff)
+        self.assertEqual(retarget(0, 1, 0x1b0404cb)[0], target_to_bits(bits_to_target(0x1b0404cb) / 4))
+
+
+class BlockStoreCases(object):
+    """
+    the same cases for every BlockStore backend, self.store is set by setUp
+    """
+    chain = SyntheticChain(BLOCK_INTERVAL * 2 + 10)
+
+    def block(self, chain, height):
+        block = BlockItem(chain.headers[height])
+        block.block_no = height
+        return block
+
+    def test_connect_chunk(self):
+        self.assertEqual(self.store.height, -1)
+        self.assertTrue(self.store.connect_chunk(0, self.chain.chunk(0)))
+        self.assertEqual(self.store.height, BLOCK_INTERVAL - 1)
+        for height in (0, 5, BLOCK_INTERVAL - 1):
+            block = self.store.get_block(height)
+            self.assertEqual(block.block_no, height)
+            self.assertEqual(block.block_hash, self.chain.header_hash(height))
+            self.assertEqual(self.store.get_block_root(height),
+                             self.chain.header_dict(height)['merkle_root'])
+        self.assertIsNone(self.store.get_block(BLOCK_INTERVAL))
+
+    def test_unchained_chunk(self):
+        self.assertFalse(self.store.connect_chunk(1, self.chain.chunk(1)))
+        self.assertEqual(self.store.height, -1)
+        self.assertTrue(self.store.connect_chunk(0, self.chain.chunk(0)))
+        self.assertTrue(self.store.connect_chunk(1, self.chain.chunk(1)))
+        # the chunk of the tip is partial
+        self.assertTrue(self.store.connect_chunk(2, self.chain.chunk(2)))
+        self.assertEqual(self.store.height, self.chain.height)
+        self.assertEqual(self.store.get_block(self.chain.height).block_hash,
+                         self.chain.header_hash(self.chain.height))
+
+    def test_connect_raw_header(self):
+        self.store.connect_chunk(0, self.chain.chunk(0))
+        for height in xrange(BLOCK_INTERVAL, BLOCK_INTERVAL + 10):
+            self.store.connect_raw_header(self.chain.headers[height], height)
+        self.assertEqual(self.store.height, BLOCK_INTERVAL + 9)
+        block = self.store.get_block(BLOCK_INTERVAL + 9)
+        self.assertEqual(block.block_hash, self.chain.header_hash(BLOCK_INTERVAL + 9))
+        self.assertEqual(block.block_prev, self.chain.header_hash(BLOCK_INTERVAL + 8))
+        # not connected to the tip
+        self.store.connect_raw_header(self.chain.headers[BLOCK_INTERVAL + 20], BLOCK_INTERVAL + 20)
+        self.assertEqual(self.store.height, BLOCK_INTERVAL + 9)
+
+    def test_reject_fork(self):
+        fork = self.chain.fork(100, BLOCK_INTERVAL * 2)
+        self.assertTrue(self.store.connect_chunk(0, self.chain.chunk(0)))
+        self.assertFalse(self.store.connect_chunk(1, fork.chunk(1)))
+        self.assertEqual(self.store.height, BLOCK_INTERVAL - 1)
+
+    def test_connect_chunks(self):
+        self.store.verify_processes = 2
+        self.store.start_verify_pool()
+        self.addCleanup(self.store.stop_verify_pool)
+        self.assertIsNotNone(self.store.verify_pool())
+        fork = self.chain.fork(BLOCK_INTERVAL * 2 - 1, 10)
+        broken = self.chain.chunk(2)[:400] + fork.chunk(2)[400:800]
+        self.assertEqual(self.store.connect_chunks(0, [self.chain.chunk(0), self.chain.chunk(1), broken]), 2)
+        self.assertEqual(self.store.height, BLOCK_INTERVAL * 2 - 1)
+        self.assertEqual(self.store.connect_chunks(2, [self.chain.chunk(2)]), 1)
+        self.assertEqual(self.store.height, self.chain.height)
+
+    def test_mainnet(self):
+        Parameter().TESTNET = False
+        try:
+            self.assertTrue(self.store.connect_chunk(0, GENESIS + BLOCK1))
+            self.assertEqual(self.store.get_block(1).block_hash,
+                             '00000000839a8e6886ab5951d76f411475428afc90947ee320161bbf18eb6048')
+            # no proof of work
+            self.assertFalse(self.store.connect_chunk(0, self.chain.chunk(0)[:800]))
+        finally:
+            set_testnet()
+
+    def test_reorg(self):
+        reorgs = []
+        forks = ForkTree(self.store, lambda *args: reorgs.append(args))
+        self.store.connect_chunks(0, [self.chain.chunk(0), self.chain.chunk(1)])
+        tip = self.store.height
+        fork = self.chain.fork(tip - 3, 5)
+        for height in xrange(tip - 2, tip + 1):
+            self.assertFalse(forks.connect(self.block(fork, height)))
+        # as much work as the main chain, which stays
+        self.assertEqual(self.store.get_block(tip).block_hash, self.chain.header_hash(tip))
+        self.assertTrue(forks.connect(self.block(fork, tip + 1)))
+        self.assertEqual(self.store.height, tip + 1)
+        self.assertEqual(self.store.get_block(tip - 2).block_hash, fork.header_hash(tip - 2))
+        self.assertEqual(self.store.get_block(tip - 3).block_hash, self.chain.header_hash(tip - 3))
+        fork_height, old, new = reorgs[0]
+        self.assertEqual((fork_height, len(old), len(new)), (tip - 3, 3, 4))
+        self.assertTrue(forks.connect(self.block(fork, tip + 2)))
+        # the replaced blocks are kept, the first branch comes back once longer
+        for height in xrange(tip + 1, tip + 3):
+            self.assertFalse(forks.connect(self.block(self.chain, height)))
+        self.assertTrue(forks.connect(self.block(self.chain, tip + 3)))
+        self.assertEqual(len(reorgs), 2)
+        self.assertEqual(self.store.height, tip + 3)
+        for height in xrange(tip - 3, tip + 4):
+            self.assertEqual(self.store.get_block(height).block_hash, self.chain.header_hash(height))
+
+    def test_fork_tree_bounded(self):
+        forks = ForkTree(self.store)
+        forks.max_depth = 10
+        forks.max_nodes = 5
+        self.store.connect_chunks(0, [self.chain.chunk(0)])
+        tip = self.store.height
+        # forking deeper than max_depth
+        self.assertFalse(forks.connect(self.block(self.chain.fork(tip - 11, 1), tip - 10)))
+        # not connected to anything known
+        self.assertFalse(forks.connect(self.block(self.chain.fork(tip - 5, 5), tip - 3)))
+        self.assertEqual(len(forks), 0)
+        fork = self.chain.fork(tip - 8, 8)
+        for height in xrange(tip - 7, tip):
+            forks.connect(self.block(fork, height))
+        self.assertEqual(len(forks), 5)
+        self.assertNotIn(fork.header_hash(tip - 7), forks)
+        self.assertIn(fork.header_hash(tip - 1), forks)
+        for height in xrange(tip + 1, tip + 10):
+            forks.connect(self.block(self.chain, height))
+        self.assertEqual(len(forks), 0)
+
+class TestSqliteBlockStore(BlockStoreCases, TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.sqlite_path = sqlite.sqlite_path
+        sqlite.sqlite_path = os.path.join(self.dir, 'tx.sqlite')
+        sqlite.init()
+        set_testnet()
+        self.store = BlockStore()
+        self.store.clear_cache()
+
+    def tearDown(self):
+        sqlite.sqlite_path = self.sqlite_path
+        shutil.rmtree(self.dir)
+
+    def test_cache(self):
+        self.store.cache_size = 10
+        self.addCleanup(delattr, self.store, 'cache_size')
+        self.store.connect_chunk(0, self.chain.chunk(0))
+        self.assertEqual(self.store.height, BLOCK_INTERVAL - 1)
+        for height in xrange(BLOCK_INTERVAL, BLOCK_INTERVAL + 5):
+            self.store.connect_raw_header(self.chain.headers[height], height)
+            self.assertEqual(self.store.height, height)
+        # each header found its prev in the cache
+        self.assertEqual(self.store.cache_stats(), {'hits': 5, 'misses': 0, 'size': 6})
+        for height in xrange(20):
+            self.assertEqual(self.store.get_block_root(height),
+                             self.chain.header_dict(height)['merkle_root'])
+        self.assertEqual(self.store.get_block(19).block_hash, self.chain.header_hash(19))
+        self.assertEqual(self.store.cache_stats(), {'hits': 6, 'misses': 20, 'size': 10})
+        self.assertIsNone(self.store.get_block_root(BLOCK_INTERVAL + 5))
+        # another connection changing the table is not seen until the cache is cleared
+        with sqlite.Connection.gen_db() as conn:
+            conn.execute('DELETE FROM blocks WHERE block_no>=?', (10,))
+        self.assertEqual(self.store.height, BLOCK_INTERVAL + 4)
+        self.store.clear_cache()
+        self.assertEqual(self.store.height, 9)
+        self.assertIsNone(self.store.get_block(19))
+
+    def test_rollback(self):
+        self.store.connect_chunks(0, [self.chain.chunk(0), self.chain.chunk(1)])
+        self.assertIsNotNone(self.store.get_block(BLOCK_INTERVAL + 5))
+        self.store.rollback(BLOCK_INTERVAL)
+        self.assertEqual(self.store.height, BLOCK_INTERVAL)
+        self.assertIsNone(self.store.get_block(BLOCK_INTERVAL + 5))
+        self.assertIsNone(self.store.get_block(BLOCK_INTERVAL * 2 - 1))
+
+    def test_reorg_undo_verifications(self):
+        self.store.connect_chunks(0, [self.chain.chunk(0)])
+        tip = self.store.height
+        for tx, height in (('aa', tip - 5), ('bb', tip - 1), ('cc', tip)):
+            TxStore().add('address', tx, height)
+            TxStore().verified_tx(tx)
+        forks = ForkTree(self.store, lambda fork_height, old, new: self.assertEqual(
+            sorted(TxStore().undo_verifications(fork_height + 1)), [('bb', tip - 1), ('cc', tip)]))
+        fork = self.chain.fork(tip - 2, 3)
+        for height in xrange(tip - 1, tip + 2):
+            forks.connect(self.block(fork, height))
+        self.assertEqual(forks.reorg_cnt, 1)
+        self.assertEqual(sorted(TxStore().unverify_tx_list), [('bb', tip - 1), ('cc', tip)])
+
+    def test_need_download(self):
+        from electrumq.net import manager
+        self.addCleanup(setattr, manager, 'headers_dir', manager.headers_dir)
+        manager.headers_dir = self.dir
+        path = NetWorkManager().headers_path()
+        chain = BlockChain()
+        self.assertTrue(chain.need_download(self.store.height))
+        self.store.connect_chunk(0, self.chain.chunk(0))
+        self.assertFalse(chain.need_download(self.store.height))
+        # interrupted, whatever the store has
+        with open(path + '.part', 'wb') as f:
+            f.write(self.chain.chunk(0))
+        self.assertTrue(chain.need_download(self.store.height))
+        os.rename(path + '.part', path)
+        self.assertFalse(chain.need_download(self.store.height))
+        # the file has a chunk the store is below
+        with open(path, 'ab') as f:
+            f.write(self.chain.chunk(1))
+        self.assertTrue(chain.need_download(self.store.height))
+
+    def test_commit_forked_chunk(self):
+        chain = BlockChain()
+        saved = chain.forks
+        chain.forks = ForkTree(self.store)
+        try:
+            self.store.connect_chunks(0, [self.chain.chunk(0), self.chain.chunk(1)])
+            fork = self.chain.fork(BLOCK_INTERVAL * 2 - 30, 40)
+            self.assertEqual(chain.chunk_fork_height(1, fork.chunk(1)), BLOCK_INTERVAL * 2 - 29)
+            self.assertIsNone(chain.chunk_fork_height(1, self.chain.chunk(1)))
+            self.assertFalse(chain.commit_chunk(1, fork.chunk(1)))
+            self.assertTrue(chain.commit_chunk(2, fork.chunk(2)))
+            self.assertEqual(self.store.height, fork.height)
+            self.assertEqual(self.store.get_block(fork.height).block_hash,
+                             fork.header_hash(fork.height))
+        finally:
+            chain.forks = saved
+
+
+class TestFlatBlockStore(BlockStoreCases, TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'headers.dat')
+        set_testnet()
+        self.store = FlatBlockStore()
+        self.store.open(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def test_reopen(self):
+        self.store.connect_chunk(0, self.chain.chunk(0))
+        self.store.connect_chunk(1, self.chain.chunk(1)[:80 * 7])
+        self.store.close()
+        with open(self.path, 'ab') as f:
+            f.write('\0' * 30)  # torn write of the next header
+        self.store.open(self.path)
+        self.assertEqual(self.store.height, BLOCK_INTERVAL + 6)
+        self.assertEqual(self.store.get_block(BLOCK_INTERVAL + 6).block_hash,
+                         self.chain.header_hash(BLOCK_INTERVAL + 6))
+        self.assertEqual(os.path.getsize(self.path), 80 * (BLOCK_INTERVAL + 7))
@@ -1,20 +1,46 @@
 # -*- coding: utf-8 -*-
+import gzip
+import hashlib
+import json
 import logging
+import os
+import shutil
+import socket
 import sys
+import tempfile
+import threading
 import time
 import unittest
 
 from tornado import gen
-from tornado.testing import gen_test, AsyncTestCase
+from tornado.testing import gen_test, AsyncTestCase, AsyncHTTPTestCase
+from tornado.httpclient import AsyncHTTPClient
+from tornado.web import Application
 
+from electrumq.chain.chain import BLOCK_INTERVAL
+from electrumq.db.sqlite import BlockItem
 from electrumq.message.all import *
-from electrumq.net.client import RPCClient
-from electrumq.net.ioloop import IOLoop
+from electrumq.net.cache import ResponseCache
+from electrumq.net.client import RPCClient, RequestFuture
+from electrumq.net.coalesce import RequestCoalescer
+from electrumq.net.download import HeaderDownloader
+from electrumq.net.framing import FrameBuffer, FrameParser, FRAME_HEAD_ID, FRAME_TAIL_ID
+from electrumq.net.ioloop import IOLoop, MAX_WAIT_SECONDS_BEFORE_SHUTDOWN
+from electrumq.net.lanes import MessageLanes, INTERACTIVE, BULK
 from electrumq.net.manager import NetWorkManager
+from electrumq.net.metrics import MetricsRegistry, Histogram
+from electrumq.net.pool import RoundRobinRouter, LeastOutstandingRouter, StickyRouter
+from electrumq.net.selector import ServerSelector, CachedResolver
 from electrumq.utils.parameter import set_testnet
+import download_server
+from tests.bench_wallets import run_load
+from tests.fake_server import start_fake_server, stop_fake_server, start_download_server, \
+    electrum_results, SyntheticChain
 
 __author__ = 'zhouqi'
 
+IOLOOP_WAIT = 0.11  # second a callback handed to the ioloop thread may take to run
+
 set_testnet()
 
 class MyTestCase(AsyncTestCase):
@@ -53,7 +79,7 @@ class HowToUseNetwork(AsyncTestCase):
         self.ioloop = IOLoop()
         self.ioloop.start()
 
-        ip, port = manager.get_server()
+        ip, port = yield manager.get_server()
 
         self.client = RPCClient(ioloop=self.ioloop, ip=ip, port=port)
         result = yield self.client.connect_with_future()
@@ -97,7 +123,7 @@ class TestIOLoop(AsyncTestCase):
         open_logger('rpcclient')
         self.ioloop = IOLoop()
         self.ioloop.start()
-        self.ioloop_wait = self.ioloop.loop_interval / 1000.0 + 0.01
+        self.ioloop_wait = IOLOOP_WAIT
 
     def tearDown(self):
         self.quit_ioloop()
@@ -124,6 +150,30 @@ class TestIOLoop(AsyncTestCase):
         yield gen.sleep(delta + self.ioloop_wait)
         self.assertTrue(is_done)
 
+    @gen_test()
+    def test_remove_timeout(self):
+        self.fired = []
+        handle = self.ioloop.add_timeout(time.time() + 0.1, lambda: self.fired.append(1))
+        self.ioloop.remove_timeout(handle)
+        self.ioloop.add_timeout(time.time() + 0.1, lambda: self.fired.append(2))
+        yield gen.sleep(0.1 + self.ioloop_wait)
+        self.assertEqual(self.fired, [2])
+
+    @gen_test()
+    def test_periodic(self):
+        self.cnt = 0
+
+        def tick():
+            self.cnt += 1
+
+        periodic = self.ioloop.add_periodic(tick, 20)
+        yield wait_until(lambda: self.cnt >= 3, timeout=1)
+        self.ioloop.stop_periodic(periodic)
+        yield gen.sleep(0.05)
+        cnt = self.cnt
+        yield gen.sleep(0.1)
+        self.assertEqual(self.cnt, cnt)
+
     @gen_test()
     def test_future(self):
         global is_done, cnt
@@ -163,12 +213,34 @@ class TestIOLoop(AsyncTestCase):
         self.assertEqual(cnt, 1)
 
 
+    @gen_test()
+    def test_future_from_threads(self):
+        self.cnt = 0
+
+        def callback(future):
+            self.cnt += 1
+
+        def produce():
+            for _ in xrange(100):
+                future = gen.Future()
+                future.set_result(None)
+                self.ioloop.add_future(future, callback)
+
+        producers = [threading.Thread(target=produce) for _ in xrange(4)]
+        for each in producers:
+            each.start()
+        for each in producers:
+            each.join()
+        # attached at once, not on the next poll
+        yield wait_until(lambda: self.cnt == 400, timeout=IOLOOP_WAIT / 2)
+        self.assertEqual(self.cnt, 400)
+
 class TestClientConnect(AsyncTestCase):
     def setUp(self):
         super(TestClientConnect, self).setUp()
         self.ioloop = IOLoop()
         self.ioloop.start()
-        self.ioloop_wait = self.ioloop.loop_interval / 1000.0 + 0.01
+        self.ioloop_wait = IOLOOP_WAIT
 
     def tearDown(self):
         print 'begin quit_ioloop'
@@ -218,7 +290,7 @@ class TestClientMessage(AsyncTestCase):
         open_logger('rpcclient')
         self.ioloop = IOLoop()
         self.ioloop.start()
-        self.ioloop_wait = self.ioloop.loop_interval / 1000.0 + 0.01
+        self.ioloop_wait = IOLOOP_WAIT
 
     def tearDown(self):
         self.quit_ioloop()
@@ -278,6 +350,1197 @@ class TestClientMessage(AsyncTestCase):
         self.assertTrue(self.is_callback)
 
 
+class TestClientLocalServer(AsyncTestCase):
+    def setUp(self):
+        super(TestClientLocalServer, self).setUp()
+        self.server_loop, self.server, self.port = start_fake_server()
+        self.ioloop = IOLoop()
+        self.ioloop.start()
+
+    def tearDown(self):
+        self.quit_ioloop()
+        stop_fake_server(self.server_loop, self.server)
+        super(TestClientLocalServer, self).tearDown()
+
+    @gen_test
+    def quit_ioloop(self):
+        self.ioloop.quit()
+        yield gen.sleep(self.ioloop.loop_quit_wait + 0.01)
+
+    @gen_test()
+    def test_round_trip(self):
+        self.client = RPCClient(ioloop=self.ioloop, ip='127.0.0.1', port=self.port)
+        result = yield self.client.connect_with_future()
+        self.assertTrue(result)
+
+        self.result = None
+
+        @gen.coroutine
+        def version_callback(msg_id, msg, param):
+            self.result = param
+
+        begin = time.time()
+        self.client.add_message(Version({}), version_callback)
+        yield wait_until(lambda: self.result is not None)
+        self.assertEqual(self.result, 'ElectrumX 1.0.17')
+        self.assertLess(time.time() - begin, 0.5)
+
+    @gen_test(timeout=10)
+    def test_drain_per_tick(self):
+        self.client = RPCClient(ioloop=self.ioloop, ip='127.0.0.1', port=self.port)
+        self.client.wakeup = False
+        self.client.dispatch_budget = 0
+        result = yield self.client.connect_with_future()
+        self.assertTrue(result)
+
+        self.cnt = 0
+
+        @gen.coroutine
+        def version_callback(msg_id, msg, param):
+            self.cnt += 1
+
+        for _ in xrange(200):
+            self.client.add_message(Version({}), version_callback)
+        yield wait_until(lambda: self.cnt == 200, timeout=5)
+        self.assertEqual(self.cnt, 200)
+        stats = self.client.queue_stats()
+        self.assertEqual(stats['response_queue'], 0)
+        self.assertEqual(stats['response_dispatched'], 200)
+        self.assertGreater(stats['response_drain_rate'], 0)
+
+    @gen_test()
+    def test_batch(self):
+        self.client = RPCClient(ioloop=self.ioloop, ip='127.0.0.1', port=self.port)
+        self.client.batch_size = 10
+        self.results = {}
+
+        @gen.coroutine
+        def version_callback(msg_id, msg, param):
+            self.results[msg_id] = param
+
+        for _ in xrange(25):
+            self.client.add_message(Version({}), version_callback)
+        result = yield self.client.connect_with_future()
+        self.assertTrue(result)
+        yield wait_until(lambda: len(self.results) == 25)
+        self.assertEqual(sorted(self.results.keys()), range(25))
+        self.assertEqual(self.server.frame_cnt, 3)
+
+    @gen_test()
+    def test_large_reply(self):
+        chunk = 'ab' * 160000
+        self.server.results['blockchain.block.get_chunk'] = chunk
+        self.client = RPCClient(ioloop=self.ioloop, ip='127.0.0.1', port=self.port)
+        self.client.max_frame_bytes = 400000
+        result = yield self.client.connect_with_future()
+        self.assertTrue(result)
+        self.results = []
+
+        @gen.coroutine
+        def chunk_callback(msg_id, msg, param):
+            self.results.append(param)
+
+        self.client.add_message(GetChunk([0]), chunk_callback)
+        yield wait_until(lambda: len(self.results) == 1)
+        self.assertEqual(self.results, [chunk])
+
+        # too large, dropped and the next reply still parsed
+        self.server.results['blockchain.block.get_chunk'] = chunk * 2
+        self.client.add_message(GetChunk([1]), chunk_callback)
+        self.client.add_message(Version({}), chunk_callback)
+        yield wait_until(lambda: len(self.results) == 2)
+        self.assertEqual(self.results[1], 'ElectrumX 1.0.17')
+        self.assertEqual(self.client.parser.oversize_cnt, 1)
+
+    @gen_test()
+    def test_in_flight_window(self):
+        self.client = RPCClient(ioloop=self.ioloop, ip='127.0.0.1', port=self.port)
+        self.client.max_in_flight = 2
+        self.in_flight = []
+
+        @gen.coroutine
+        def version_callback(msg_id, msg, param):
+            self.in_flight.append(self.client.queue_stats()['in_flight'])
+
+        admits = [self.client.add_message(Version({}), version_callback) for _ in xrange(10)]
+        self.assertEqual(self.client.queue_stats()['message_queue'], 10)
+        result = yield self.client.connect_with_future()
+        self.assertTrue(result)
+        msg_ids = yield admits
+        self.assertEqual(msg_ids, range(10))
+        yield wait_until(lambda: len(self.in_flight) == 10)
+        self.assertEqual(len(self.in_flight), 10)
+        self.assertLessEqual(max(self.in_flight), 1)
+
+    @gen_test()
+    def test_error_frees_slot(self):
+        self.server.errors['blockchain.transaction.get_merkle'] = {
+            'code': 1, 'message': 'tx not in block'}
+        self.client = RPCClient(ioloop=self.ioloop, ip='127.0.0.1', port=self.port)
+        self.client.max_in_flight = 1
+        self.results = []
+
+        @gen.coroutine
+        def version_callback(msg_id, msg, param):
+            self.results.append(param)
+
+        result = yield self.client.connect_with_future()
+        self.assertTrue(result)
+        self.client.add_message(GetMerkle(['%064x' % 1, 1]), version_callback)
+        self.client.add_message(Version({}), version_callback)
+        yield wait_until(lambda: len(self.results) == 1)
+        self.assertEqual(self.results, ['ElectrumX 1.0.17'])
+        self.assertEqual(self.client.queue_stats()['in_flight'], 0)
+
+    @gen_test()
+    def test_oversize_reply(self):
+        # default request_timeout, nothing sweeps the request
+        self.server.results['blockchain.transaction.get'] = 'ab' * 4096
+        self.client = RPCClient(ioloop=self.ioloop, ip='127.0.0.1', port=self.port)
+        self.client.max_in_flight = 1
+        self.client.max_frame_bytes = 1024
+        self.results = []
+
+        @gen.coroutine
+        def callback(msg_id, msg, param):
+            self.results.append(param)
+
+        result = yield self.client.connect_with_future()
+        self.assertTrue(result)
+        future = self.client.add_message(Get(['%064x' % 1]), callback)
+        self.client.add_message(Version({}), callback)
+        yield wait_until(lambda: len(self.results) == 1)
+        self.assertEqual(self.results, ['ElectrumX 1.0.17'])
+        self.assertTrue(future.expired)
+        self.assertIsNotNone(future.error)
+        self.assertEqual(self.client.queue_stats()['in_flight'], 0)
+        self.assertEqual(self.client._callback_dict, {})
+        self.assertTrue(self.client.is_connected)
+
+    @gen_test()
+    def test_error_reply(self):
+        error = {'code': 1, 'message': 'tx not in block'}
+        self.server.errors['blockchain.transaction.get_merkle'] = error
+        self.client = RPCClient(ioloop=self.ioloop, ip='127.0.0.1', port=self.port)
+        self.client.request_timeout = 10
+        self.results = []
+
+        @gen.coroutine
+        def merkle_callback(msg_id, msg, param):
+            self.results.append(param)
+
+        result = yield self.client.connect_with_future()
+        self.assertTrue(result)
+        future = self.client.add_message(GetMerkle(['%064x' % 1, 1]), merkle_callback)
+        yield wait_until(lambda: future.expired)
+        self.assertEqual(future.error, error)
+        self.assertEqual(self.client.outstanding(), 0)
+        self.assertEqual(self.client._callback_dict, {})
+        self.assertEqual(self.client._deadline_dict, {})
+        self.assertEqual(self.results, [])
+
+
+class TestClientReconnect(AsyncTestCase):
+    def setUp(self):
+        super(TestClientReconnect, self).setUp()
+        self.server_loop, self.server, self.port = start_fake_server()
+        self.ioloop = IOLoop()
+        self.ioloop.start()
+
+    def tearDown(self):
+        self.quit_ioloop()
+        stop_fake_server(self.server_loop, self.server)
+        super(TestClientReconnect, self).tearDown()
+
+    @gen_test
+    def quit_ioloop(self):
+        self.ioloop.add_callback(self.client.close)
+        self.ioloop.quit()
+        yield gen.sleep(self.ioloop.loop_quit_wait + 0.01)
+
+    @gen_test(timeout=10)
+    def test_replay(self):
+        self.server.no_reply.add('blockchain.transaction.get')
+        self.client = RPCClient(ioloop=self.ioloop, ip='127.0.0.1', port=self.port)
+        self.client.reconnect_base = 0.05
+        self.client.handshake = Version({})
+        result = yield self.client.connect_with_future()
+        self.assertTrue(result)
+        self.heights = []
+        self.headers = []
+
+        @gen.coroutine
+        def header_callback(msg_id, msg, param):
+            self.heights.append(param['block_height'])
+
+        @gen.coroutine
+        def tx_callback(msg_id, msg, param):
+            self.tx = param
+
+        @gen.coroutine
+        def header_subscribe(params):
+            self.headers.append(params)
+
+        self.client.add_message(headers_subscribe([]), header_callback, header_subscribe)
+        self.client.add_message(Get(['%064x' % 1]), tx_callback)
+        yield wait_until(lambda: len(self.heights) == 1
+                         and self.server.method_cnt.get('blockchain.transaction.get') == 1)
+
+        self.server.results['blockchain.headers.subscribe'] = {'block_height': 1}
+        self.server.no_reply.discard('blockchain.transaction.get')
+        self.server_loop.add_callback(self.server.drop_connections)
+        yield wait_until(lambda: len(self.heights) == 2 and hasattr(self, 'tx'))
+        self.assertEqual(self.client.reconnect_cnt, 1)
+        self.assertEqual(self.heights, [0, 1])
+        self.assertEqual(self.server.method_cnt,
+                         {'server.version': 2, 'blockchain.headers.subscribe': 2,
+                          'blockchain.transaction.get': 2})
+        self.assertEqual(self.client.outstanding(), 0)
+
+        # notifications reach the subscriber on the new connection
+        self.server_loop.add_callback(self.server.notify, 'blockchain.headers.subscribe',
+                                      [{'block_height': 2}])
+        yield wait_until(lambda: len(self.headers) == 1)
+        self.assertEqual(self.headers, [[{'block_height': 2}]])
+
+    @gen_test(timeout=10)
+    def test_backoff(self):
+        self.client = RPCClient(ioloop=self.ioloop, ip='127.0.0.1', port=self.port)
+        self.client.reconnect_base = 0.05
+        result = yield self.client.connect_with_future()
+        self.assertTrue(result)
+        self.server_loop.add_callback(self.server.drop_connections)
+        stop_fake_server(self.server_loop, self.server)
+        yield wait_until(lambda: self.client._reconnect_attempt >= 3)
+        self.assertFalse(self.client.is_connected)
+        self.assertEqual(self.client.reconnect_cnt, 0)
+
+
+class TestClientTimeout(AsyncTestCase):
+    def setUp(self):
+        super(TestClientTimeout, self).setUp()
+        self.server_loop, self.server, self.port = start_fake_server(
+            {'blockchain.transaction.get': '0100'})
+        self.server.no_reply.add('blockchain.transaction.get')
+        self.ioloop = IOLoop()
+        self.ioloop.start()
+        self.client = RPCClient(ioloop=self.ioloop, ip='127.0.0.1', port=self.port)
+        self.client.sweep_interval = 0.05
+        self.results = []
+
+    def tearDown(self):
+        self.quit_ioloop()
+        stop_fake_server(self.server_loop, self.server)
+        super(TestClientTimeout, self).tearDown()
+
+    @gen_test
+    def quit_ioloop(self):
+        self.ioloop.add_callback(self.client.close)
+        self.ioloop.quit()
+        yield gen.sleep(self.ioloop.loop_quit_wait + 0.01)
+
+    @gen.coroutine
+    def tx_callback(self, msg_id, msg, param):
+        self.results.append(param)
+
+    @gen_test()
+    def test_timeout(self):
+        yield self.client.connect_with_future()
+        future = self.client.add_message(Get(['%064x' % 1]), self.tx_callback, timeout=0.1)
+        yield wait_until(lambda: future.expired)
+        self.assertTrue(future.expired)
+        self.assertEqual(self.client.timeout_stats, {'blockchain.transaction.get': 1})
+        self.assertEqual(self.client.queue_stats()['timeouts'], 1)
+        self.assertEqual(self.client.outstanding(), 0)
+        self.assertEqual(self.client._callback_dict, {})
+        self.assertEqual(self.results, [])
+
+    @gen_test()
+    def test_timeout_queued(self):
+        self.client.max_in_flight = 1
+        yield self.client.connect_with_future()
+        first = self.client.add_message(Get(['%064x' % 1]), self.tx_callback, timeout=0.1)
+        queued = self.client.add_message(Get(['%064x' % 2]), self.tx_callback, timeout=0.1)
+        msg_id = yield first
+        self.assertIsNotNone(msg_id)
+        msg_id = yield gen.with_timeout(time.time() + 2, queued)
+        self.assertIsNone(msg_id)
+        self.assertTrue(queued.expired)
+        self.assertEqual(self.client.outstanding(), 0)
+
+    @gen_test()
+    def test_close_stops_sweep(self):
+        yield self.client.connect_with_future()
+        periodics = list(self.client._periodics)
+        self.assertEqual(len(periodics), 1)
+        self.assertTrue(periodics[0].is_running())
+        self.client.close()
+        yield gen.sleep(0.05)
+        self.assertFalse(periodics[0].is_running())
+
+    @gen_test()
+    def test_retry(self):
+        yield self.client.connect_with_future()
+        future = self.client.add_message(Get(['%064x' % 1]), self.tx_callback, timeout=0.1,
+                                         retries=2)
+        yield wait_until(lambda: self.server.method_cnt.get('blockchain.transaction.get') == 1)
+        self.server.no_reply.discard('blockchain.transaction.get')
+        yield wait_until(lambda: len(self.results) == 1)
+        self.assertEqual(self.results, ['0100'])
+        self.assertEqual(self.server.method_cnt['blockchain.transaction.get'], 2)
+        self.assertEqual(self.client.timeout_stats, {'blockchain.transaction.get': 1})
+        self.assertFalse(future.expired)
+
+    @gen_test()
+    def test_cancel(self):
+        # not connected yet, so the message is still queued
+        future = self.client.add_message(Get(['%064x' % 1]), self.tx_callback)
+        self.assertTrue(future.cancel())
+        self.assertTrue(future.cancelled())
+        self.assertFalse(future.cancel())
+        self.assertEqual(self.client.outstanding(), 0)
+        # never written, a producer waiting for it goes on
+        msg_id = yield future
+        self.assertIsNone(msg_id)
+
+        yield self.client.connect_with_future()
+        future = self.client.add_message(Get(['%064x' % 2]), self.tx_callback)
+        yield future
+        self.assertEqual(self.client.outstanding(), 1)
+        self.assertTrue(future.cancel())
+        self.assertEqual(self.client.outstanding(), 0)
+        self.assertEqual(self.client._callback_dict, {})
+
+
+class TestFrameBuffer(unittest.TestCase):
+    class Stream(object):
+        def __init__(self):
+            self.writes = []
+
+        def write(self, content):
+            self.writes.append(content)
+
+    def test_compact(self):
+        frames = FrameBuffer()
+        frames.append({'method': 'server.banner', 'params': ['a b'], 'id': 1})
+        frames.append_batch(['1', '2'])
+        content = frames.take()
+        self.assertEqual(content.split('\n')[1], '[1,2]')
+        self.assertEqual(json.loads(content.split('\n')[0]),
+                         {'method': 'server.banner', 'params': ['a b'], 'id': 1})
+        self.assertNotIn(', ', content)
+        self.assertEqual(len(frames), 0)
+
+    def test_split(self):
+        client = RPCClient(ioloop=None)
+        client.max_write_bytes = 1000
+        for i in xrange(100):
+            client.add_message(Broadcast(['00' * 100]))
+        client.stream = self.Stream()
+        client.is_connected = True
+        client.send_all()
+        self.assertGreater(len(client.stream.writes), 1)
+        frame_len = len(client.stream.writes[0].split('\n')[0]) + 1
+        for content in client.stream.writes:
+            self.assertLess(len(content), client.max_write_bytes + frame_len)
+        lines = ''.join(client.stream.writes).split('\n')
+        self.assertEqual([json.loads(line)['id'] for line in lines[:-1]], range(100))
+        self.assertEqual(len(client._sent_dict), 100)
+
+
+class TestFrameParser(unittest.TestCase):
+    def test_split(self):
+        parser = FrameParser()
+        self.assertEqual(parser.feed('{"id":1}\n{"id"'), ['{"id":1}'])
+        self.assertEqual(parser.feed(':2'), [])
+        self.assertEqual(parser.feed('}\n{"id":3}\n\n'), ['{"id":2}', '{"id":3}', ''])
+
+    def test_max_frame(self):
+        parser = FrameParser(max_frame_bytes=10)
+        self.assertEqual(parser.feed('x' * 8), [])
+        self.assertEqual(parser.feed('x' * 8), [])
+        self.assertEqual(parser.oversize_cnt, 1)
+        self.assertEqual(parser.feed('x' * 8 + '\n{"id":1}\n'), ['{"id":1}'])
+        # ending in the same read
+        self.assertEqual(parser.feed('x' * 50 + '\n{"id":2}\n'), ['{"id":2}'])
+        self.assertEqual(parser.oversize_cnt, 2)
+        self.assertEqual(parser.feed('x' * 6), [])
+        self.assertEqual(parser.feed('x' * 6 + '\n' + 'x' * 10 + '\n'), ['x' * 10])
+        self.assertEqual(parser.oversize_cnt, 3)
+        self.assertEqual(len(parser.take_dropped()), 3)
+        self.assertEqual(parser.dropped, [])
+
+    def test_dropped_edges(self):
+        parser = FrameParser(max_frame_bytes=100)
+        parser.edge_bytes = 16
+        reply = '{"id":7,"result":"%s"}' % ('ab' * 100)
+        for idx in xrange(0, len(reply), 30):
+            self.assertEqual(parser.feed(reply[idx:idx + 30]), [])
+        self.assertEqual(parser.feed('\n'), [])
+        reply2 = '{"result":"%s","id":8}' % ('ab' * 100)
+        self.assertEqual(parser.feed(reply2 + '\n{"id":9}\n'), ['{"id":9}'])
+        (head, tail), (head2, tail2) = parser.take_dropped()
+        self.assertEqual((head, tail), (reply[:16], reply[-16:]))
+        self.assertEqual((head2, tail2), (reply2[:16], reply2[-16:]))
+        self.assertEqual(FRAME_HEAD_ID.match(head).group(1), '7')
+        self.assertIsNone(FRAME_HEAD_ID.match(head2))
+        self.assertEqual(FRAME_TAIL_ID.search(tail2).group(1), '8')
+
+
+class TestMessageLanes(unittest.TestCase):
+    def test_priority(self):
+        lanes = MessageLanes()
+        for i in xrange(1000):
+            lanes.append(GetChunk([i]))
+        lanes.append(Broadcast(['00']))
+        lanes.append(GetBalance(['1ZhouQKMethPQLYaQYcSsqqMNCgbNTYVm']))
+        methods = [lanes.popleft()['method'] for _ in xrange(3)]
+        self.assertIn('blockchain.transaction.broadcast', methods)
+        self.assertIn('blockchain.address.get_balance', methods)
+        self.assertEqual(len(lanes), 999)
+
+    def test_weighted(self):
+        lanes = MessageLanes({INTERACTIVE: 3, BULK: 1})
+        for i in xrange(100):
+            lanes.append(GetChunk([i]))
+            lanes.append(Banner([]))
+        methods = [lanes.popleft()['method'] for _ in xrange(40)]
+        self.assertEqual(methods.count('blockchain.block.get_chunk'), 10)
+        self.assertEqual(lanes.dequeue_cnt, {INTERACTIVE: 30, BULK: 10})
+        # the lane never starves
+        self.assertLessEqual(methods.index('blockchain.block.get_chunk'), 3)
+
+    def test_head(self):
+        lanes = MessageLanes()
+        lanes.append(Banner([]))
+        version = Version([])
+        lanes.appendleft(version)
+        self.assertEqual(list(lanes)[0], version)
+        self.assertIs(lanes.popleft(), version)
+        banner = lanes.popleft()
+        self.assertEqual(banner['method'], 'server.banner')
+        self.assertRaises(IndexError, lanes.popleft)
+
+
+class TestHeaderDownloader(AsyncTestCase):
+    chunk_cnt = 3
+    tail_cnt = 100
+
+    def setUp(self):
+        super(TestHeaderDownloader, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.data = os.urandom(80 * (BLOCK_INTERVAL * self.chunk_cnt + self.tail_cnt))
+        with open(os.path.join(self.dir, 'testnet_headers'), 'wb') as f:
+            f.write(self.data)
+        self.server_loop, self.server, port = start_download_server(self.dir)
+        self.url = 'http://127.0.0.1:%d/files/testnet_headers' % port
+        self.path = os.path.join(self.dir, 'local_headers')
+        self.chunks = {}
+        self.tail = None
+
+    def tearDown(self):
+        stop_fake_server(self.server_loop, self.server)
+        shutil.rmtree(self.dir)
+        super(TestHeaderDownloader, self).tearDown()
+
+    def chunk_callback(self, idx, data):
+        self.assertNotIn(idx, self.chunks)
+        self.chunks[idx] = data
+
+    def tail_callback(self, height, data):
+        self.tail = (height, data)
+
+    def check(self, chunks):
+        size = 80 * BLOCK_INTERVAL
+        self.assertEqual(sorted(self.chunks.keys()), chunks)
+        for idx, data in self.chunks.items():
+            self.assertEqual(data, self.data[idx * size:(idx + 1) * size])
+        self.assertEqual(self.tail, (BLOCK_INTERVAL * self.chunk_cnt,
+                                     self.data[self.chunk_cnt * size:]))
+        self.assertEqual(open(self.path, 'rb').read(), self.data)
+        self.assertFalse(os.path.exists(self.path + '.part'))
+
+    @gen_test(timeout=10)
+    def test_download(self):
+        downloader = HeaderDownloader(self.url, self.path, self.chunk_callback, self.tail_callback)
+        cnt = yield downloader.start()
+        self.assertEqual(cnt, BLOCK_INTERVAL * self.chunk_cnt + self.tail_cnt)
+        self.check(range(self.chunk_cnt))
+
+    @gen_test(timeout=10)
+    def test_resume(self):
+        # interrupted in the middle of the second chunk, the first one is connected
+        with open(self.path + '.part', 'wb') as f:
+            f.write(self.data[:80 * BLOCK_INTERVAL * 3 / 2 + 7])
+        downloader = HeaderDownloader(self.url, self.path, self.chunk_callback, self.tail_callback,
+                                      skip_chunks=1)
+        yield downloader.start()
+        self.check(range(1, self.chunk_cnt))
+
+    @gen_test(timeout=10)
+    def test_resume_complete(self):
+        # a file downloaded before, with a store that stopped in the second chunk
+        with open(self.path, 'wb') as f:
+            f.write(self.data[:80 * BLOCK_INTERVAL * 2])
+        downloader = HeaderDownloader(self.url, self.path, self.chunk_callback, self.tail_callback,
+                                      skip_chunks=1)
+        received = []
+        on_data = downloader.on_data
+        downloader.on_data = lambda data: received.append(len(data)) or on_data(data)
+        yield downloader.start()
+        self.check(range(1, self.chunk_cnt))
+        # only the headers after the file are downloaded
+        self.assertEqual(sum(received), len(self.data) - 80 * BLOCK_INTERVAL * 2)
+
+
+class TestDownloadServer(AsyncHTTPTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.data = os.urandom(80 * (BLOCK_INTERVAL * 2 + 10))
+        with open(os.path.join(self.dir, 'testnet_headers'), 'wb') as f:
+            f.write(self.data)
+        super(TestDownloadServer, self).setUp()
+
+    def tearDown(self):
+        super(TestDownloadServer, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def get_app(self):
+        return Application(download_server.make_routings(self.dir))
+
+    def test_manifest(self):
+        response = self.fetch('/manifest?file=testnet_headers')
+        self.assertEqual(response.code, 200)
+        manifest = json.loads(response.body)
+        self.assertEqual(manifest['headers'], BLOCK_INTERVAL * 2 + 10)
+        size = 80 * BLOCK_INTERVAL
+        self.assertEqual(manifest['sha256'], [hashlib.sha256(self.data[i * size:(i + 1) * size]).hexdigest()
+                                              for i in range(2)])
+        response = self.fetch('/manifest?file=testnet_headers',
+                              headers={'If-None-Match': response.headers['Etag']})
+        self.assertEqual(response.code, 304)
+        self.assertEqual(self.fetch('/manifest?file=../testnet_headers').code, 404)
+
+    def test_delta(self):
+        height = BLOCK_INTERVAL + 5
+        response = self.fetch('/headers?file=testnet_headers&from=%d' % height, decompress_response=False)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, self.data[80 * height:])
+        etag = response.headers['Etag']
+        response = self.fetch('/headers?file=testnet_headers&from=%d' % height, decompress_response=False,
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 304)
+        response = self.fetch('/headers?file=testnet_headers&from=%d' % height)
+        self.assertEqual(response.body, self.data[80 * height:])
+        self.assertEqual(self.fetch('/headers?file=testnet_headers&from=%d' % (BLOCK_INTERVAL * 3)).code, 416)
+
+    def test_precompressed(self):
+        download_server.precompress(self.dir)
+        response = self.fetch('/files/testnet_headers', decompress_response=False,
+                              headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Content-Type'], 'application/octet-stream')
+        self.assertEqual(gzip.GzipFile(fileobj=response.buffer).read(), self.data)
+        # ranges are always served from the plain file
+        response = self.fetch('/files/testnet_headers', decompress_response=False,
+                              headers={'Accept-Encoding': 'gzip', 'Range': 'bytes=800-'})
+        self.assertEqual(response.code, 206)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.body, self.data[800:])
+        response = self.fetch('/files/testnet_headers')
+        self.assertEqual(response.body, self.data)
+
+
+class TestFakeElectrumServer(AsyncTestCase):
+    def setUp(self):
+        super(TestFakeElectrumServer, self).setUp()
+        self.server_loop, self.server, self.port = start_fake_server(
+            electrum_results(height=3000), latency=0.01, jitter=0.02, seed=1)
+        self.client = RPCClient(ioloop=IOLoop(), ip='127.0.0.1', port=self.port)
+        self.client.ioloop.start()
+
+    def tearDown(self):
+        self.client.ioloop.quit()
+        stop_fake_server(self.server_loop, self.server)
+        super(TestFakeElectrumServer, self).tearDown()
+
+    @gen.coroutine
+    def ask(self, message):
+        reply = gen.Future()
+
+        @gen.coroutine
+        def callback(msg_id, msg, result):
+            reply.set_result(result)
+
+        self.client.add_message(message, callback)
+        result = yield reply
+        raise gen.Return(result)
+
+    @gen_test(timeout=10)
+    def test_replay(self):
+        connected = yield self.client.connect_with_future()
+        self.assertTrue(connected)
+        version = yield self.ask(Version(['2.8.3', '1.1']))
+        self.assertEqual(version, ['ElectrumX 1.2', '1.1'])
+        history = yield self.ask(GetHistory(['1ZhouQKMethPQLYaQYcSsqqMNCgbNTYVm']))
+        self.assertEqual(history[0]['height'], 100)
+        raw = yield self.ask(Get([history[0]['tx_hash']]))
+        self.assertTrue(raw.startswith('0100000001'))
+        # not recorded, synthetic
+        history = yield self.ask(GetHistory(['1other']))
+        self.assertEqual(len(history), 3)
+        tip = yield self.ask(headers_subscribe([]))
+        self.assertEqual(tip['block_height'], 3000)
+
+    @gen_test(timeout=10)
+    def test_chunk_links(self):
+        connected = yield self.client.connect_with_future()
+        self.assertTrue(connected)
+        data = yield self.ask(GetChunk([1]))
+        data = data.decode('hex')
+        self.assertEqual(len(data), 80 * (3001 - BLOCK_INTERVAL))
+        chain = SyntheticChain(3000)
+        prev = chain.header_hash(BLOCK_INTERVAL - 1)
+        for idx in xrange(len(data) / 80):
+            block = BlockItem(data[idx * 80:idx * 80 + 80])
+            self.assertEqual(block.block_prev, prev)
+            prev = block.block_hash
+
+    def test_drop(self):
+        self.server.drop_rate = 0.5
+        for idx in xrange(200):
+            self.server.reply({'id': idx, 'method': 'server.banner', 'params': []})
+        self.assertTrue(60 < self.server.drop_cnt < 140)
+
+
+class TestLoadDriver(unittest.TestCase):
+    def test_wallets(self):
+        stats = run_load(wallet_cnt=5, address_cnt=3, latency=0.002, jitter=0.005,
+                         drop_rate=0.05, server_cnt=2, timeout=20)
+        self.assertEqual(stats['done'], 5)
+        # 3 subscribes, 3 histories and 3 txs with merkle for every address
+        self.assertEqual(stats['requests'], 5 * 3 * (1 + 1 + 3 * 2))
+        self.assertIsNotNone(stats['p99'])
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram(buckets=(0.1, 1, float('inf')))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+        self.assertEqual(histogram.cumulative(), [(0.1, 2), (1, 3), (float('inf'), 4)])
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 3.65)
+
+    def test_snapshot(self):
+        registry = MetricsRegistry()
+        registry.request('a:1', 'server.banner')
+        registry.request('b:1', 'server.banner')
+        registry.request('b:1', 'blockchain.transaction.get')
+        registry.response('a:1', 'server.banner', latency=0.02)
+        registry.response('b:1', 'server.banner', latency=0.3)
+        registry.response('b:1', 'blockchain.transaction.get', error=True)
+        registry.bytes_in('a:1', 100)
+        registry.bytes_out('a:1', 40)
+        registry.reconnect('b:1')
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['methods']['server.banner']['requests'], 2)
+        self.assertEqual(snapshot['methods']['server.banner']['latency']['count'], 2)
+        self.assertEqual(snapshot['methods']['blockchain.transaction.get']['errors'], 1)
+        self.assertEqual(snapshot['servers']['a:1']['bytes_in'], 100)
+        self.assertEqual(snapshot['servers']['a:1']['bytes_out'], 40)
+        self.assertEqual(snapshot['servers']['b:1']['requests'], 2)
+        self.assertEqual(snapshot['servers']['b:1']['reconnects'], 1)
+
+    def test_render(self):
+        registry = MetricsRegistry()
+        registry.request('a:1', 'server.banner')
+        registry.response('a:1', 'server.banner', latency=0.02)
+        client = StubClient(3)  # registered clients are weakly referenced
+        registry.register('a:1', client)
+        text = registry.render()
+        self.assertIn('# TYPE electrumq_request_seconds histogram', text)
+        self.assertIn('electrumq_requests_total{method="server.banner",server="a:1"} 1', text)
+        self.assertIn('electrumq_request_seconds_bucket{le="0.01",method="server.banner",server="a:1"} 0',
+                      text)
+        self.assertIn('electrumq_request_seconds_bucket{le="0.025",method="server.banner",server="a:1"} 1',
+                      text)
+        self.assertIn('electrumq_request_seconds_bucket{le="+Inf",method="server.banner",server="a:1"} 1',
+                      text)
+        self.assertIn('electrumq_queue{queue="in_flight",server="a:1"} 3', text)
+        self.assertIn('# TYPE electrumq_timeouts_total counter', text)
+        self.assertIn('electrumq_timeouts_total{server="a:1"} 2', text)
+        self.assertIn('# TYPE electrumq_dispatched_total counter', text)
+        self.assertIn('electrumq_dispatched_total{queue="response",server="a:1"} 7', text)
+        self.assertNotIn('queue="timeouts"', text)
+        self.assertNotIn('queue="response_dispatched"', text)
+
+
+class StubClient(object):
+    is_connected = True
+
+    def __init__(self, outstanding):
+        self._outstanding = outstanding
+
+    def outstanding(self):
+        return self._outstanding
+
+    def queue_stats(self):
+        return {'in_flight': self._outstanding, 'timeouts': 2, 'response_dispatched': 7,
+                'response_drain_rate': 0.5}
+
+
+class TestRouter(unittest.TestCase):
+    def test_round_robin(self):
+        clients = [StubClient(0), StubClient(0), StubClient(0)]
+        router = RoundRobinRouter()
+        picked = [router.route(clients, Version({})) for _ in xrange(6)]
+        self.assertEqual(picked, clients + clients)
+
+    def test_least_outstanding(self):
+        clients = [StubClient(5), StubClient(1), StubClient(3)]
+        self.assertIs(LeastOutstandingRouter().route(clients, Version({})), clients[1])
+
+    def test_sticky(self):
+        clients = [StubClient(0), StubClient(0)]
+        router = StickyRouter(fallback=RoundRobinRouter())
+        first = router.route(clients, address_subscribe(['1ZhouQKMethPQLYaQYcSsqqMNCgbNTYVm']))
+        other = router.route(clients, address_subscribe(['1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2']))
+        self.assertIsNot(first, other)
+        for _ in xrange(3):
+            self.assertIs(
+                router.route(clients, address_subscribe(['1ZhouQKMethPQLYaQYcSsqqMNCgbNTYVm'])),
+                first)
+        clients.remove(first)
+        self.assertIs(
+            router.route(clients, address_subscribe(['1ZhouQKMethPQLYaQYcSsqqMNCgbNTYVm'])),
+            other)
+
+
+class TestRequestCoalescer(AsyncTestCase):
+    @gen_test
+    def test_coalesce(self):
+        coalescer = RequestCoalescer()
+        sent = []
+        self.results = []
+
+        def send(message, callback):
+            sent.append((message, callback))
+            return len(sent)
+
+        @gen.coroutine
+        def merkle_callback(msg_id, msg, param):
+            self.results.append(param)
+
+        tx_hash = '50d958904e0ab7bac04cbc7f81e27d14143306ba2ad04f3770bf36dfa388e059'
+        self.assertEqual(coalescer.add_message(GetMerkle([tx_hash, 1]), merkle_callback, send), 1)
+        self.assertEqual(coalescer.add_message(GetMerkle([tx_hash, 1]), merkle_callback, send), 1)
+        self.assertEqual(coalescer.add_message(Get([tx_hash]), merkle_callback, send), 2)
+        self.assertEqual(len(sent), 2)
+
+        message, callback = sent[0]
+        yield callback(0, message, 'merkle')
+        self.assertEqual(self.results, ['merkle', 'merkle'])
+        stats = coalescer.stats()
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['waiting'], 1)
+
+        # answered, the next identical request goes to the wire again
+        coalescer.add_message(GetMerkle([tx_hash, 1]), merkle_callback, send)
+        self.assertEqual(len(sent), 3)
+
+
+class TestResponseCache(unittest.TestCase):
+    tx_hash = '50d958904e0ab7bac04cbc7f81e27d14143306ba2ad04f3770bf36dfa388e059'
+
+    def setUp(self):
+        self.path = tempfile.mktemp(suffix='.sqlite')
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_rule(self):
+        cache = ResponseCache(self.path)
+        self.assertTrue(cache.is_cacheable(Get([self.tx_hash])))
+        self.assertFalse(cache.is_cacheable(GetHistory(['1ZhouQKMethPQLYaQYcSsqqMNCgbNTYVm']), 1000))
+        self.assertFalse(cache.is_cacheable(GetMerkle([self.tx_hash, 1000])))
+        self.assertFalse(cache.is_cacheable(GetMerkle([self.tx_hash, 0]), 1000))
+        self.assertFalse(cache.is_cacheable(GetMerkle([self.tx_hash, 996]), 1000))
+        self.assertTrue(cache.is_cacheable(GetMerkle([self.tx_hash, 995]), 1000))
+        self.assertFalse(cache.is_cacheable(GetChunk([0]), 2019))
+        self.assertTrue(cache.is_cacheable(GetChunk([0]), 2020))
+
+    def test_persist(self):
+        cache = ResponseCache(self.path)
+        self.assertIsNone(cache.get(Get([self.tx_hash])))
+        cache.put(Get([self.tx_hash]), '0100')
+        cache = ResponseCache(self.path)
+        self.assertEqual(cache.get(Get([self.tx_hash])), '0100')
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 0, 'size': 6})
+
+    def test_lru(self):
+        cache = ResponseCache(self.path, max_bytes=30)
+        for i in xrange(3):
+            cache.put(Get(['%064x' % i]), '%08x' % i)
+        cache.get(Get(['%064x' % 0]))
+        cache.put(Get(['%064x' % 3]), '%08x' % 3)
+        self.assertLessEqual(cache.size, 30)
+        self.assertEqual(cache.get(Get(['%064x' % 0])), '%08x' % 0)
+        self.assertIsNone(cache.get(Get(['%064x' % 1])))
+        self.assertEqual(cache.get(Get(['%064x' % 3])), '%08x' % 3)
+
+    def test_access_batch(self):
+        cache = ResponseCache(self.path)
+        cache.flush_access = 3
+        for i in xrange(3):
+            cache.put(Get(['%064x' % i]), '%08x' % i)
+
+        def access(i):
+            return cache.conn.execute('SELECT access FROM responses WHERE cache_key=?',
+                                      (cache.key(Get(['%064x' % i])),)).fetchone()[0]
+
+        cache.get(Get(['%064x' % 0]))
+        cache.get(Get(['%064x' % 1]))
+        self.assertEqual((access(0), access(1)), (1, 2))
+        cache.get(Get(['%064x' % 2]))
+        self.assertEqual([access(i) for i in xrange(3)], [4, 5, 6])
+        cache.get(Get(['%064x' % 0]))
+        cache.put(Get(['%064x' % 3]), '%08x' % 3)
+        self.assertEqual((access(0), access(3)), (7, 8))
+
+    def test_discard_from(self):
+        cache = ResponseCache(self.path)
+        cache.put(Get([self.tx_hash]), '0100')
+        for height in (900, 995, 1000):
+            cache.put(GetMerkle([self.tx_hash, height]), {'block_height': height})
+        cache.put(GetChunk([0]), '00')
+        self.assertEqual(cache.discard_from(2016), 0)
+        # the chunk holding 995 goes too
+        self.assertEqual(cache.discard_from(995), 3)
+        self.assertEqual(cache.get(GetMerkle([self.tx_hash, 900])), {'block_height': 900})
+        self.assertIsNone(cache.get(GetMerkle([self.tx_hash, 995])))
+        self.assertIsNone(cache.get(GetMerkle([self.tx_hash, 1000])))
+        self.assertIsNone(cache.get(GetChunk([0])))
+        self.assertEqual(cache.get(Get([self.tx_hash])), '0100')
+        self.assertEqual(cache.size, len('"0100"') + len(json.dumps({'block_height': 900})))
+
+
+class TestServerSelector(AsyncTestCase):
+    fast, slow = 'fast.example:50001:t', 'slow.example:50001:t'
+
+    def setUp(self):
+        super(TestServerSelector, self).setUp()
+        self.path = tempfile.mktemp(suffix='.json')
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        super(TestServerSelector, self).tearDown()
+
+    def test_score(self):
+        selector = ServerSelector()
+        selector.record(self.fast, rtt=0.1)
+        selector.record(self.slow, rtt=0.5)
+        self.assertEqual(selector.pick([self.slow, self.fast]), [self.fast])
+        # errors make the fast server worse than the slow one
+        selector.record(self.fast, error=True)
+        selector.record(self.fast, error=True)
+        self.assertEqual(selector.pick([self.slow, self.fast]), [self.slow])
+        self.assertEqual(selector.pick([self.slow, self.fast], exclude_set={self.slow}),
+                         [self.fast])
+        # never measured servers come after the measured ones
+        self.assertEqual(selector.pick(['new.example:50001:t', self.slow, self.fast], count=2),
+                         [self.slow, self.fast])
+
+    def test_persist(self):
+        selector = ServerSelector(self.path)
+        selector.record(self.fast, rtt=0.1)
+        selector.save()
+        self.assertAlmostEqual(ServerSelector(self.path).score(self.fast), selector.score(self.fast))
+
+    @gen_test()
+    def test_resolve(self):
+        resolver = CachedResolver()
+        address = yield resolver.resolve('localhost', 50001)
+        self.assertEqual(address[1], 50001)
+        self.assertIn(('localhost', 50001), resolver._cache)
+        address = yield resolver.resolve('no-such-host.invalid', 50001)
+        self.assertEqual(address, ('no-such-host.invalid', 50001))
+
+    @gen_test(timeout=10)
+    def test_probe(self):
+        server_loop, server, port = start_fake_server()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        dead_port = sock.getsockname()[1]
+        sock.close()
+        ioloop = IOLoop()
+        ioloop.start()
+        try:
+            selector = ServerSelector(self.path)
+            alive, dead = '127.0.0.1:%d:t' % port, '127.0.0.1:%d:t' % dead_port
+            yield selector.probe(ioloop, [alive, dead])
+            self.assertEqual(selector.scores[dead]['error'], selector.alpha)
+            self.assertEqual(selector.scores[alive]['error'], 0)
+            self.assertEqual(selector.pick([dead, alive]), [alive])
+            self.assertIn(alive, ServerSelector(self.path).scores)
+        finally:
+            ioloop.quit()
+            stop_fake_server(server_loop, server)
+
+
+class TestNetWorkManagerLanes(AsyncTestCase):
+    chunk_cnt = 200
+
+    def setUp(self):
+        super(TestNetWorkManagerLanes, self).setUp()
+        self.server_loop, self.server, self.port = start_fake_server(
+            {'blockchain.block.get_chunk': '00'}, latency=0.05)
+        self.manager = NetWorkManager()
+
+    def tearDown(self):
+        self.quit_manager()
+        stop_fake_server(self.server_loop, self.server)
+        super(TestNetWorkManagerLanes, self).tearDown()
+
+    @gen_test
+    def quit_manager(self):
+        self.manager.quit()
+        yield gen.sleep(MAX_WAIT_SECONDS_BEFORE_SHUTDOWN + 0.01)
+
+    @gen_test(timeout=10)
+    def test_interactive_overtakes_bulk(self):
+        # default settings of the manager
+        self.manager.start(servers=[('127.0.0.1', self.port)])
+        yield wait_until(lambda: self.manager.client.is_connected)
+        self.chunks = 0
+        self.chunks_before_banner = None
+
+        @gen.coroutine
+        def chunk_callback(msg_id, msg, param):
+            self.chunks += 1
+
+        @gen.coroutine
+        def banner_callback(msg_id, msg, param):
+            self.chunks_before_banner = self.chunks
+
+        for idx in xrange(self.chunk_cnt):
+            self.manager.add_message(GetChunk([idx]), chunk_callback)
+        yield gen.sleep(0.01)
+        self.manager.add_message(Banner([]), banner_callback)
+        yield wait_until(lambda: self.chunks == self.chunk_cnt, timeout=8)
+        # the window kept most chunks in the bulk lane, the banner took the next slot
+        self.assertLess(self.chunks_before_banner, self.chunk_cnt / 2)
+
+
+class TestNetWorkManagerPool(AsyncTestCase):
+    def setUp(self):
+        super(TestNetWorkManagerPool, self).setUp()
+        self.servers = [start_fake_server({'blockchain.transaction.get': '0100'})
+                        for _ in xrange(3)]
+        self.manager = NetWorkManager()
+        self.manager.pool_size = 3
+        self.manager.router = RoundRobinRouter()
+        self.manager.coalesce = False
+        self.manager.cache_enabled = False
+        self.manager.metrics = MetricsRegistry()
+
+    def tearDown(self):
+        self.quit_manager()
+        self.manager.pool_size = 1
+        self.manager.router = None
+        self.manager.coalesce = True
+        self.manager.cache_enabled = True
+        for server_loop, server, port in self.servers:
+            stop_fake_server(server_loop, server)
+        super(TestNetWorkManagerPool, self).tearDown()
+
+    @gen_test
+    def quit_manager(self):
+        self.manager.quit()
+        yield gen.sleep(MAX_WAIT_SECONDS_BEFORE_SHUTDOWN + 0.01)
+
+    @gen_test(timeout=5)
+    def test_explicit_server_kept(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        self.manager.pool_size = 1
+        self.manager.start(servers=[('127.0.0.1', port)])
+        client = self.manager.client
+        yield gen.sleep(1)
+        self.assertEqual((client.ip, client.port), ('127.0.0.1', port))
+        self.assertFalse(client.is_connected)
+        # 0.25-0.5s then 0.5-1s between the attempts, no busy loop
+        self.assertIn(client._reconnect_attempt, (2, 3))
+
+    @gen_test()
+    def test_probe_after_quit(self):
+        self.manager.start(servers=[('127.0.0.1', self.servers[0][2])])
+        ioloop = self.manager.ioloop
+        self.manager.quit()
+        # returns instead of probing through a quit ioloop
+        yield self.manager.probe_servers(ioloop)
+
+    @gen_test()
+    def test_round_robin(self):
+        self.manager.start(servers=[('127.0.0.1', port) for _, _, port in self.servers])
+        self.assertEqual(len(self.manager.pool), 3)
+        yield wait_until(lambda: all(c.is_connected for c in self.manager.pool.clients))
+        self.cnt = 0
+
+        @gen.coroutine
+        def banner_callback(msg_id, msg, param):
+            self.cnt += 1
+
+        for _ in xrange(30):
+            self.manager.add_message(Banner([]), banner_callback)
+        yield wait_until(lambda: self.cnt == 30)
+        self.assertEqual(self.cnt, 30)
+        # 10 banners and one version after connected for every server
+        self.assertEqual([server.request_cnt for _, server, _ in self.servers], [11, 11, 11])
+
+    @gen_test()
+    def test_metrics(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.manager.metrics_port = sock.getsockname()[1]
+        sock.close()
+        try:
+            self.manager.start(servers=[('127.0.0.1', port) for _, _, port in self.servers])
+            yield wait_until(lambda: all(c.is_connected for c in self.manager.pool.clients))
+            self.cnt = 0
+
+            @gen.coroutine
+            def banner_callback(msg_id, msg, param):
+                self.cnt += 1
+
+            for _ in xrange(6):
+                self.manager.add_message(Banner([]), banner_callback)
+            yield wait_until(lambda: self.cnt == 6)
+            snapshot = self.manager.metrics.snapshot()
+            banner = snapshot['methods']['server.banner']
+            self.assertEqual(banner['requests'], 6)
+            self.assertEqual(banner['errors'], 0)
+            self.assertEqual(banner['latency']['count'], 6)
+            self.assertEqual(len(snapshot['servers']), 3)
+            for server in snapshot['servers'].values():
+                self.assertGreater(server['bytes_in'], 0)
+                self.assertGreater(server['bytes_out'], 0)
+                self.assertEqual(server['queues']['in_flight'], 0)
+            response = yield AsyncHTTPClient().fetch(
+                'http://127.0.0.1:%d/metrics' % self.manager.metrics_port)
+            self.assertIn('electrumq_request_seconds_count{method="server.banner",server="127.0.0.1:%d"} 2'
+                          % self.servers[0][2], response.body)
+        finally:
+            self.manager.metrics_port = 0
+
+    @gen_test()
+    def test_coalesce(self):
+        self.manager.coalesce = True
+        self.manager.start(servers=[('127.0.0.1', port) for _, _, port in self.servers])
+        self.cnt = 0
+
+        @gen.coroutine
+        def banner_callback(msg_id, msg, param):
+            self.cnt += 1
+
+        for _ in xrange(5):
+            self.manager.add_message(Banner([]), banner_callback)
+        yield wait_until(lambda: self.cnt == 5)
+        self.assertEqual(self.cnt, 5)
+        self.assertEqual(
+            sum([server.method_cnt.get('server.banner', 0) for _, server, _ in self.servers]), 1)
+        self.assertGreaterEqual(self.manager.coalescer.stats()['hits'], 4)
+
+    @gen_test()
+    def test_coalesce_error(self):
+        self.manager.coalesce = True
+        for _, server, _ in self.servers:
+            server.errors['blockchain.transaction.get_merkle'] = 'tx not in block'
+        self.manager.start(servers=[('127.0.0.1', port) for _, _, port in self.servers])
+        yield wait_until(lambda: all(c.is_connected for c in self.manager.pool.clients))
+        self.results = []
+
+        @gen.coroutine
+        def merkle_callback(msg_id, msg, param):
+            self.results.append(param)
+
+        admits = [self.manager.add_message(GetMerkle(['%064x' % 1, 1]), merkle_callback)
+                  for _ in xrange(2)]
+        self.assertIs(admits[0], admits[1])
+        yield wait_until(lambda: admits[0].expired)
+        self.assertEqual(admits[0].error, 'tx not in block')
+        self.assertEqual(self.manager.coalescer.stats()['waiting'], 0)
+        # released, the next identical request goes to the wire again
+        admit = self.manager.add_message(GetMerkle(['%064x' % 1, 1]), merkle_callback)
+        yield wait_until(lambda: admit.expired)
+        self.assertEqual(sum([server.method_cnt.get('blockchain.transaction.get_merkle', 0)
+                              for _, server, _ in self.servers]), 2)
+        self.assertEqual(self.results, [])
+
+    @gen_test()
+    def test_cache(self):
+        path = tempfile.mktemp(suffix='.sqlite')
+        self.manager.cache = ResponseCache(path)
+        self.manager.start(servers=[('127.0.0.1', port) for _, _, port in self.servers])
+        self.results = []
+
+        @gen.coroutine
+        def tx_callback(msg_id, msg, param):
+            self.results.append(param)
+
+        try:
+            futures = []
+            for i in xrange(2):
+                futures.append(self.manager.add_message(Get(['%064x' % 1]), tx_callback))
+                yield wait_until(lambda: len(self.results) == i + 1)
+            self.assertEqual(self.results, ['0100', '0100'])
+            # a hit is a RequestFuture answered already
+            self.assertIsInstance(futures[1], RequestFuture)
+            self.assertTrue(futures[1].done())
+            self.assertIsNone(futures[1].msg_id)
+            self.assertFalse(futures[1].cancel())
+            self.assertEqual(sum([server.method_cnt.get('blockchain.transaction.get', 0)
+                                  for _, server, _ in self.servers]), 1)
+            self.assertEqual(self.manager.cache.stats()['hits'], 1)
+        finally:
+            self.manager.cache = None
+            os.remove(path)
+
+
+    @gen_test()
+    def test_retry_other_server(self):
+        self.servers[0][1].no_reply.add('blockchain.transaction.get')
+        self.manager.start(servers=[('127.0.0.1', port) for _, _, port in self.servers])
+        for client in self.manager.pool.clients:
+            client.sweep_interval = 0.05
+        yield wait_until(lambda: all(c.is_connected for c in self.manager.pool.clients))
+        self.results = []
+
+        @gen.coroutine
+        def tx_callback(msg_id, msg, param):
+            self.results.append(param)
+
+        self.manager.add_message(Get(['%064x' % 1]), tx_callback, timeout=0.1, retries=1)
+        yield wait_until(lambda: len(self.results) == 1)
+        self.assertEqual(self.results, ['0100'])
+        self.assertEqual([server.method_cnt.get('blockchain.transaction.get', 0)
+                          for _, server, _ in self.servers][0], 1)
+        self.assertEqual(sum([server.method_cnt.get('blockchain.transaction.get', 0)
+                              for _, server, _ in self.servers]), 2)
+
+
+@gen.coroutine
+def wait_until(predicate, timeout=3, step=0.01):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        yield gen.sleep(step)
+
+
 class FakeTcpServer():
     pass
 
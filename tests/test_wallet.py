@@ -1,8 +1,15 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import os
+import tempfile
 from unittest import TestCase
 
 from tornado.testing import AsyncTestCase
 
+from electrumq.db import sqlite
+from electrumq.db.sqlite import Connection
+from electrumq.db.sqlite.tx import TxStore
+from electrumq.net.client import RequestFuture
 from electrumq.net.manager import NetWorkManager
 from electrumq.utils.configuration import dirs
 from electrumq.wallet import BaseWallet, WalletConfig
@@ -25,3 +32,124 @@ class TestWalletSync(TestCase):
         network.start()
         wallet = SimpleWallet(WalletConfig(store_path=dirs.user_data_dir + '/' + '00.json'))
         wallet.sync()
+
+
+class TestAddressStatus(TestCase):
+    address = '1ZhouQKMethPQLYaQYcSsqqMNCgbNTYVm'
+    history = [{'tx_hash': '%064x' % 1, 'height': 100}, {'tx_hash': '%064x' % 2, 'height': 0}]
+
+    def setUp(self):
+        self.path = tempfile.mktemp(suffix='.json')
+        self.sqlite_path = sqlite.sqlite_path
+        sqlite.sqlite_path = tempfile.mktemp(suffix='.sqlite')
+        sqlite.init()
+        # requests are recorded instead of sent
+        self.sent = []
+        network = NetWorkManager()
+        network.add_message = self.add_message
+        self.addCleanup(delattr, network, 'add_message')
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.remove(sqlite.sqlite_path)
+        sqlite.sqlite_path = self.sqlite_path
+
+    def add_message(self, message, callback=None, **kwargs):
+        future = RequestFuture(None, len(self.sent))
+        self.sent.append((message, future))
+        return future
+
+    def sent_methods(self):
+        return [(message['method'], message['params']) for message, _ in self.sent]
+
+    def test_status(self):
+        self.assertIsNone(BaseWallet.history_status([]))
+        self.assertEqual(BaseWallet.history_status(self.history), hashlib.sha256(
+            '%064x:100:%064x:0:' % (1, 2)).hexdigest())
+
+    def test_unchanged(self):
+        wallet = BaseWallet(WalletConfig(store_path=self.path))
+        # never used address, nothing to ask
+        wallet.on_address_status(self.address, None)
+        wallet.address_status[self.address] = BaseWallet.history_status(self.history)
+        wallet.on_address_status(self.address, BaseWallet.history_status(self.history))
+        self.assertEqual(wallet._history_pending, 0)
+
+    def test_changed(self):
+        wallet = BaseWallet(WalletConfig(store_path=self.path))
+        wallet.is_mine = lambda address: address == self.address
+        wallet.address_status[self.address] = BaseWallet.history_status(self.history[:1])
+        wallet.on_address_status(self.address, BaseWallet.history_status(self.history))
+        # a notification of the address
+        wallet.address_notify([self.address, BaseWallet.history_status(self.history)])
+        wallet.address_notify([self.address + '2', 'status'])
+        self.assertEqual(self.sent_methods(),
+                         [('blockchain.address.get_history', [self.address])] * 2)
+        self.assertEqual(wallet._history_pending, 2)
+
+    def test_history_delta(self):
+        wallet = BaseWallet(WalletConfig(store_path=self.path))
+        moved, known, unverified, unfetched, new = ['%064x' % i for i in xrange(1, 6)]
+        for tx_hash in (moved, known, unverified, unfetched):
+            TxStore().add(self.address, tx_hash, 100)
+        for tx_hash in (moved, known, unfetched):
+            TxStore().verified_tx(tx_hash)
+        with Connection.gen_db() as conn:
+            conn.execute('UPDATE txs SET tx_ver=1 WHERE tx_hash IN (?, ?, ?)',
+                         (moved, known, unverified))
+        wallet.on_address_status(self.address, 'status')
+        message, _ = self.sent.pop()
+        history = [{'tx_hash': moved, 'height': 101}, {'tx_hash': known, 'height': 100},
+                   {'tx_hash': unverified, 'height': 100}, {'tx_hash': unfetched, 'height': 100},
+                   {'tx_hash': new, 'height': 0}]
+        wallet.history_callback(None, message, history)
+        self.assertEqual(sorted(self.sent_methods()), [
+            ('blockchain.transaction.get', [unfetched]),
+            ('blockchain.transaction.get', [new]),
+            ('blockchain.transaction.get_merkle', [moved, 101]),
+            ('blockchain.transaction.get_merkle', [unverified, 100])])
+        self.assertEqual(wallet._history_pending, 0)
+        self.assertEqual(wallet.address_status[self.address], BaseWallet.history_status(history))
+
+    def test_resume_txs(self):
+        wallet = BaseWallet(WalletConfig(store_path=self.path))
+        wallet.get_addresses = lambda: [self.address]
+        unverified, unfetched, unconfirmed, done = ['%064x' % i for i in xrange(1, 5)]
+        for tx_hash, height in ((unverified, 100), (unfetched, 100), (unconfirmed, 0),
+                                (done, 100)):
+            TxStore().add(self.address, tx_hash, height)
+        for tx_hash in (unfetched, done):
+            TxStore().verified_tx(tx_hash)
+        with Connection.gen_db() as conn:
+            conn.execute('UPDATE txs SET tx_ver=1 WHERE tx_hash IN (?, ?, ?)',
+                         (unverified, unconfirmed, done))
+        # the status was saved before the replies of the last run came back
+        wallet.sync()
+        self.assertEqual(sorted(self.sent_methods()), [
+            ('blockchain.address.subscribe', [self.address]),
+            ('blockchain.transaction.get', [unfetched]),
+            ('blockchain.transaction.get_merkle', [unverified, 100])])
+
+    def test_history_failed(self):
+        wallet = BaseWallet(WalletConfig(store_path=self.path))
+        wallet.on_address_status(self.address, 'status')
+        wallet.on_address_status(self.address + '2', 'status')
+        self.assertEqual(wallet._history_pending, 2)
+        # answered with an error, then timed out
+        self.sent[0][1].error = {'message': 'failed'}
+        self.sent[0][1].expire()
+        self.sent[1][1].expire()
+        self.assertEqual(wallet._history_pending, 0)
+        self.assertNotIn(self.address, wallet.address_status)
+        # the next notification asks again
+        wallet.on_address_status(self.address, 'status')
+        self.assertEqual(len(self.sent), 3)
+
+    def test_persist(self):
+        wallet = BaseWallet(WalletConfig(store_path=self.path))
+        wallet.address_status[self.address] = BaseWallet.history_status(self.history)
+        wallet.save_address_status()
+        wallet = BaseWallet(WalletConfig(store_path=self.path))
+        self.assertEqual(wallet.address_status,
+                         {self.address: BaseWallet.history_status(self.history)})